@@ -0,0 +1,614 @@
+#!/usr/bin/env python3
+"""Measures the cost of virttop: collection, rendering and whole TUI frames,
+against libvirt's test:/// driver or a synthetic connection with N domains,
+M disks and NICs each and a configurable latency per RPC.
+
+Every size runs in its own process so the peak RSS is that of the size alone.
+The results are written as JSON for tracking regressions over time.
+
+    python benchmarks/bench.py --sizes 10 100 1000 10000 --output results.json
+"""
+
+import argparse
+import collections
+import contextlib
+import curses
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+import libvirt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from virttop import virttop  # pylint: disable=wrong-import-position
+
+# the fakes mirror the libvirt-python method names and signatures
+# pylint: disable=invalid-name,unused-argument
+
+URI: str = "bench:///"
+
+
+class NoSupport(libvirt.libvirtError):
+    """What drivers without the bulk stats API raise."""
+
+    def get_error_code(self):
+        return libvirt.VIR_ERR_NO_SUPPORT
+
+
+class FakeVolume:  # pylint: disable=too-few-public-methods
+    """A storage volume of FakePool."""
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def path(self) -> str:
+        """The path of the volume."""
+        return self._path
+
+
+class FakePool:
+    """A storage pool holding the disks of every domain."""
+
+    def __init__(self, backend: "FakeBackend", paths: typing.List[str]):
+        self.backend = backend
+        self.paths = paths
+
+    def name(self) -> str:
+        """The name of the pool."""
+        return "default"
+
+    def listAllVolumes(self, flags: int = 0):
+        """Lists the volumes of the pool."""
+        self.backend.rpc("virStoragePoolListAllVolumes")
+        return [FakeVolume(path) for path in self.paths]
+
+
+class FakeDomain:
+    """A domain of FakeConnection. Counters grow with the monotonic clock so
+    that rates come out steady."""
+
+    def __init__(self, backend: "FakeBackend", index: int):
+        self.backend = backend
+        self.index = index
+        self._name = f"bench-{index}"
+        self._uuid = f"00000000-0000-0000-0000-{index:012d}"
+        # one in ten domains is shut off
+        self.dom_id = index + 1 if index % 10 else -1
+
+    def ID(self) -> int:
+        """Cached by libvirt-python, no RPC."""
+        return self.dom_id
+
+    def name(self) -> str:
+        """Cached by libvirt-python, no RPC."""
+        return self._name
+
+    def UUIDString(self) -> str:
+        """Cached by libvirt-python, no RPC."""
+        return self._uuid
+
+    def disk_path(self, disk: int) -> str:
+        """The source of a disk."""
+        return f"/var/lib/libvirt/images/{self._name}-{disk}.qcow2"
+
+    def mac(self, nic: int) -> str:
+        """The MAC address of a NIC."""
+        octets = (
+            nic,
+            self.index >> 16 & 0xFF,
+            self.index >> 8 & 0xFF,
+            self.index & 0xFF,
+        )
+        return "52:54:" + ":".join(f"{octet:02x}" for octet in octets)
+
+    def XMLDesc(self, flags: int = 0) -> str:
+        """The domain XML, with the disks and NICs only."""
+        self.backend.rpc("virDomainGetXMLDesc")
+        devices = [
+            f'<disk type="file" device="disk"><source file="{self.disk_path(disk)}"/>'
+            f'<target dev="vd{chr(ord("a") + disk % 26)}"/></disk>'
+            for disk in range(self.backend.disks)
+        ]
+        devices.extend(
+            f'<interface type="network"><mac address="{self.mac(nic)}"/>'
+            f'<target dev="vnet{self.index}-{nic}"/></interface>'
+            for nic in range(self.backend.nics)
+        )
+        return (
+            f"<domain><name>{self._name}</name><uuid>{self._uuid}</uuid>"
+            f"<devices>{''.join(devices)}</devices></domain>"
+        )
+
+    def snapshotNum(self, flags: int = 0) -> int:
+        """The number of snapshots."""
+        self.backend.rpc("virDomainSnapshotNum")
+        return self.index % 3
+
+    def info(self) -> list:
+        """State, memory, vCPUs and CPU time."""
+        self.backend.rpc("virDomainGetInfo")
+        state = libvirt.VIR_DOMAIN_RUNNING if self.dom_id > 0 else 5
+        return [state, 2097152, 2097152, 2, time.monotonic_ns()]
+
+    def getCPUStats(self, total: bool) -> list:
+        """The total CPU time."""
+        self.backend.rpc("virDomainGetCPUStats")
+        return [{"cpu_time": time.monotonic_ns()}]
+
+    def memoryStats(self) -> dict:
+        """The balloon stats."""
+        self.backend.rpc("virDomainMemoryStats")
+        return {"actual": 2097152, "available": 1048576}
+
+    def interfaceStats(self, device: str) -> list:
+        """The counters of one NIC."""
+        self.backend.rpc("virDomainInterfaceStats")
+        now = time.monotonic_ns()
+        return [now // 1000, now // 100000, 0, 0, now // 2000, now // 200000, 0, 0]
+
+    def blockStats(self, device: str) -> list:
+        """The counters of one disk."""
+        self.backend.rpc("virDomainBlockStats")
+        now = time.monotonic_ns()
+        return [now // 100000, now // 100, now // 300000, now // 300, 0]
+
+    def interfaceAddresses(self, source: int, flags: int = 0) -> dict:
+        """The DHCP leases of the NICs, every source knows them."""
+        self.backend.rpc("virDomainInterfaceAddresses")
+        return {
+            f"vnet{self.index}.{nic}": {
+                "hwaddr": self.mac(nic),
+                "addrs": [
+                    {
+                        "type": 0,
+                        "addr": f"10.{nic}.{self.index // 256 % 256}.{self.index % 256}",
+                        "prefix": 16,
+                    }
+                ],
+            }
+            for nic in range(self.backend.nics)
+        }
+
+    def stats(self) -> dict:
+        """The typed parameters getAllDomainStats reports for the domain."""
+        stats: typing.Dict[str, typing.Any] = {
+            "state.state": libvirt.VIR_DOMAIN_RUNNING if self.dom_id > 0 else 5,
+            "state.reason": 0,
+        }
+        if self.dom_id < 0:
+            return stats
+        now = time.monotonic_ns()
+        stats["cpu.time"] = now
+        stats["balloon.current"] = 2097152
+        stats["balloon.available"] = 1048576
+        stats["net.count"] = self.backend.nics
+        for nic in range(self.backend.nics):
+            stats[f"net.{nic}.name"] = f"vnet{self.index}-{nic}"
+            stats[f"net.{nic}.rx.bytes"] = now // 1000
+            stats[f"net.{nic}.tx.bytes"] = now // 2000
+        stats["block.count"] = self.backend.disks
+        for disk in range(self.backend.disks):
+            stats[f"block.{disk}.name"] = f"vd{chr(ord('a') + disk % 26)}"
+            stats[f"block.{disk}.path"] = self.disk_path(disk)
+            stats[f"block.{disk}.rd.bytes"] = now // 100
+            stats[f"block.{disk}.wr.bytes"] = now // 300
+            stats[f"block.{disk}.rd.reqs"] = now // 100000
+            stats[f"block.{disk}.wr.reqs"] = now // 300000
+        return stats
+
+
+class FakeConnection:
+    """Answers the calls virttop makes with synthetic domains."""
+
+    def __init__(self, backend: "FakeBackend"):
+        self.backend = backend
+
+    def getURI(self) -> str:
+        """Cached by libvirt-python, no RPC."""
+        return URI
+
+    def setKeepAlive(self, interval: int, count: int) -> int:
+        """Keepalives are set up once per connection."""
+        return 0
+
+    def registerCloseCallback(self, callback, opaque) -> int:
+        """The connection never closes."""
+        return 0
+
+    def unregisterCloseCallback(self) -> int:
+        """The connection never closes."""
+        return 0
+
+    def domainEventRegisterAny(self, dom, event_id, callback, opaque) -> int:
+        """Events never fire, the domains stay the same."""
+        self.backend.rpc("virConnectDomainEventRegisterAny")
+        return 0
+
+    def storagePoolEventRegisterAny(self, pool, event_id, callback, opaque) -> int:
+        """Events never fire, the pools stay the same."""
+        self.backend.rpc("virConnectStoragePoolEventRegisterAny")
+        return 0
+
+    def isAlive(self) -> int:
+        """The connection never dies."""
+        return 1
+
+    def close(self) -> int:
+        """Nothing to release."""
+        return 0
+
+    def listAllDomains(self, flags: int = 0) -> list:
+        """Lists the domains."""
+        self.backend.rpc("virConnectListAllDomains")
+        return list(self.backend.domains)
+
+    def lookupByName(self, name: str) -> FakeDomain:
+        """Looks a domain up by name."""
+        self.backend.rpc("virDomainLookupByName")
+        return self.backend.domains[int(name.rsplit("-", 1)[1])]
+
+    def listAllStoragePools(self, flags: int = 0) -> list:
+        """Lists the pools."""
+        self.backend.rpc("virConnectListAllStoragePools")
+        return [
+            FakePool(
+                self.backend,
+                [
+                    dom.disk_path(disk)
+                    for dom in self.backend.domains
+                    for disk in range(self.backend.disks)
+                ],
+            )
+        ]
+
+    def getAllDomainStats(self, stats: int = 0, flags: int = 0) -> list:
+        """The stats of all the domains."""
+        self.backend.rpc("virConnectGetAllDomainStats")
+        if not self.backend.bulk:
+            raise NoSupport("this function is not supported by the connection driver")
+        return [
+            (dom, dom.stats())
+            for dom in self.backend.domains
+            if not flags or dom.dom_id > 0
+        ]
+
+    def domainListGetStats(self, doms: list, stats: int = 0, flags: int = 0) -> list:
+        """The stats of the given domains."""
+        self.backend.rpc("virDomainListGetStats")
+        if not self.backend.bulk:
+            raise NoSupport("this function is not supported by the connection driver")
+        return [(dom, dom.stats()) for dom in doms]
+
+
+class FakeBackend:
+    """A synthetic hypervisor, each call counted and delayed by latency."""
+
+    def __init__(self, domains: int, disks: int, nics: int, latency: float, bulk: bool):
+        self.disks = disks
+        self.nics = nics
+        self.latency = latency
+        self.bulk = bulk
+        self.domains = [FakeDomain(self, index) for index in range(domains)]
+        self.calls: typing.Counter[str] = collections.Counter()
+        self.lock = threading.Lock()
+
+    def rpc(self, name: str) -> None:
+        """Accounts for one round trip."""
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def open(self, uri: str, auth: list, flags: int) -> FakeConnection:
+        """Opens a connection, in place of libvirt.openAuth."""
+        return FakeConnection(self)
+
+    @contextlib.contextmanager
+    def counting(self) -> typing.Iterator[typing.Counter[str]]:
+        """Counts the calls made within the block."""
+        self.calls.clear()
+        yield self.calls
+
+
+class TestDriverBackend:
+    """libvirt's in-process test:/// driver, filled with domains. Every
+    connection to test:///default gets its own state, so all the pools are
+    handed the same connection."""
+
+    def __init__(self, domains: int, disks: int, nics: int):
+        # domain events need an event loop implementation before connecting
+        virttop.start_event_loop()
+        self.conn = libvirt.open("test:///default")
+        for index in range(domains):
+            devices = "".join(
+                f'<disk type="file" device="disk">'
+                f'<source file="/var/lib/libvirt/images/bench-{index}-{disk}.img"/>'
+                f'<target dev="vd{chr(ord("a") + disk % 26)}"/></disk>'
+                for disk in range(disks)
+            ) + "".join(
+                '<interface type="network"><source network="default"/></interface>'
+                for _ in range(nics)
+            )
+            self.conn.createXML(
+                f"<domain type='test'><name>bench-{index}</name>"
+                "<memory unit='MiB'>64</memory><vcpu>1</vcpu>"
+                "<os><type>hvm</type></os>"
+                f"<devices>{devices}</devices></domain>"
+            )
+
+    def open(self, uri: str, auth: list, flags: int) -> libvirt.virConnect:
+        """Opens a connection, in place of libvirt.openAuth."""
+        return self.conn
+
+    @contextlib.contextmanager
+    def counting(self) -> typing.Iterator[typing.Counter[str]]:
+        """Counts the calls into the libvirt C bindings within the block,
+        through a profile hook installed on the threads started within it."""
+        calls: typing.Counter[str] = collections.Counter()
+
+        def hook(frame, event, arg):  # pylint: disable=unused-argument
+            if event == "c_call" and getattr(arg, "__module__", "") == "libvirtmod":
+                # freeing objects and fetching errors stay in the process
+                if not arg.__name__.endswith("Free") and "Error" not in arg.__name__:
+                    calls[arg.__name__] += 1
+
+        threading.setprofile(hook)
+        sys.setprofile(hook)
+        try:
+            yield calls
+        finally:
+            sys.setprofile(None)
+            threading.setprofile(None)
+
+
+class FakeScreen:
+    """Stands in for the curses window. getch feeds the next snapshot and
+    records when the previous frame was done."""
+
+    def __init__(self, feed: "SnapshotFeed", lines: int = 50, cols: int = 250):
+        self.feed = feed
+        self.size = (lines, cols)
+        self.frame_ends: typing.List[float] = []
+
+    def getmaxyx(self) -> typing.Tuple[int, int]:
+        """The terminal size."""
+        return self.size
+
+    def addnstr(self, *args) -> None:
+        """Drawing is what is measured, the terminal is not."""
+
+    def clear(self) -> None:
+        """See addnstr."""
+
+    def box(self) -> None:
+        """See addnstr."""
+
+    def attron(self, attr: int) -> None:
+        """See addnstr."""
+
+    def attroff(self, attr: int) -> None:
+        """See addnstr."""
+
+    def refresh(self) -> None:
+        """See addnstr."""
+
+    def getch(self) -> int:
+        """Moves on to the next snapshot, quits after the last one."""
+        self.frame_ends.append(time.perf_counter())
+        return -1 if self.feed.advance() else ord("q")
+
+
+class SnapshotFeed:
+    """A snapshot source for tui_loop cycling through collected data."""
+
+    def __init__(self, virt_datas: typing.List[virttop.VirtData], frames: int):
+        self.virt_datas = virt_datas
+        self.frames = frames
+        self.generation: int = 0
+
+    def advance(self) -> bool:
+        """Publishes the next snapshot, False once all have been shown."""
+        if self.generation >= self.frames:
+            return False
+        self.generation += 1
+        return True
+
+    def latest(self) -> virttop.Snapshot:
+        """The current snapshot."""
+        return virttop.Snapshot(
+            self.virt_datas[self.generation % len(self.virt_datas)],
+            frozenset(),
+            time.monotonic(),
+            self.generation,
+        )
+
+
+def percentiles(samples: typing.List[float]) -> typing.Dict[str, float]:
+    """Nearest rank percentiles of samples in seconds, in milliseconds."""
+    ordered = sorted(samples)
+
+    def rank(percent: float) -> float:
+        index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "p50": rank(50),
+        "p90": rank(90),
+        "p99": rank(99),
+        "max": round(ordered[-1] * 1000, 3),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+def make_collector(backend, history: int = 2) -> virttop.HostCollector:
+    """A collector of the one benchmark URI, connected through the backend."""
+    conn_pool = virttop.ConnectionPool(opener=backend.open)
+    context = virttop.CollectionContext(False, metrics=virttop.MetricsStore(history))
+    return virttop.HostCollector(conn_pool, [URI], context, 600.0, 1)
+
+
+def run_size(args) -> dict:
+    """Runs every benchmark for one size, in this process."""
+    if args.backend == "test":
+        backend = TestDriverBackend(args.domains, args.disks, args.nics)
+    else:
+        backend = FakeBackend(
+            args.domains, args.disks, args.nics, args.latency / 1000, not args.no_bulk
+        )
+    # no terminal, the colors are plain attributes
+    curses.color_pair = lambda pair: pair << 8
+
+    # the calls of the first pass set up the caches the later ones use
+    rpcs = {}
+    collector = make_collector(backend)
+    for name in ("first_collect", "collect"):
+        with backend.counting() as calls:
+            collector.collect()
+            rpcs[name] = dict(sorted(calls.items()))
+    collector.close()
+
+    collector = make_collector(backend)
+    started = time.perf_counter()
+    virt_datas = [collector.collect()]
+    first_collect = time.perf_counter() - started
+    collect_times = []
+    for _ in range(args.frames):
+        started = time.perf_counter()
+        virt_data = collector.collect()
+        collect_times.append(time.perf_counter() - started)
+        virt_datas = [virt_datas[-1], virt_data]
+    collector.close()
+    collector.conn_pool.close()
+
+    # sorting, formatting and drawing the visible rows of a new snapshot
+    feed = SnapshotFeed(virt_datas, args.frames)
+    screen = FakeScreen(feed)
+    renderer = virttop.Renderer(screen, virttop.HEADERS)
+    view = virttop.SortedView(False)
+    render_times = []
+    for generation in range(args.frames):
+        started = time.perf_counter()
+        view.update(virt_datas[generation % 2].records)
+        rows = [
+            (virttop.get_row(view[row], frozenset()), 0)
+            for row in range(min(len(view), renderer.height()))
+        ]
+        renderer.draw(rows)
+        render_times.append(time.perf_counter() - started)
+
+    # whole iterations of the TUI loop, from one getch to the next
+    virttop.tui_loop(screen, None, feed, False)
+    frame_times = [
+        end - start for start, end in zip(screen.frame_ends, screen.frame_ends[1:])
+    ]
+
+    return {
+        "domains": args.domains,
+        "disks": args.disks,
+        "nics": args.nics,
+        "latency_ms": args.latency if args.backend == "fake" else None,
+        "bulk": not args.no_bulk,
+        "first_collect_ms": round(first_collect * 1000, 3),
+        "collect_ms": percentiles(collect_times),
+        "render_ms": percentiles(render_times),
+        "frame_ms": percentiles(frame_times),
+        "rpcs": rpcs,
+        # kilobytes on Linux, bytes on macOS
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+class Argparser:  # pylint: disable=too-few-public-methods
+    """Argparser class."""
+
+    def __init__(self):
+        self.parser = argparse.ArgumentParser()
+        self.parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            help="Numbers of domains to run at",
+            default=[10, 100, 1000, 10000],
+        )
+        self.parser.add_argument(
+            "--backend",
+            choices=("fake", "test"),
+            help="Synthetic connection or libvirt's test:/// driver",
+            default="fake",
+        )
+        self.parser.add_argument(
+            "--disks", type=int, help="Disks per domain", default=2
+        )
+        self.parser.add_argument("--nics", type=int, help="NICs per domain", default=2)
+        self.parser.add_argument(
+            "--latency",
+            type=float,
+            help="Milliseconds added to every call of the fake backend",
+            default=0.0,
+        )
+        self.parser.add_argument(
+            "--no-bulk",
+            action="store_true",
+            help="Make the fake backend refuse the bulk stats API",
+            default=False,
+        )
+        self.parser.add_argument(
+            "--frames", type=int, help="Samples per benchmark", default=20
+        )
+        self.parser.add_argument(
+            "--output", "-o", type=str, help="Write the results to a file", default=None
+        )
+        self.parser.add_argument(
+            "--domains", type=int, help=argparse.SUPPRESS, default=None
+        )
+        self.args = self.parser.parse_args()
+
+
+def main() -> None:
+    """Runs every size in a child process and writes the results."""
+    argparser = Argparser()
+    args = argparser.args
+    if args.domains is not None:
+        json.dump(run_size(args), sys.stdout)
+        return
+
+    results = []
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), "--domains", str(size)]
+        for option in ("backend", "disks", "nics", "latency", "frames"):
+            command += [f"--{option}", str(getattr(args, option))]
+        if args.no_bulk:
+            command.append("--no-bulk")
+        result = json.loads(
+            subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+        )
+        print(
+            f"{size:>6} domains: collect p50 {result['collect_ms']['p50']}ms "
+            f"frame p50 {result['frame_ms']['p50']}ms "
+            f"peak rss {result['peak_rss']}",
+            file=sys.stderr,
+        )
+        results.append(result)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Tests of parsing and evaluating the alert rules."""
+
+import math
+
+import pytest
+
+from virttop import virttop
+
+URI: str = "fake:///"
+
+
+def make_data(cpu_percent: float, mem_available: float = 512) -> virttop.VirtData:
+    """One domain with the given CPU% and KiB of available memory out of 1024."""
+    record = virttop.DomainRecord(URI, "00000000-0000-0000-0000-000000000000", "vm", 1)
+    record.mem_actual = 1024
+    record.mem_available = mem_available
+    record.rates = (cpu_percent * 1e7,) + (0.0,) * (len(virttop.METRICS) - 1)
+    virt_data = virttop.VirtData()
+    virt_data.add(record)
+    return virt_data
+
+
+def test_rules_scale_their_thresholds():
+    """Units and durations are turned into bytes and seconds."""
+    rule = virttop.parse_alert_rule("disk write rate > 500MB/s for 2m")
+    assert rule.metric is virttop.DISK_WR_METRIC
+    assert rule.threshold == 500e6
+    assert rule.duration == 120
+    assert not rule.percent
+
+    rule = virttop.parse_alert_rule("mem_avail < 5%")
+    assert rule.percent
+    assert rule.threshold == 5
+    assert rule.duration == 0
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["cpu% >", "load > 1", "cpu% > 90MB", "mem_actual > 1GB/s", "iops > 10kb"],
+)
+def test_bad_rules_are_refused(text):
+    """Unknown metrics and units that do not fit the metric are errors."""
+    with pytest.raises(ValueError):
+        virttop.parse_alert_rule(text)
+
+
+def test_percent_of_the_total():
+    """A threshold in % compares against the total of the metric, and an
+    unknown total never holds."""
+    rule = virttop.parse_alert_rule("mem_avail < 5%")
+    record = next(iter(make_data(0, mem_available=40).records.values()))
+    assert rule.holds(record)
+    record.mem_actual = math.nan
+    assert not rule.holds(record)
+
+
+def test_rule_fires_after_its_duration_and_resolves():
+    """A domain fires once the condition held for the duration, once."""
+    engine = virttop.AlertEngine([virttop.parse_alert_rule("cpu% > 90 for 60s")])
+    key = (URI, "00000000-0000-0000-0000-000000000000")
+
+    assert not engine.evaluate(make_data(95), frozenset(), now=0)
+    assert not engine.evaluate(make_data(95), frozenset(), now=59)
+    events = engine.evaluate(make_data(95), frozenset(), now=60)
+    assert [event.firing for event in events] == [True]
+    assert engine.firing == {key}
+    assert not engine.evaluate(make_data(95), frozenset(), now=120)
+
+    events = engine.evaluate(make_data(10), frozenset(), now=130)
+    assert [event.firing for event in events] == [False]
+    assert engine.firing == frozenset()
+
+
+def test_stale_hosts_are_left_alone():
+    """A host that did not answer neither resolves nor resets its alerts."""
+    engine = virttop.AlertEngine([virttop.parse_alert_rule("cpu% > 90")])
+    engine.evaluate(make_data(95), frozenset(), now=0)
+    assert not engine.evaluate(make_data(10), frozenset((URI,)), now=1)
+    assert engine.firing
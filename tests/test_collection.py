@@ -0,0 +1,121 @@
+"""Tests of the collection against a minimal fake libvirt connection."""
+
+# the fakes mirror the libvirt-python method names and signatures
+# pylint: disable=invalid-name,unused-argument
+
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from virttop import virttop  # pylint: disable=wrong-import-position
+
+URI: str = "fake:///"
+
+
+class FakeDomain:
+    """A running domain without devices."""
+
+    def __init__(self, index: int):
+        self.index = index
+
+    def ID(self) -> int:
+        """Cached by libvirt-python, no RPC."""
+        return self.index + 1
+
+    def name(self) -> str:
+        """Cached by libvirt-python, no RPC."""
+        return f"fake-{self.index}"
+
+    def UUIDString(self) -> str:
+        """Cached by libvirt-python, no RPC."""
+        return f"00000000-0000-0000-0000-{self.index:012d}"
+
+    def XMLDesc(self, flags: int = 0) -> str:
+        """The domain XML, without devices."""
+        return f"<domain><name>{self.name()}</name><devices/></domain>"
+
+    def snapshotNum(self, flags: int = 0) -> int:
+        """The number of snapshots."""
+        return 0
+
+    def memoryStats(self) -> dict:
+        """The balloon stats."""
+        return {"actual": 2097152, "available": 1048576}
+
+    def interfaceAddresses(self, source: int, flags: int = 0) -> dict:
+        """No NICs, no addresses."""
+        return {}
+
+
+class FakeConnection:
+    """Reports the stats groups that were asked for only, like libvirt."""
+
+    def __init__(self):
+        self.domains = [FakeDomain(0)]
+
+    def getURI(self) -> str:
+        """Cached by libvirt-python, no RPC."""
+        return URI
+
+    def getAllDomainStats(self, stats: int = 0, flags: int = 0) -> list:
+        """The stats of all the domains."""
+        result = []
+        for dom in self.domains:
+            values = {"state.state": libvirt.VIR_DOMAIN_RUNNING, "cpu.time": 1}
+            if stats & libvirt.VIR_DOMAIN_STATS_BALLOON:
+                values["balloon.current"] = 2097152
+                values["balloon.available"] = 1048576
+            result.append((dom, values))
+        return result
+
+
+def test_new_domain_between_balloon_refreshes_has_memory():
+    """A domain showing up while balloon is not due still gets its memory."""
+    conn = FakeConnection()
+    context = virttop.CollectionContext(False)
+    try:
+        first = virttop.VirtData()
+        virttop.fill_virt_data(conn, first, context)
+        conn.domains.append(FakeDomain(1))
+        second = virttop.VirtData()
+        virttop.fill_virt_data(
+            conn,
+            second,
+            context,
+            due=virttop.ALL_GROUPS - {"balloon"},
+            previous=first.records,
+        )
+    finally:
+        context.resolver.close()
+
+    assert len(second.records) == 2
+    for record in second.records.values():
+        assert record.mem_actual == 2097152
+        assert record.mem_available == 1048576
+
+
+class SplitAddressDomain(FakeDomain):
+    """Two NICs, the leases know the first and only the agent the second."""
+
+    def interfaceAddresses(self, source: int, flags: int = 0) -> dict:
+        """The NICs the source knows."""
+        if source == libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE:
+            nic, mac, addr = "vnet0", "52:54:00:00:00:01", "10.0.0.1"
+        elif source == libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT:
+            nic, mac, addr = "eth1", "52:54:00:00:00:02", "192.168.1.2"
+        else:
+            return {}
+        return {nic: {"hwaddr": mac, "addrs": [{"type": 0, "addr": addr}]}}
+
+
+def test_addresses_of_every_nic_are_merged_across_sources():
+    """A NIC only one of the later sources knows still gets its address."""
+    resolver = virttop.AddressResolver()
+    dom = SplitAddressDomain(0)
+    key = (URI, dom.UUIDString())
+    try:
+        resolver.resolve(URI, dom, key, ("52:54:00:00:00:01", "52:54:00:00:00:02"))
+    finally:
+        resolver.close()
+
+    assert resolver.addresses[key][2] == "10.0.0.1,192.168.1.2"
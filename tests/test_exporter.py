@@ -0,0 +1,63 @@
+"""Tests of the OpenMetrics exporter."""
+
+import math
+
+import pytest
+
+from virttop import virttop
+
+URI: str = "fake:///"
+
+
+@pytest.mark.parametrize(
+    "address,expected",
+    [
+        (":9177", ("", 9177)),
+        ("127.0.0.1:9177", ("127.0.0.1", 9177)),
+        ("[::1]:9177", ("::1", 9177)),
+    ],
+)
+def test_addresses(address, expected):
+    """The address is optional, an IPv6 one bracketed."""
+    assert virttop.parse_address(address) == expected
+
+
+@pytest.mark.parametrize("address", ["9177", "localhost", ":http", ":0", ":65536"])
+def test_bad_addresses_are_refused(address):
+    """Anything but ADDR:PORT with a valid port is an error."""
+    with pytest.raises(ValueError):
+        virttop.parse_address(address)
+
+
+def test_rendering():
+    """Running domains get their samples, counters a _total suffix, unknown
+    values no sample, labels are escaped and stale URIs are marked."""
+    running = virttop.DomainRecord(URI, "uuid-0", 'vm "0"', 1)
+    running.cpu_time = 2_000_000_000
+    running.mem_actual = 1024
+    running.net_rx = math.nan
+    shut_off = virttop.DomainRecord(URI, "uuid-1", "vm-1", -1)
+    shut_off.mem_actual = 1024
+    virt_data = virttop.VirtData()
+    virt_data.add(running)
+    virt_data.add(shut_off)
+    snapshot = virttop.Snapshot(virt_data, frozenset(("stale:///",)), 0.0, 1)
+
+    lines = virttop.render_openmetrics(snapshot).decode().splitlines()
+
+    label = f'uri="{URI}",uuid="uuid-0",name="vm \\"0\\""'
+    assert f"virttop_domain_running{{{label}}} 1" in lines
+    assert f"virttop_domain_cpu_seconds_total{{{label}}} 2" in lines
+    assert f"virttop_domain_memory_actual_bytes{{{label}}} 1048576" in lines
+    assert not any(line.startswith("virttop_domain_network_receive") for line in lines)
+    assert not any('uuid="uuid-1"' in line for line in lines if "bytes" in line)
+    assert 'virttop_uri_stale{uri="stale:///"} 1' in lines
+    assert f'virttop_uri_stale{{uri="{URI}"}} 0' in lines
+    assert lines[-1] == "# EOF"
+
+
+def test_rendering_nothing_yet():
+    """Before the first snapshot there are only the metric families."""
+    lines = virttop.render_openmetrics(None).decode().splitlines()
+    assert all(line.startswith("#") for line in lines)
+    assert lines[-1] == "# EOF"
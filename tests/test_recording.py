@@ -0,0 +1,69 @@
+"""Tests of the recording format and of recovering a torn recording."""
+
+import os
+
+from virttop import virttop
+
+URI: str = "fake:///"
+
+
+def make_snapshot(generation: int, count: int = 3) -> virttop.Snapshot:
+    """A snapshot of count domains whose counters grow with generation."""
+    virt_data = virttop.VirtData()
+    for index in range(count):
+        record = virttop.DomainRecord(
+            URI, f"00000000-0000-0000-0000-{index:012d}", f"fake-{index}", index + 1
+        )
+        record.cpu_time = 1000 * generation + index
+        record.mem_actual = 2097152
+        record.net_rx = 100 * generation
+        record.ip = f"10.0.0.{index}" if generation % 2 else "-"
+        virt_data.add(record)
+    return virttop.Snapshot(virt_data, frozenset(), 0.0, generation)
+
+
+def columns(record: virttop.DomainRecord) -> tuple:
+    """The recorded columns of a record, NaN as None so they compare."""
+    return tuple(
+        getattr(record, field) for field in virttop.RECORDED_STRINGS
+    ) + virttop.recorded_values(record)
+
+
+def test_frames_round_trip_against_the_previous_frame():
+    """A delta frame decodes to the snapshot it was encoded from."""
+    first, second = make_snapshot(1), make_snapshot(2, count=2)
+    payload, previous = virttop.encode_frame(first, {})
+    _, domains = virttop.decode_frame(payload, 0, [])
+    payload, _ = virttop.encode_frame(second, previous)
+    stale_uris, domains = virttop.decode_frame(payload, 0, domains)
+
+    assert stale_uris == frozenset()
+    assert [columns(virttop.make_record(domain)) for domain in domains] == [
+        columns(record) for record in second.virt_data.records.values()
+    ]
+
+
+def test_appending_after_a_torn_frame(tmp_path):
+    """A frame a crash cut short is dropped and appending goes on after the
+    last complete one."""
+    path = str(tmp_path / "virttop.rec")
+    recorder = virttop.Recorder(path)
+    for generation in range(3):
+        recorder.write(make_snapshot(generation))
+    recorder.close()
+    os.truncate(path, os.path.getsize(path) - 5)
+
+    recorder = virttop.Recorder(path)
+    recorder.write(make_snapshot(3))
+    recorder.close()
+
+    replay = virttop.Replay(path)
+    try:
+        assert len(replay) == 3
+        assert os.path.getsize(path + ".idx") == 3 * virttop.INDEX_ENTRY.size
+        records = replay.decode(2).virt_data.records.values()
+        assert [columns(record) for record in records] == [
+            columns(record) for record in make_snapshot(3).virt_data.records.values()
+        ]
+    finally:
+        replay.close()
@@ -0,0 +1,38 @@
+"""Tests of the parsing of the domain XML."""
+
+from virttop import virttop
+
+XML: str = """
+<domain>
+  <devices>
+    <disk type="file" device="disk">
+      <source file="/var/lib/libvirt/images/vm.qcow2"/>
+      <target dev="vda"/>
+    </disk>
+    <disk type="volume" device="disk">
+      <source pool="fast" volume="vm-data"/>
+      <target dev="vdb"/>
+    </disk>
+    <disk type="file" device="cdrom">
+      <target dev="sda"/>
+    </disk>
+    <interface type="network">
+      <mac address="52:54:00:00:00:01"/>
+      <target dev="vnet0"/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+
+def test_disks_and_nics():
+    """Every disk and NIC comes with its target and source, a volume backed
+    disk with its pool since it has no path to look the pool up by."""
+    topology = virttop.parse_topology(XML)
+
+    assert topology.disks == (
+        virttop.Disk("vda", "/var/lib/libvirt/images/vm.qcow2"),
+        virttop.Disk("vdb", "vm-data", "fast"),
+        virttop.Disk("sda", ""),
+    )
+    assert topology.interfaces == (virttop.Interface("vnet0", "52:54:00:00:00:01"),)
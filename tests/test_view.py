@@ -0,0 +1,73 @@
+"""Tests of the order SortedView keeps the domains in."""
+
+import math
+import re
+
+from virttop import virttop
+
+URI: str = "fake:///"
+NAME: int = 1
+CPU_TIME: int = 2
+
+
+def make_records(*cpu_times: float) -> dict:
+    """Records named vm-0, vm-1, ... with the given CPU times, a negative one
+    standing for a shut off domain."""
+    records = {}
+    for index, cpu_time in enumerate(cpu_times):
+        record = virttop.DomainRecord(
+            URI, f"uuid-{index}", f"vm-{index}", -1 if cpu_time < 0 else index + 1
+        )
+        record.cpu_time = cpu_time
+        records[record.key] = record
+    return records
+
+
+def names(view: virttop.SortedView) -> list:
+    """The names of the domains in display order."""
+    return [view[index].name for index in range(len(view))]
+
+
+def test_default_order_puts_active_domains_first():
+    """Without a sort column domains keep the order they were first seen in,
+    the shut off ones after the others."""
+    view = virttop.SortedView(False)
+    view.update(make_records(1, -1, 3))
+    assert names(view) == ["vm-0", "vm-2", "vm-1"]
+
+
+def test_sorting_by_a_column_both_ways_with_nans_last():
+    """Numbers sort by value, unknown values last in either direction."""
+    view = virttop.SortedView(False)
+    view.update(make_records(3, math.nan, 1, 2))
+    view.sort_by(CPU_TIME, False)
+    assert names(view) == ["vm-2", "vm-3", "vm-0", "vm-1"]
+    view.sort_by(CPU_TIME, True)
+    assert names(view) == ["vm-0", "vm-3", "vm-2", "vm-1"]
+    view.sort_by(NAME, True)
+    assert names(view) == ["vm-3", "vm-2", "vm-1", "vm-0"]
+
+
+def test_updates_move_the_changed_records_only():
+    """A record whose key changed is moved to its new place, a gone one is
+    dropped and a new one inserted, as a full sort would."""
+    view = virttop.SortedView(False)
+    view.update(make_records(*range(20)))
+    view.sort_by(CPU_TIME, False)
+    records = make_records(*range(21))
+    records[(URI, "uuid-0")].cpu_time = 5.5
+    del records[(URI, "uuid-4")]
+    view.update(records)
+
+    expected = sorted(records.values(), key=lambda record: record.cpu_time)
+    assert names(view) == [record.name for record in expected]
+    assert view.index((URI, "uuid-0")) == names(view).index("vm-0")
+    assert view.index((URI, "uuid-4")) is None
+
+
+def test_filters():
+    """Only the records matching the filters are shown."""
+    view = virttop.SortedView(True)
+    view.update(make_records(1, -1, 3, 4))
+    view.filter_by(re.compile("vm-[0-2]"), None)
+    assert names(view) == ["vm-0", "vm-2"]
@@ -1,30 +1,82 @@
 #!/usr/bin/env python
 """virttop"""
 
+# annotations mention libvirt types, which must not import libvirt
+from __future__ import annotations
+
 # ideally we would like to use the monkeypatch but it is untested
 # and experimental
 # import defusedxml  # type:ignore
 # defusedxml.defuse_stdlib()
 import argparse
-import asyncio
+import array
+import bisect
+import concurrent.futures
+import contextlib
 import csv
 import curses
 import dataclasses
 import functools
+import http.server
+import importlib.util
+import ipaddress
+import json
 import logging
+import math
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import operator
 import os
+import re
 import signal
+import socket
+import stat
+import struct
 import sys
+import threading
 import time
+import tomllib
 import typing
 
-# we are only using this for type annotation
-from xml.dom.minidom import Document  # nosec
 
-from defusedxml import ElementTree  # type:ignore
-from defusedxml import minidom
-import libvirt  # type:ignore
-import tomllib
+class MissingModule:  # pylint: disable=too-few-public-methods
+    """Stands in for a module that is not installed, failing on first use
+    rather than on import."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, attr: str):
+        raise ModuleNotFoundError(f"No module named {self.name!r}", name=self.name)
+
+
+def lazy_import(name: str):
+    """Imports a module the first time one of its attributes is used, so that
+    --help and config errors do not pay for importing libvirt, and what does
+    not use libvirt at all works without it."""
+    if name in sys.modules:
+        # replacing it would leave two copies, e.g. of libvirt.libvirtError
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        return MissingModule(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load_now(module) -> None:
+    """Loads a module from lazy_import right away, as any attribute access
+    does."""
+    vars(module)
+
+
+ElementTree = lazy_import("defusedxml.ElementTree")
+libvirt = lazy_import("libvirt")
 
 
 def request_cred(credentials, sasl_user, sasl_pass):
@@ -37,6 +89,323 @@ def request_cred(credentials, sasl_user, sasl_pass):
     return 0
 
 
+def run_event_loop() -> None:
+    """Runs the default libvirt event loop forever."""
+    while True:
+        try:
+            libvirt.virEventRunDefaultImpl()
+        except Exception as exception:
+            logging.exception(exception)
+
+
+def start_event_loop() -> None:
+    """Registers the default libvirt event loop and runs it in a daemon thread.
+    Keepalives and close callbacks only work with a running event loop so this
+    needs to be called before any connection is opened."""
+    libvirt.virEventRegisterDefaultImpl()
+    threading.Thread(target=run_event_loop, name="libvirt-events", daemon=True).start()
+
+
+class Histogram:  # pylint: disable=too-few-public-methods
+    """Latencies bucketed by powers of two microseconds. Recording is an
+    increment, so it can sit around every libvirt call."""
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = array.array("Q", bytes(8 * 40))
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+
+    def record(self, elapsed: float) -> None:
+        """Adds one latency in seconds."""
+        self.buckets[min(int(elapsed * 1_000_000).bit_length(), 39)] += 1
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def quantile(self, fraction: float) -> float:
+        """The upper bound in seconds of the bucket holding the quantile."""
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << bucket) / 1_000_000, self.max)
+        return self.max
+
+
+class RpcLimiter:
+    """Bounds the libvirt calls in flight per URI, so that the collection,
+    the address lookups, the detail pane and the actions together cannot pile
+    up on one slow host. 0 means no bound."""
+
+    def __init__(self, max_inflight: int = 0):
+        self.max_inflight = max_inflight
+        self.semaphores: typing.Dict[str, threading.BoundedSemaphore] = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def slot(self, uri: str) -> typing.Iterator[None]:
+        """Holds one of the slots of the URI for the block."""
+        if self.max_inflight <= 0 or not uri:
+            yield
+            return
+        semaphore = self.semaphores.get(uri)
+        if semaphore is None:
+            with self.lock:
+                semaphore = self.semaphores.setdefault(
+                    uri, threading.BoundedSemaphore(self.max_inflight)
+                )
+        with semaphore:
+            yield
+
+
+RPC_LIMITER = RpcLimiter()
+
+
+class Profiler:
+    """Latency histograms per URI and per libvirt call or phase, the UI
+    phases having an empty URI. The calls of a URI are made from several
+    threads, so histograms are updated under a lock."""
+
+    def __init__(self):
+        self.histograms: typing.Dict[typing.Tuple[str, str], Histogram] = {}
+        self.lock = threading.Lock()
+
+    def record(self, uri: str, name: str, elapsed: float) -> None:
+        """Adds one latency in seconds."""
+        with self.lock:
+            histogram = self.histograms.get((uri, name))
+            if histogram is None:
+                histogram = self.histograms[(uri, name)] = Histogram()
+            histogram.record(elapsed)
+
+    def call(self, uri: str, name: str, func: typing.Callable, *args, **kwargs):
+        """Calls func once the URI has a call slot free, timing the call."""
+        with RPC_LIMITER.slot(uri):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(uri, name, time.perf_counter() - started)
+
+    @contextlib.contextmanager
+    def span(self, uri: str, name: str) -> typing.Iterator[None]:
+        """Times the block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(uri, name, time.perf_counter() - started)
+
+    def summary(self) -> typing.List[typing.List[str]]:
+        """One line per histogram, the most time consuming first. Times are in
+        milliseconds."""
+        with self.lock:
+            items = list(self.histograms.items())
+        items.sort(key=lambda item: item[1].total, reverse=True)
+        return [
+            [uri or "local", name, str(histogram.count)]
+            + [
+                f"{value * 1000:.3g}"
+                for value in (
+                    histogram.total / histogram.count,
+                    histogram.quantile(0.5),
+                    histogram.quantile(0.9),
+                    histogram.quantile(0.99),
+                    histogram.max,
+                    histogram.total,
+                )
+            ]
+            for (uri, name), histogram in items
+        ]
+
+    def dump(self) -> None:
+        """Writes the histograms to the log."""
+        logging.info("profile: %s", " ".join(PROFILE_HEADERS))
+        for line in self.summary():
+            logging.info("profile: %s", " ".join(line))
+
+
+PROFILER = Profiler()
+PROFILE_HEADERS: typing.Tuple[str, ...] = (
+    "URI",
+    "CALL",
+    "COUNT",
+    "MEAN_MS",
+    "P50_MS",
+    "P90_MS",
+    "P99_MS",
+    "MAX_MS",
+    "TOTAL_MS",
+)
+
+
+# connection methods answered by the client library, without an RPC
+LOCAL_METHODS: typing.FrozenSet[str] = frozenset(
+    (
+        "getURI",
+        "isAlive",
+        "close",
+        "registerCloseCallback",
+        "unregisterCloseCallback",
+    )
+)
+
+
+class ProfiledConnection:  # pylint: disable=too-few-public-methods
+    """Wraps a libvirt connection, timing every RPC by name and holding a call
+    slot of the URI for it. Local methods are passed through, so they never
+    wait behind a hung call."""
+
+    def __init__(self, conn: libvirt.virConnect, uri: str):
+        self.conn = conn
+        self.uri = uri
+        # cleared once the driver turns the bulk stats API down, a reconnect
+        # asks again
+        self.bulk_stats = True
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.conn, name)
+        if not callable(attr) or name in LOCAL_METHODS:
+            return attr
+
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            return PROFILER.call(self.uri, name, attr, *args, **kwargs)
+
+        # only the first lookup of a method goes through __getattr__
+        setattr(self, name, timed)
+        return timed
+
+
+class ConnectionPool:
+    """Keeps one libvirt connection per URI open across refreshes.
+    Dead connections are detected through the close callback and reopened with
+    an exponential backoff. Connections are handed out wrapped in a
+    ProfiledConnection. opener stands in for libvirt.openAuth, e.g. to
+    benchmark against a synthetic connection."""
+
+    def __init__(
+        self,
+        keepalive_interval: int = 5,
+        keepalive_count: int = 3,
+        max_backoff: float = 60.0,
+        opener: typing.Optional[
+            typing.Callable[[str, list, int], libvirt.virConnect]
+        ] = None,
+    ):
+        self.auth = [
+            [libvirt.VIR_CRED_AUTHNAME, libvirt.VIR_CRED_PASSPHRASE],
+            request_cred,
+            None,
+        ]
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.max_backoff = max_backoff
+        self.opener = opener or libvirt.openAuth
+        self.conns: typing.Dict[str, libvirt.virConnect] = {}
+        self.backoff: typing.Dict[str, float] = {}
+        self.retry_at: typing.Dict[str, float] = {}
+        self.uri_locks: typing.Dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+        # called with the URI and the connection on every (re)connect
+        self.on_connect: typing.List[
+            typing.Callable[[str, libvirt.virConnect], None]
+        ] = []
+
+    def get(self, uri: str) -> typing.Optional[libvirt.virConnect]:
+        """Returns a live connection to the URI or None if the URI is
+        unreachable and still backing off."""
+        with self.lock:
+            conn = self.conns.get(uri)
+            if conn is not None:
+                return conn
+            uri_lock = self.uri_locks.setdefault(uri, threading.Lock())
+
+        # connecting can take a while so only hold up the callers of this URI
+        with uri_lock:
+            with self.lock:
+                conn = self.conns.get(uri)
+                if conn is not None:
+                    return conn
+                if time.monotonic() < self.retry_at.get(uri, 0.0):
+                    return None
+            try:
+                with PROFILER.span(uri, "connect"):
+                    conn = ProfiledConnection(self.opener(uri, self.auth, 0), uri)
+            except libvirt.libvirtError as exception:
+                with self.lock:
+                    backoff = min(self.backoff.get(uri, 0.5) * 2, self.max_backoff)
+                    self.backoff[uri] = backoff
+                    self.retry_at[uri] = time.monotonic() + backoff
+                logging.error("connecting to %s failed: %s", uri, exception)
+                return None
+
+            try:
+                conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+            except libvirt.libvirtError:
+                # local drivers do not do keepalives
+                logging.debug("%s does not support keepalives", uri)
+            try:
+                conn.registerCloseCallback(self.on_close, uri)
+            except libvirt.libvirtError:
+                logging.debug("%s does not support close callbacks", uri)
+            for callback in self.on_connect:
+                try:
+                    callback(uri, conn)
+                except Exception as exception:
+                    logging.exception(exception)
+            with self.lock:
+                self.conns[uri] = conn
+                self.backoff.pop(uri, None)
+                self.retry_at.pop(uri, None)
+            logging.info("connected to %s", uri)
+            return conn
+
+    def on_close(self, conn: libvirt.virConnect, reason: int, uri: str) -> None:
+        """Close callback, called from the event loop thread."""
+        logging.warning("connection to %s closed, reason %d", uri, reason)
+        with self.lock:
+            current = self.conns.get(uri)
+            if current is not None and current.conn is conn:
+                del self.conns[uri]
+
+    def invalidate(self, uri: str) -> None:
+        """Drops the connection to the URI if it is no longer alive so that the
+        next get reconnects."""
+        with self.lock:
+            conn = self.conns.get(uri)
+        if conn is None:
+            return
+        try:
+            alive = conn.isAlive()
+        except libvirt.libvirtError:
+            alive = False
+        if not alive:
+            logging.warning("connection to %s is dead", uri)
+            with self.lock:
+                if self.conns.get(uri) is conn:
+                    del self.conns[uri]
+
+    def close(self) -> None:
+        """Closes all the connections."""
+        with self.lock:
+            conns, self.conns = self.conns, {}
+        # outside the lock, a hung URI must not hold up the others
+        for uri, conn in conns.items():
+            try:
+                conn.unregisterCloseCallback()
+            except libvirt.libvirtError:
+                pass
+            try:
+                conn.close()
+            except libvirt.libvirtError as exception:
+                logging.error("closing %s failed: %s", uri, exception)
+
+
 def do_cleanup(stdscr):
     """Return the terminal to a sane state."""
     curses.nocbreak()
@@ -87,6 +456,124 @@ class Argparser:  # pylint: disable=too-few-public-methods
             help="Location of the log file",
             default="~/.virttop.log",
         )
+        self.parser.add_argument(
+            "--timeout",
+            "-t",
+            type=float,
+            help="Seconds to wait for a URI before showing its last data as stale",
+            default=2.0,
+        )
+        self.parser.add_argument(
+            "--threads",
+            type=int,
+            help="Maximum number of URIs to collect from concurrently",
+            default=16,
+        )
+        self.parser.add_argument(
+            "--fleet",
+            type=int,
+            metavar="WORKERS",
+            help="Collect on this many worker processes, for watching many URIs",
+            default=0,
+        )
+        self.parser.add_argument(
+            "--max-inflight",
+            type=int,
+            help="Maximum number of libvirt calls in flight per URI, 0 for no limit",
+            default=4,
+        )
+        self.parser.add_argument(
+            "--delay",
+            "-d",
+            type=float,
+            help="Seconds between two refreshes",
+            default=2.0,
+        )
+        self.parser.add_argument(
+            "--history",
+            type=int,
+            help="Number of samples per domain the rates are averaged over",
+            default=2,
+        )
+        self.parser.add_argument(
+            "--batch",
+            "-b",
+            action="store_true",
+            help="Write the stats to stdout instead of running the TUI",
+            default=False,
+        )
+        self.parser.add_argument(
+            "--format",
+            "-f",
+            choices=("jsonl", "csv"),
+            help="Output format of the batch mode",
+            default="jsonl",
+        )
+        self.parser.add_argument(
+            "--iterations",
+            "-n",
+            type=int,
+            help="Number of refreshes before the batch mode exits, 0 for no limit",
+            default=0,
+        )
+        self.parser.add_argument(
+            "--serve",
+            type=str,
+            metavar="ADDR:PORT",
+            help="Serve the stats as OpenMetrics over HTTP instead of running the TUI",
+            default=None,
+        )
+        self.parser.add_argument(
+            "--daemon",
+            type=str,
+            metavar="SOCKET",
+            help="Serve the stats to the TUIs attached to this Unix socket "
+            "instead of running one",
+            default=None,
+        )
+        self.parser.add_argument(
+            "--attach",
+            type=str,
+            metavar="SOCKET",
+            help="Show the stats of the daemon on this Unix socket instead of "
+            "connecting to libvirt",
+            default=None,
+        )
+        self.parser.add_argument(
+            "--record",
+            type=str,
+            metavar="FILE",
+            help="Append every refresh to a recording",
+            default=None,
+        )
+        self.parser.add_argument(
+            "--replay",
+            type=str,
+            metavar="FILE",
+            help="Play a recording back in the TUI instead of connecting to libvirt",
+            default=None,
+        )
+        self.parser.add_argument(
+            "--cache",
+            type=str,
+            metavar="FILE",
+            help="Where to keep the last snapshot between runs",
+            default=os.path.join(
+                os.environ.get("XDG_CACHE_HOME", "~/.cache"), "virttop", "snapshot.json"
+            ),
+        )
+        self.parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help="Neither show nor keep the last snapshot",
+            default=False,
+        )
+        self.parser.add_argument(
+            "--profile-log",
+            action="store_true",
+            help="Write the latency histograms to the log file on exit",
+            default=False,
+        )
         self.parser.add_argument(
             "--columns",
             type=str,
@@ -97,522 +584,4273 @@ class Argparser:  # pylint: disable=too-few-public-methods
         self.args = self.parser.parse_args()
 
 
+# the raw counters we keep a history of, in the order they are sampled
+METRICS: typing.Tuple[str, ...] = (
+    "cpu_time",
+    "net_rx",
+    "net_tx",
+    "disk_rd",
+    "disk_wr",
+    "disk_reqs",
+)
+
+
+# (uri, uuid) of a domain
+DomainKey = typing.Tuple[str, str]
+
+
+# pylint: disable=too-many-instance-attributes,too-few-public-methods
+class DomainRecord:
+    """The raw values collected for one domain. NaN stands for a value we could
+    not get. Formatting for display is left to the columns so that it only
+    happens for the rows that end up on the screen."""
+
+    __slots__ = (
+        "uri",
+        "uuid",
+        "name",
+        "dom_id",
+        "cpu_time",
+        "mem_actual",
+        "mem_available",
+        "net_rx",
+        "net_tx",
+        "disk_rd",
+        "disk_wr",
+        "mac",
+        "ip",
+        "snapshots",
+        "pool",
+        "rates",
+    )
+
+    def __init__(self, uri: str, uuid: str, name: str, dom_id: int):
+        self.uri = uri
+        self.uuid = uuid
+        self.name = name
+        self.dom_id = dom_id
+        self.cpu_time: float = math.nan
+        self.mem_actual: float = math.nan
+        self.mem_available: float = math.nan
+        self.net_rx: float = math.nan
+        self.net_tx: float = math.nan
+        self.disk_rd: float = math.nan
+        self.disk_wr: float = math.nan
+        self.mac: str = "-"
+        self.ip: str = "-"
+        self.snapshots: int = -1
+        self.pool: str = "N/A"
+        # per second rates of the counters in METRICS
+        self.rates: typing.Tuple[float, ...] = (math.nan,) * len(METRICS)
+
+    @property
+    def key(self) -> DomainKey:
+        """The key of the domain in VirtData."""
+        return (self.uri, self.uuid)
+
+
 @dataclasses.dataclass
-# pylint: disable=too-many-instance-attributes
 class VirtData:
     """Holds the data that we collect to display to the user"""
 
-    vm_id: typing.List[str] = dataclasses.field(default_factory=list)
-    name: typing.List[str] = dataclasses.field(default_factory=list)
-    cpu_times: typing.List[str] = dataclasses.field(default_factory=list)
-    mem_actual: typing.List[str] = dataclasses.field(default_factory=list)
-    mem_unused: typing.List[str] = dataclasses.field(default_factory=list)
-    write_bytes: typing.List[str] = dataclasses.field(default_factory=list)
-    read_bytes: typing.List[str] = dataclasses.field(default_factory=list)
-    macs: typing.List[str] = dataclasses.field(default_factory=list)
-    ips: typing.List[str] = dataclasses.field(default_factory=list)
-    disk_reads: typing.List[str] = dataclasses.field(default_factory=list)
-    disk_writes: typing.List[str] = dataclasses.field(default_factory=list)
-    snapshot_counts: typing.List[str] = dataclasses.field(default_factory=list)
-    uri: typing.List[str] = dataclasses.field(default_factory=list)
-    memory_pool: typing.List[str] = dataclasses.field(default_factory=list)
+    records: typing.Dict[DomainKey, DomainRecord] = dataclasses.field(
+        default_factory=dict
+    )
 
-    pools: typing.List[libvirt.virStoragePool] = dataclasses.field(default_factory=list)
+    def add(self, record: DomainRecord) -> None:
+        """Adds the record of one domain."""
+        self.records[record.key] = record
 
+    def extend(self, other: "VirtData") -> None:
+        """Adds the records of another VirtData to this one."""
+        self.records.update(other.records)
 
-@dataclasses.dataclass
-class ConfigData:
-    """Holds the config data"""
 
-    sasl_user: str = dataclasses.field(default_factory=str)
-    sasl_password: str = dataclasses.field(default_factory=str)
-    color: typing.Dict[str, int] = dataclasses.field(default_factory=dict)
+# metric group -> the stats group getAllDomainStats returns it in, empty for
+# the ones that take a call per domain. Names rather than values so that
+# libvirt is not imported before it is needed.
+METRIC_GROUPS: typing.Dict[str, str] = {
+    "state": "VIR_DOMAIN_STATS_STATE",
+    "cpu": "VIR_DOMAIN_STATS_CPU_TOTAL",
+    "net": "VIR_DOMAIN_STATS_INTERFACE",
+    "block": "VIR_DOMAIN_STATS_BLOCK",
+    "balloon": "VIR_DOMAIN_STATS_BALLOON",
+    "snapshots": "",
+}
+ALL_GROUPS: typing.FrozenSet[str] = frozenset(METRIC_GROUPS)
+# seconds between two fetches of a group, 0 for every refresh. The counters
+# rates are computed from need to be fetched on every refresh.
+REFRESH_INTERVALS: typing.Dict[str, float] = {
+    "state": 0.0,
+    "cpu": 0.0,
+    "net": 0.0,
+    "block": 0.0,
+    "balloon": 10.0,
+    "snapshots": 60.0,
+}
 
 
-def get_network_info(
-    xml_doc: Document,
-) -> typing.Dict[str, str]:
-    """returns the network info"""
-    result_dict = {}
-    interface_types = xml_doc.getElementsByTagName("interface")
-    for interface_type in interface_types:
-        interface_nodes = interface_type.childNodes
-        for interface_node in interface_nodes:
-            if interface_node.nodeName[0:1] != "#":
-                for attr in interface_node.attributes.keys():
-                    result_dict[
-                        interface_node.attributes[attr].name
-                    ] = interface_node.attributes[attr].value
-    return result_dict
-
-
-def get_arp_table() -> typing.Dict[str, str]:
-    """Get the ARP table. return a dict with MAC/IP as key/value pair."""
-    result: typing.Dict[str, str] = {}
-    with open("/proc/net/arp", encoding="utf-8") as arp_table:
-        reader = csv.reader(arp_table, skipinitialspace=True, delimiter=" ")
-        for arp_entry in reader:
-            result[arp_entry[3]] = arp_entry[0]
-
-    return result
-
-
-def get_ip_from_arp_table(arp_table: typing.Dict[str, str], mac: str) -> str:
-    """get IP from MAC address using the arp table"""
-    try:
-        return arp_table[mac]
-    except KeyError:
-        return "N/A"
+def stats_flags(groups: typing.AbstractSet[str]) -> int:
+    """The stats groups to ask for to get the given metric groups."""
+    flags = 0
+    for group in groups:
+        if METRIC_GROUPS[group]:
+            flags |= getattr(libvirt, METRIC_GROUPS[group])
+    return flags
 
 
-def get_disk_info(
-    xml_doc: Document,
-) -> typing.Dict[str, str]:
-    """returns the disk info"""
-    result_dict: typing.Dict = {}
-    disk_types = xml_doc.getElementsByTagName("disk")
-    for disk_type in disk_types:
-        disk_nodes = disk_type.childNodes
-        for disk_node in disk_nodes:
-            if disk_node.nodeName[0:1] != "#":
-                for attr in disk_node.attributes.keys():
-                    result_dict[disk_node.attributes[attr].name] = disk_node.attributes[
-                        attr
-                    ].value
-
-    return result_dict
-
-
-# pylint: disable=too-many-locals
-def ffs(
-    offset: int,
-    header_list: typing.Optional[typing.List[str]],
-    numbered: bool,
-    *args,
-) -> typing.List[str]:
-    """A simple columnar printer"""
-    max_column_width = []
-    lines = []
-    numbers_f: typing.List[int] = []
-    dummy = []
-
-    for arg in args:
-        max_column_width.append(max(len(repr(argette)) for argette in arg))
-
-    if header_list is not None:
-        if numbered:
-            numbers_f.extend(range(1, len(args[-1]) + 1))
-            max_column_width.append(max(len(repr(number)) for number in numbers_f))
-            header_list.insert(0, "idx")
-
-        index = range(0, len(header_list))
-        for header, width, i in zip(header_list, max_column_width, index):
-            max_column_width[i] = max(len(header), width) + offset
-
-        for i in index:
-            dummy.append(header_list[i].ljust(max_column_width[i]))
-        lines.append("".join(dummy))
-        dummy.clear()
-
-    index2 = range(0, len(args[-1]))
-    active_count: int = 1
-    for i in index2:
-        if numbered:
-            if int(args[0][i]) >= 0:
-                active_count += 1
-            dummy.append(repr(i).ljust(max_column_width[0]))
-            for arg, width in zip(args, max_column_width[1:]):
-                if int(args[0][i]) >= 0:
-                    dummy.append((arg[i]).ljust(width))
-                else:
-                    dummy.append((arg[i]).ljust(width))
-        else:
-            for arg, width in zip(args, max_column_width):
-                if int(args[0][i]) >= 0:
-                    dummy.append((arg[i]).ljust(width))
-                else:
-                    dummy.append((arg[i]).ljust(width))
-        lines.append("".join(dummy))
-        dummy.clear()
-    return lines
+class RefreshScheduler:
+    """Decides which metric groups are due on each URI. Groups with an
+    interval of 0 are fetched on every refresh, the others once per interval,
+    stretched by up to max_stretch while the URI answers slower than it
+    usually does. Storage pools and domain topologies are not scheduled here,
+    they are only refetched on libvirt events."""
 
+    def __init__(
+        self,
+        intervals: typing.Optional[typing.Dict[str, float]] = None,
+        max_stretch: float = 8.0,
+    ):
+        self.intervals = dict(REFRESH_INTERVALS if intervals is None else intervals)
+        self.max_stretch = max_stretch
+        # (uri, group) -> when it was last fetched
+        self.fetched: typing.Dict[typing.Tuple[str, str], float] = {}
+        # uri -> moving average and lowest moving average of a collection
+        self.latency: typing.Dict[str, float] = {}
+        self.baseline: typing.Dict[str, float] = {}
+        self.lock = threading.Lock()
 
-def size_abr(num: float, shift_by: float) -> str:
-    """Rounds and abbreviates floats."""
-    num = num * shift_by
-    if num < 1000:
-        return repr(num)
-    if num < 1_000_000.0:
-        return repr(round(num / 1_000, 2)) + " KB"
-    if num < 1_000_000_000:
-        return repr(round(num / 1_000_000, 2)) + " MB"
-    if num < 1_000_000_000_000:
-        return repr(round(num / 1_000_000_000, 2)) + " GB"
-    return "N/A"
+    def stretch(self, uri: str) -> float:
+        """How much longer than usual the URI takes to answer, within limits."""
+        with self.lock:
+            latency = self.latency.get(uri)
+            if latency is None:
+                return 1.0
+            # a few milliseconds more on a fast local URI is no slowdown
+            baseline = max(self.baseline[uri], 0.01)
+        return min(max(latency / baseline, 1.0), self.max_stretch)
 
+    def due(self, uri: str) -> typing.FrozenSet[str]:
+        """The groups to fetch from the URI now."""
+        now = time.monotonic()
+        stretch = self.stretch(uri)
+        with self.lock:
+            return frozenset(
+                group
+                for group, interval in self.intervals.items()
+                if now - self.fetched.get((uri, group), -math.inf) >= interval * stretch
+            )
 
-# pylint: disable=too-many-locals
-def fill_virt_data_uri(
-    conn: libvirt.virConnect,
-    hosts: typing.List[libvirt.virDomain],
-    virt_data: VirtData,
-    arp_table: typing.Dict[str, str],
-    active_only: bool,
-) -> None:
-    """fill VirtData for one URI."""
-    for host in hosts:
-        try:
-            if active_only and host.ID() <= 0:
-                continue
-            virt_data.vm_id.append(repr(host.ID()))
-            virt_data.uri.append(conn.getURI())
-            virt_data.name.append(host.name())
-            dom = conn.lookupByName(host.name())
+    def done(self, uri: str, groups: typing.AbstractSet[str], elapsed: float) -> None:
+        """Records a successful collection of the groups, which took elapsed
+        seconds."""
+        now = time.monotonic()
+        with self.lock:
+            for group in groups:
+                self.fetched[(uri, group)] = now
+            latency = self.latency.get(uri)
+            latency = elapsed if latency is None else 0.7 * latency + 0.3 * elapsed
+            self.latency[uri] = latency
+            self.baseline[uri] = min(self.baseline.get(uri, math.inf), latency)
 
-            virt_data.snapshot_counts.append(repr(dom.snapshotNum()))
-            if host.ID() > 0:
-                try:
-                    virt_data.cpu_times.append(
-                        repr(
-                            int(
-                                dom.getCPUStats(total=True)[0]["cpu_time"]
-                                / 1_000_000_000
-                            )
-                        )
-                        + "s"
-                    )
-                except:
-                    virt_data.cpu_times.append("n/a")
-            else:
-                virt_data.cpu_times.append("-")
 
-            xml_doc = minidom.parseString(dom.XMLDesc())
+class Interface(typing.NamedTuple):
+    """A NIC of a domain."""
 
-            if host.ID() >= 0:
-                mem_stats = dom.memoryStats()
-                if "actual" in mem_stats:
-                    virt_data.mem_actual.append(size_abr(mem_stats["actual"], 1000))
-                else:
-                    virt_data.mem_actual.append("n/a")
+    target: str
+    mac: str
 
-                try:
-                    virt_data.mem_unused.append(size_abr(mem_stats["available"], 1000))
-                except KeyError:
-                    virt_data.mem_unused.append("N/A")
-            else:
-                virt_data.mem_actual.append("-")
-                virt_data.mem_unused.append("-")
-
-            tree = ElementTree.fromstring(dom.XMLDesc())
-            if host.ID() >= 0:
-                iface = tree.find("devices/interface/target").get("dev")
-                stats = dom.interfaceStats(iface)
-                virt_data.write_bytes.append(size_abr(stats[4], 1))
-                virt_data.read_bytes.append(size_abr(stats[0], 1))
-            else:
-                virt_data.write_bytes.append("-")
-                virt_data.read_bytes.append("-")
-
-            found_the_pool: bool = False
-            disk = tree.find("devices/disk/source").get("file")
-            if disk:
-                for pool in virt_data.pools:
-                    if not pool.isActive():
-                        continue
-                    if os.path.basename(disk) in pool.listVolumes():
-                        virt_data.memory_pool.append(pool.name())
-                        found_the_pool = True
-            # you could delete the pool but keep the volumes inside
-            # which results in a functional VM but it wont have a
-            # volume inside a pool that we can detect
-            if not found_the_pool:
-                virt_data.memory_pool.append("N/A")
 
-            try:
-                disk_info = get_disk_info(xml_doc)
-                image_name = disk_info["file"]
-            except Exception as exception:
-                image_name = ""
-                logging.exception(exception)
-            try:
-                if host.ID() >= 0:
-                    _, rd_bytes, _, wr_bytes, _ = dom.blockStats(image_name)
-                    virt_data.disk_reads.append(size_abr(rd_bytes, 1))
-                    virt_data.disk_writes.append(size_abr(wr_bytes, 1))
-
-                    network_info = get_network_info(xml_doc)
-                    virt_data.macs.append(network_info["address"])
-                    # TODO-this is obviously not going to work for remote URIs
-                    virt_data.ips.append(
-                        get_ip_from_arp_table(arp_table, network_info["address"])
-                    )
-                else:
-                    virt_data.disk_reads.append("-")
-                    virt_data.disk_writes.append("-")
-                    virt_data.macs.append("-")
-                    virt_data.ips.append("-")
-            except Exception as exception:
-                virt_data.disk_reads.append("-")
-                virt_data.disk_writes.append("-")
-                virt_data.macs.append("-")
-                virt_data.ips.append("-")
-                logging.exception(exception)
-        except Exception as exception:
-            logging.exception(exception)
+class Disk(typing.NamedTuple):
+    """A disk of a domain. A volume backed disk has the name of its volume as
+    path, and its storage pool."""
 
+    target: str
+    path: str
+    pool: str = ""
 
-def read_config(config_path) -> ConfigData:
-    """read the config"""
-    config_data = ConfigData()
-    try:
-        with open(os.path.expanduser(config_path), "rb") as conf_file:
-            data = tomllib.load(conf_file)
-            for key, value in data.items():
-                match key:
-                    case "sasl_user":
-                        config_data.sasl_user = value
-                    case "sasl_password":
-                        config_data.sasl_password = value
-                    case "color":
-                        for key, value in value.items():
-                            config_data.color[key] = value
-                    case _:
-                        print(f"warning: unknown key, {key}, found.")
-    except FileNotFoundError:
-        pass
 
-    return config_data
+@dataclasses.dataclass(frozen=True)
+class DomainTopology:
+    """The devices of a domain as described by its XML."""
 
+    interfaces: typing.Tuple[Interface, ...]
+    disks: typing.Tuple[Disk, ...]
 
-def curses_init():
-    """Initialize ncurses."""
-    stdscr = curses.initscr()
-    curses.start_color()
-    curses.use_default_colors()
-    curses.curs_set(False)
-    curses.noecho()
-    curses.cbreak()
-    stdscr.keypad(True)
-    curses.halfdelay(4)
-    return stdscr
 
+def get_attr(element, path: str, *attrs: str) -> str:
+    """Returns the first of the attributes that is set on the subelement."""
+    subelement = element.find(path)
+    if subelement is None:
+        return ""
+    for attr in attrs:
+        value = subelement.get(attr)
+        if value:
+            return value
+    return ""
 
-def init_color_pairs(config_data: ConfigData) -> None:
-    """Initialize the curses color pairs."""
-    curses.init_pair(
-        1, config_data.color["name_column_fg"], config_data.color["name_column_bg"]
-    )
-    curses.init_pair(
-        2, config_data.color["active_row_fg"], config_data.color["active_row_bg"]
-    )
-    curses.init_pair(
-        3, config_data.color["inactive_row_fg"], config_data.color["inactive_row_bg"]
+
+def parse_topology(xml_desc: str) -> DomainTopology:
+    """Extracts all the NICs and disks from the domain XML."""
+    tree = ElementTree.fromstring(xml_desc)
+    interfaces = tuple(
+        Interface(get_attr(iface, "target", "dev"), get_attr(iface, "mac", "address"))
+        for iface in tree.iterfind("devices/interface")
     )
-    curses.init_pair(4, config_data.color["box_fg"], config_data.color["box_bg"])
-    curses.init_pair(
-        5, config_data.color["selected_fg"], config_data.color["selected_bg"]
+    # file, block, volume and network backed disks name their source differently
+    disks = tuple(
+        Disk(
+            get_attr(disk, "target", "dev"),
+            get_attr(disk, "source", "file", "dev", "volume", "name"),
+            get_attr(disk, "source", "pool"),
+        )
+        for disk in tree.iterfind("devices/disk")
     )
+    return DomainTopology(interfaces, disks)
 
 
-def get_visible_rows(max_rows: int, sel: int) -> typing.Tuple[int, int]:
-    """Returns the range of columns that will be visible based on max_rows."""
-    win_min_row = sel + 2 - int(max_rows / 2)
-    win_min_row = max(win_min_row, 0)
-    win_max_row = sel + 2 + int(max_rows / 2)
-    win_max_row = max(win_max_row, max_rows)
-    return win_min_row, win_max_row
+class TopologyCache:
+    """Caches the device topology of the domains keyed by UUID so that the XML
+    is only fetched and parsed when it could have changed."""
 
+    def __init__(self):
+        # uuid -> (uri, domain id, topology)
+        self.topologies: typing.Dict[str, typing.Tuple[str, int, DomainTopology]] = {}
+        self.connected: typing.Set[str] = set()
+        self.lock = threading.Lock()
 
-async def start_domain(dom):
-    """Start a domain."""
-    try:
-        task = asyncio.create_task(dom.createWithFlags())
-        await asyncio.sleep(0)
-        return task
-    except Exception as exception:
-        logging.exception(exception)
+    def get(self, uri: str, dom: libvirt.virDomain) -> DomainTopology:
+        """Returns the topology of the domain, fetching its XML on a miss."""
+        uuid = dom.UUIDString()
+        dom_id = dom.ID()
+        with self.lock:
+            entry = self.topologies.get(uuid)
+        # the live XML carries the tap device names which get assigned on start
+        # so a new domain ID means a stale entry even if we missed the event
+        if entry is not None and entry[1] == dom_id:
+            return entry[2]
+        xml_desc = PROFILER.call(uri, "XMLDesc", dom.XMLDesc)
+        with PROFILER.span(uri, "parse XML"):
+            topology = parse_topology(xml_desc)
+        with self.lock:
+            self.topologies[uuid] = (uri, dom_id, topology)
+        return topology
 
+    def invalidate(self, uuid: str) -> None:
+        """Drops the cached topology of a domain."""
+        with self.lock:
+            self.topologies.pop(uuid, None)
 
-async def destroy_domain(dom):
-    """Destroy a domain gracefully."""
-    try:
-        task = asyncio.create_task(
-            dom.destroyFlags(flags=libvirt.VIR_DOMAIN_DESTROY_GRACEFUL)
-        )
-        await asyncio.sleep(0)
-        return task
-    except Exception as exception:
-        logging.exception(exception)
+    def register(self, uri: str, conn: libvirt.virConnect) -> None:
+        """Subscribes to the events that change the topology of the domains on
+        the connection. Called on every (re)connect."""
+        # we might have missed events while we were disconnected. entries
+        # from the startup cache are kept on the first connect, like any other
+        # entry they are dropped once the domain gets a new ID
+        with self.lock:
+            if uri in self.connected:
+                for uuid in [
+                    uuid for uuid, entry in self.topologies.items() if entry[0] == uri
+                ]:
+                    del self.topologies[uuid]
+            self.connected.add(uri)
+        try:
+            conn.domainEventRegisterAny(
+                None,
+                libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self.on_lifecycle,
+                None,
+            )
+            for event_id in (
+                libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+                libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
+            ):
+                conn.domainEventRegisterAny(None, event_id, self.on_device, None)
+        except libvirt.libvirtError as exception:
+            logging.error("%s does not support domain events: %s", uri, exception)
 
+    # pylint: disable=too-many-arguments
+    def on_lifecycle(self, conn, dom, event: int, detail: int, opaque) -> None:
+        """Lifecycle event callback, called from the event loop thread."""
+        if event in (
+            libvirt.VIR_DOMAIN_EVENT_DEFINED,
+            libvirt.VIR_DOMAIN_EVENT_UNDEFINED,
+            libvirt.VIR_DOMAIN_EVENT_STARTED,
+            libvirt.VIR_DOMAIN_EVENT_STOPPED,
+        ):
+            self.invalidate(dom.UUIDString())
 
-async def shutdown_domain(dom):
-    """Shutdown a domain."""
-    try:
-        task = asyncio.create_task(dom.shutdownFlags())
-        await asyncio.sleep(0)
-        return task
-    except Exception as exception:
-        logging.exception(exception)
+    def on_device(self, conn, dom, dev_alias: str, opaque) -> None:
+        """Device added/removed event callback."""
+        self.invalidate(dom.UUIDString())
 
 
-async def main_loop(argparser, stdscr) -> None:
-    """Main TUI loop."""
-    sel: int = 0
-    current_row: int = 0
-    current_visi: int = 0
-    vm_name_ordered_list: typing.List[str] = []
-    task_list: typing.List[asyncio.Task] = []
+class PoolIndex:
+    """Maps the volume paths of every URI to the storage pool holding them.
+    An index is rebuilt when a storage pool event arrives for its URI or when
+    it gets older than max_age seconds, since there are no volume events."""
 
-    sigint_handler = functools.partial(sig_handler_sigint, stdscr=stdscr)
-    signal.signal(signal.SIGINT, sigint_handler)
-    config_data = read_config(argparser.args.config)
-    arp_table = get_arp_table()
-    init_color_pairs(config_data)
-    while True:
-        stdscr.clear()
-        virt_data = VirtData()
-        for hv_host in argparser.args.uri:
-            auth = [
-                [libvirt.VIR_CRED_AUTHNAME, libvirt.VIR_CRED_PASSPHRASE],
-                request_cred,
-                None,
-            ]
-            conn = libvirt.openAuth(hv_host, auth, 0)
-            hosts = conn.listAllDomains()
-            if len(hosts) > 0:
-                virt_data.pools = conn.listAllStoragePools()
-                fill_virt_data_uri(
-                    conn, hosts, virt_data, arp_table, argparser.args.active
-                )
+    def __init__(self, max_age: float = 300.0):
+        self.max_age = max_age
+        # uri -> volume path -> pool name
+        self.indexes: typing.Dict[str, typing.Dict[str, str]] = {}
+        self.built_at: typing.Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, uri: str, conn: libvirt.virConnect, path: str) -> str:
+        """Returns the name of the pool holding the volume at path."""
+        if not path:
+            return "N/A"
+        with self.lock:
+            index = self.indexes.get(uri)
+            if time.monotonic() - self.built_at.get(uri, -math.inf) > self.max_age:
+                index = None
+        if index is None:
+            with PROFILER.span(uri, "pool index"):
+                index = self.build(uri, conn)
+            with self.lock:
+                self.indexes[uri] = index
+                self.built_at[uri] = time.monotonic()
+        # you could delete the pool but keep the volumes inside
+        # which results in a functional VM but it wont have a
+        # volume inside a pool that we can detect
+        return index.get(path, "N/A")
+
+    @staticmethod
+    def build(uri: str, conn: libvirt.virConnect) -> typing.Dict[str, str]:
+        """Lists the volumes of all the active pools of the connection."""
+        index: typing.Dict[str, str] = {}
+        # the connection times its own calls, the pools and volumes it hands
+        # out are raw libvirt objects whose RPCs need a call slot all the same
+        for pool in conn.listAllStoragePools(
+            libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE
+        ):
+            try:
+                name = pool.name()
+                for vol in PROFILER.call(uri, "listAllVolumes", pool.listAllVolumes):
+                    index[PROFILER.call(uri, "path", vol.path)] = name
+            except libvirt.libvirtError as exception:
+                # the pool might have gone away in the meantime
+                logging.error("listing the volumes of a pool failed: %s", exception)
+        return index
+
+    def invalidate(self, uri: str) -> None:
+        """Makes the next lookup on the URI rebuild its index."""
+        with self.lock:
+            self.built_at.pop(uri, None)
+
+    def register(self, uri: str, conn: libvirt.virConnect) -> None:
+        """Subscribes to the storage pool events of the connection. Called on
+        every (re)connect."""
+        self.invalidate(uri)
+        try:
+            conn.storagePoolEventRegisterAny(
+                None,
+                libvirt.VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE,
+                self.on_lifecycle,
+                uri,
+            )
+            conn.storagePoolEventRegisterAny(
+                None, libvirt.VIR_STORAGE_POOL_EVENT_ID_REFRESH, self.on_refresh, uri
+            )
+        except libvirt.libvirtError as exception:
+            logging.error("%s does not support pool events: %s", uri, exception)
+
+    # pylint: disable=too-many-arguments
+    def on_lifecycle(self, conn, pool, event: int, detail: int, uri: str) -> None:
+        """Storage pool lifecycle event callback."""
+        self.invalidate(uri)
+
+    def on_refresh(self, conn, pool, uri: str) -> None:
+        """Storage pool refresh event callback."""
+        self.invalidate(uri)
+
+
+class DomainInventory:
+    """The domains of every URI. Listed once on (re)connect and then kept up to
+    date by lifecycle events so that a refresh only needs to fetch the stats."""
+
+    def __init__(self):
+        # uri -> uuid -> domain
+        self.domains: typing.Dict[str, typing.Dict[str, libvirt.virDomain]] = {}
+        self.lock = threading.Lock()
+        # called without arguments whenever a domain changes state
+        self.listeners: typing.List[typing.Callable[[], None]] = []
+
+    def get(self, uri: str) -> typing.Optional[typing.List[libvirt.virDomain]]:
+        """Returns the domains of the URI or None if the URI is not tracked
+        through events, in which case the caller has to list them itself."""
+        with self.lock:
+            domains = self.domains.get(uri)
+            return None if domains is None else list(domains.values())
+
+    def resync(self, uri: str, conn: libvirt.virConnect) -> None:
+        """Lists all the domains and subscribes to the lifecycle events of the
+        connection. Called on every (re)connect."""
+        with self.lock:
+            self.domains.pop(uri, None)
+        try:
+            conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.on_lifecycle, uri
+            )
+            conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, self.on_reboot, uri
+            )
+        except libvirt.libvirtError as exception:
+            # without events we would never notice new domains so leave the
+            # URI untracked and let the collector list its domains every time
+            logging.error("%s does not support domain events: %s", uri, exception)
+            return
+        domains = {dom.UUIDString(): dom for dom in conn.listAllDomains()}
+        with self.lock:
+            self.domains[uri] = domains
+
+    # pylint: disable=too-many-arguments
+    def on_lifecycle(self, conn, dom, event: int, detail: int, uri: str) -> None:
+        """Lifecycle event callback, called from the event loop thread."""
+        logging.debug("%s: %s lifecycle event %d", uri, dom.name(), event)
+        with self.lock:
+            domains = self.domains.get(uri)
+            if domains is None:
+                return
+            if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                domains.pop(dom.UUIDString(), None)
+            else:
+                # the domain object we get carries the new domain ID
+                domains[dom.UUIDString()] = dom
+        for listener in self.listeners:
+            listener()
+
+    def on_reboot(self, conn, dom, uri: str) -> None:
+        """Reboot event callback."""
+        logging.debug("%s: %s rebooted", uri, dom.name())
+
+
+class DomainHistory:  # pylint: disable=too-few-public-methods
+    """The last samples of the raw counters of one domain. Samples are stored
+    row major in a flat array of doubles, each row being the monotonic
+    timestamp followed by one value per metric."""
+
+    __slots__ = ("samples", "head", "count")
+
+    def __init__(self, history: int, width: int):
+        self.samples = array.array("d", bytes(8 * history * width))
+        self.head: int = 0
+        self.count: int = 0
+
+
+class MetricsStore:
+    """Keeps a fixed number of raw samples per domain and derives the rates
+    over all of them, so a longer history smooths the rates out and the
+    default of 2 gives the rates of the last refresh. Memory use is bounded by
+    the history length and the number of
+    domains seen within the pruning age. Samples have a value per counter in
+    METRICS unless told otherwise."""
+
+    def __init__(self, history: int, metrics: int = len(METRICS)):
+        self.history = max(history, 2)
+        self.width = metrics + 1
+        self.domains: typing.Dict[typing.Tuple[str, str], DomainHistory] = {}
+        self.lock = threading.Lock()
+
+    def record(
+        self,
+        key: typing.Tuple[str, str],
+        timestamp: float,
+        values: typing.Sequence[float],
+    ) -> typing.Tuple[float, ...]:
+        """Appends a sample for the domain and returns its rates over the
+        history."""
+        with self.lock:
+            hist = self.domains.get(key)
+            if hist is None:
+                hist = DomainHistory(self.history, self.width)
+                self.domains[key] = hist
+        row = hist.head * self.width
+        hist.samples[row] = timestamp
+        for i, value in enumerate(values, start=row + 1):
+            hist.samples[i] = value
+        hist.head = (hist.head + 1) % self.history
+        hist.count = min(hist.count + 1, self.history)
+        return self.rates(hist, self.history - 1)
+
+    def rates(self, hist: DomainHistory, span: int = 1) -> typing.Tuple[float, ...]:
+        """Returns the per second rate of every metric over the last span
+        samples, NaN where there is not enough history or a counter reset."""
+        span = min(span, hist.count - 1)
+        if span < 1:
+            return (math.nan,) * (self.width - 1)
+        new = ((hist.head - 1) % self.history) * self.width
+        old = ((hist.head - 1 - span) % self.history) * self.width
+        elapsed = hist.samples[new] - hist.samples[old]
+        if elapsed <= 0:
+            return (math.nan,) * (self.width - 1)
+        rates = []
+        for i in range(1, self.width):
+            delta = hist.samples[new + i] - hist.samples[old + i]
+            # counters start over when a domain restarts
+            rates.append(delta / elapsed if delta >= 0 else math.nan)
+        return tuple(rates)
+
+    def prune(self, max_age: float) -> None:
+        """Forgets the domains that have not been sampled for max_age seconds."""
+        deadline = time.monotonic() - max_age
+        with self.lock:
+            for key in [
+                key
+                for key, hist in self.domains.items()
+                if hist.samples[((hist.head - 1) % self.history) * self.width]
+                < deadline
+            ]:
+                del self.domains[key]
+
+
+VCPU_STATES: typing.Dict[int, str] = {0: "offline", 1: "running", 2: "blocked"}
+
+
+class DeviceDetail(typing.NamedTuple):
+    """The counters of one vCPU, disk, NIC or NUMA node of a domain and their
+    per second rates."""
+
+    name: str
+    info: str
+    values: typing.Tuple[float, ...]
+    rates: typing.Tuple[float, ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class DomainDetail:
+    """The per device stats of one domain. Never mutated once published."""
+
+    key: DomainKey
+    name: str
+    vcpus: typing.Tuple[DeviceDetail, ...] = ()
+    disks: typing.Tuple[DeviceDetail, ...] = ()
+    nics: typing.Tuple[DeviceDetail, ...] = ()
+    nodes: typing.Tuple[DeviceDetail, ...] = ()
+
+
+def parse_cpuset(text: str) -> typing.Set[int]:
+    """Parses a libvirt CPU or node set like 0-3,^2,8."""
+    included: typing.Set[int] = set()
+    excluded: typing.Set[int] = set()
+    for part in filter(None, text.split(",")):
+        target = excluded if part.startswith("^") else included
+        first, _, last = part.lstrip("^").partition("-")
+        target.update(range(int(first), int(last or first) + 1))
+    return included - excluded
+
+
+def parse_cells(capabilities: str) -> typing.Dict[int, int]:
+    """Maps the host CPUs to their NUMA node from the capabilities XML."""
+    tree = ElementTree.fromstring(capabilities)
+    return {
+        int(cpu.get("id")): int(cell.get("id"))
+        for cell in tree.iterfind("host/topology/cells/cell")
+        for cpu in cell.iterfind("cpus/cpu")
+    }
+
+
+class DetailCollector:
+    """Fetches the per vCPU, per disk, per NIC and per NUMA node stats of the
+    one domain the detail pane shows, along with the refreshes of its URI.
+    Nothing is fetched while the pane is closed."""
+
+    def __init__(self, history: int = 2):
+        self.history = history
+        self.key: typing.Optional[DomainKey] = None
+        self.detail: typing.Optional[DomainDetail] = None
+        # vcpu, block and net -> the counters of the devices of the domain
+        self.metrics: typing.Dict[str, MetricsStore] = {}
+        # uri -> host CPU -> NUMA node, the host does not change under us
+        self.cells: typing.Dict[str, typing.Dict[int, int]] = {}
+
+    def watch(self, key: typing.Optional[DomainKey]) -> None:
+        """Starts fetching the detail of a domain, None to stop."""
+        if key == self.key:
+            return
+        self.detail = None
+        self.metrics = {
+            "vcpu": MetricsStore(self.history, 1),
+            "block": MetricsStore(self.history, 3),
+            "net": MetricsStore(self.history, 3),
+        }
+        self.key = key
+
+    def collect(
+        self, uri: str, conn: libvirt.virConnect, topology_cache: TopologyCache
+    ) -> None:
+        """Fetches the detail if the watched domain is on the URI. Runs on the
+        thread collecting the URI."""
+        key = self.key
+        if key is None or key[0] != uri:
+            return
+        metrics = self.metrics
+        try:
+            dom = conn.lookupByUUIDString(key[1])
+            if dom.ID() < 0:
+                self.detail = DomainDetail(key, dom.name())
+                return
+            timestamp = time.monotonic()
+            vcpus = []
+            placement: typing.Dict[int, typing.List[DeviceDetail]] = {}
+            cells = self.host_cells(uri, conn)
+            for number, state, cpu_time, cpu in PROFILER.call(uri, "vcpus", dom.vcpus)[
+                0
+            ]:
+                rates = metrics["vcpu"].record(
+                    (uri, f"{key[1]}/vcpu{number}"), timestamp, (cpu_time,)
+                )
+                info = VCPU_STATES.get(state, "unknown")
+                if cpu >= 0:
+                    info += f" on cpu {cpu}"
+                vcpu = DeviceDetail(str(number), info, (cpu_time,), rates)
+                vcpus.append(vcpu)
+                if cpu in cells:
+                    placement.setdefault(cells[cpu], []).append(vcpu)
+            self.detail = DomainDetail(
+                key,
+                dom.name(),
+                tuple(vcpus),
+                *self.devices(uri, dom, topology_cache.get(uri, dom), metrics),
+                self.nodes(uri, dom, cells, placement),
+            )
+        except libvirt.libvirtError as exception:
+            # e.g. the domain went away while the pane was open
+            logging.error("%s: %s", key[1], exception)
+
+    def host_cells(self, uri: str, conn: libvirt.virConnect) -> typing.Dict[int, int]:
+        """The NUMA node of every host CPU of the URI."""
+        if uri not in self.cells:
+            # the connection times the call and holds the slot for it
+            self.cells[uri] = parse_cells(conn.getCapabilities())
+        return self.cells[uri]
+
+    # pylint: disable=too-many-arguments
+    def devices(
+        self,
+        uri: str,
+        dom: libvirt.virDomain,
+        topology: DomainTopology,
+        metrics: typing.Dict[str, MetricsStore],
+    ) -> typing.Tuple[typing.Tuple[DeviceDetail, ...], typing.Tuple[DeviceDetail, ...]]:
+        """The bytes and requests of every disk and the bytes and packets of
+        every NIC of the domain."""
+        timestamp = time.monotonic()
+        missing = (math.nan,) * 3
+        disks = []
+        for disk in topology.disks:
+            if not disk.path:
+                disks.append(DeviceDetail(disk.target, "empty", missing, missing))
+                continue
+            rd_req, rd_bytes, wr_req, wr_bytes, _ = PROFILER.call(
+                uri, "blockStats", dom.blockStats, disk.target
+            )
+            values = (rd_bytes, wr_bytes, rd_req + wr_req)
+            rates = metrics["block"].record(
+                (uri, f"{dom.UUIDString()}/{disk.target}"), timestamp, values
+            )
+            source = f"{disk.pool}/{disk.path}" if disk.pool else disk.path
+            disks.append(DeviceDetail(disk.target, source, values, rates))
+        nics = []
+        for iface in topology.interfaces:
+            if not iface.target:
+                nics.append(DeviceDetail("-", iface.mac, missing, missing))
+                continue
+            stats = PROFILER.call(
+                uri, "interfaceStats", dom.interfaceStats, iface.target
+            )
+            values = (stats[0], stats[4], stats[1] + stats[5])
+            rates = metrics["net"].record(
+                (uri, f"{dom.UUIDString()}/{iface.target}"), timestamp, values
+            )
+            nics.append(DeviceDetail(iface.target, iface.mac, values, rates))
+        return tuple(disks), tuple(nics)
+
+    def nodes(
+        self,
+        uri: str,
+        dom: libvirt.virDomain,
+        cells: typing.Dict[int, int],
+        placement: typing.Dict[int, typing.List[DeviceDetail]],
+    ) -> typing.Tuple[DeviceDetail, ...]:
+        """The vCPUs running on every host NUMA node and their CPU use, and
+        whether the memory policy of the domain allows the node."""
+        try:
+            nodeset = PROFILER.call(uri, "numaParameters", dom.numaParameters).get(
+                "numa_nodeset", ""
+            )
+        except libvirt.libvirtError:
+            # not every driver has NUMA tuning
+            nodeset = ""
+        allowed = parse_cpuset(nodeset)
+        nodes = []
+        for node in sorted(set(cells.values())):
+            vcpus = placement.get(node, [])
+            rates = [vcpu.rates[0] for vcpu in vcpus if not math.isnan(vcpu.rates[0])]
+            info = "vcpus " + (",".join(vcpu.name for vcpu in vcpus) or "-")
+            if allowed and node not in allowed:
+                info += ", not in nodeset"
+            nodes.append(
+                DeviceDetail(
+                    str(node),
+                    info,
+                    (len(vcpus),),
+                    (sum(rates) if rates or not vcpus else math.nan,),
+                )
+            )
+        return tuple(nodes)
+
+
+# where interfaceAddresses looks for the addresses, in the order asked
+ADDRESS_SOURCES: typing.Tuple[str, ...] = (
+    "VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE",
+    "VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT",
+    "VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP",
+)
+
+
+class AddressResolver:
+    """Resolves the IP addresses of all the NICs of the domains on their
+    hypervisor with interfaceAddresses, asking the DHCP leases, the guest
+    agent and the ARP table in turn until every NIC has an address, each NIC
+    taking the addresses of the first source that knows them. Answers are
+    cached per domain for ttl seconds and refreshed on a thread pool, so
+    looking an address up never waits on libvirt."""
+
+    def __init__(self, ttl: float = 60.0, max_workers: int = 4):
+        self.ttl = ttl
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="resolver"
+        )
+        # key -> (time of the answer, domain id, addresses)
+        self.addresses: typing.Dict[DomainKey, typing.Tuple[float, int, str]] = {}
+        self.pending: typing.Set[DomainKey] = set()
+        # (uri, source) pairs the driver does not support
+        self.unsupported: typing.Set[typing.Tuple[str, str]] = set()
+        self.lock = threading.Lock()
+
+    def lookup(
+        self,
+        uri: str,
+        dom: libvirt.virDomain,
+        key: DomainKey,
+        macs: typing.Sequence[str] = (),
+    ) -> str:
+        """Returns the cached addresses of a running domain, refreshing them in
+        the background once they are older than the TTL or the domain has
+        restarted. macs are those of the NICs of the domain. "-" until the
+        first answer."""
+        dom_id = dom.ID()
+        with self.lock:
+            entry = self.addresses.get(key)
+            expired = (
+                entry is None
+                or entry[1] != dom_id
+                or time.monotonic() - entry[0] > self.ttl
+            )
+            if expired and key not in self.pending:
+                self.pending.add(key)
+                self.executor.submit(self.resolve, uri, dom, key, macs)
+        if entry is None or entry[1] != dom_id:
+            return "-"
+        return entry[2]
+
+    def resolve(
+        self,
+        uri: str,
+        dom: libvirt.virDomain,
+        key: DomainKey,
+        macs: typing.Sequence[str] = (),
+    ) -> None:
+        """Asks the sources in turn until all the NICs with the given MACs
+        have an address, or any NIC if there are none. Runs on the thread
+        pool."""
+        wanted = [mac.lower() for mac in macs if mac]
+        # mac -> the addresses of the NIC
+        found: typing.Dict[str, typing.List[str]] = {}
+        try:
+            for source in ADDRESS_SOURCES:
+                if found and found.keys() >= set(wanted):
+                    break
+                if (uri, source) in self.unsupported:
+                    continue
+                try:
+                    interfaces = PROFILER.call(
+                        uri,
+                        "interfaceAddresses",
+                        dom.interfaceAddresses,
+                        getattr(libvirt, source),
+                    )
+                except libvirt.libvirtError as exception:
+                    # the agent not running is not worth a log line
+                    if exception.get_error_code() == libvirt.VIR_ERR_NO_SUPPORT:
+                        self.unsupported.add((uri, source))
+                    continue
+                for name, interface in interfaces.items():
+                    mac = (interface.get("hwaddr") or name).lower()
+                    addresses = [
+                        address["addr"]
+                        for address in interface.get("addrs") or []
+                        if not ipaddress.ip_address(address["addr"]).is_loopback
+                    ]
+                    if addresses and mac not in found:
+                        found[mac] = addresses
+            # in the order of the NICs of the domain, then the unknown ones
+            addresses = [
+                address
+                for mac in dict.fromkeys([*wanted, *found])
+                for address in found.get(mac, ())
+            ]
+            with self.lock:
+                self.addresses[key] = (
+                    time.monotonic(),
+                    dom.ID(),
+                    ",".join(addresses) or "N/A",
+                )
+        except Exception as exception:
+            logging.exception(exception)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def prune(self, max_age: float) -> None:
+        """Forgets the domains that have not been looked up for max_age
+        seconds."""
+        deadline = time.monotonic() - max_age - self.ttl
+        with self.lock:
+            for key in [
+                key for key, entry in self.addresses.items() if entry[0] < deadline
+            ]:
+                del self.addresses[key]
+
+    def close(self) -> None:
+        """Stops the thread pool without waiting for the pending lookups."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+@dataclasses.dataclass
+class CollectionContext:
+    """The state shared by the collection of all the URIs."""
+
+    active_only: bool
+    resolver: AddressResolver = dataclasses.field(default_factory=AddressResolver)
+    topology_cache: TopologyCache = dataclasses.field(default_factory=TopologyCache)
+    pool_index: PoolIndex = dataclasses.field(default_factory=PoolIndex)
+    metrics: MetricsStore = dataclasses.field(
+        default_factory=functools.partial(MetricsStore, 2)
+    )
+    scheduler: RefreshScheduler = dataclasses.field(default_factory=RefreshScheduler)
+    detail: DetailCollector = dataclasses.field(default_factory=DetailCollector)
+
+
+class HostStatus(typing.NamedTuple):
+    """How the collection of one URI is going."""
+
+    # seconds a collection takes, smoothed, NaN before the first one
+    latency: float
+    # wall clock time of the last successful collection, NaN if none yet
+    updated: float
+
+
+@dataclasses.dataclass
+class HostSnapshot:
+    """The last data successfully collected from one URI."""
+
+    virt_data: VirtData
+    timestamp: float
+    stale: bool = False
+
+
+class HostCollector:
+    """Collects the data of all the URIs concurrently on a bounded thread pool.
+    A URI that misses its deadline keeps its last snapshot, marked as stale."""
+
+    def __init__(
+        self,
+        conn_pool: ConnectionPool,
+        uris: typing.List[str],
+        context: CollectionContext,
+        timeout: float,
+        max_workers: int,
+    ):
+        self.conn_pool = conn_pool
+        self.uris = uris
+        self.context = context
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(uris))),
+            thread_name_prefix="collector",
+        )
+        self.pending: typing.Dict[str, concurrent.futures.Future] = {}
+        self.snapshots: typing.Dict[str, HostSnapshot] = {}
+        self.inventory = DomainInventory()
+        # the lazy loader is not thread safe before python 3.12, so load the
+        # XML parser before the collection threads race for it
+        load_now(ElementTree)
+        conn_pool.on_connect.append(context.topology_cache.register)
+        conn_pool.on_connect.append(context.pool_index.register)
+        conn_pool.on_connect.append(self.inventory.resync)
+
+    def collect_uri(self, uri: str) -> typing.Optional[VirtData]:
+        """Collects the data of one URI, runs on the thread pool."""
+        conn = self.conn_pool.get(uri)
+        if conn is None:
+            return None
+        virt_data = VirtData()
+        due = self.context.scheduler.due(uri)
+        previous = self.snapshots.get(uri)
+        started = time.perf_counter()
+        try:
+            with PROFILER.span(uri, "collect"):
+                fill_virt_data(
+                    conn,
+                    virt_data,
+                    self.context,
+                    self.inventory.get(uri),
+                    due,
+                    None if previous is None else previous.virt_data.records,
+                )
+        except libvirt.libvirtError as exception:
+            logging.exception(exception)
+            self.conn_pool.invalidate(uri)
+            return None
+        self.context.scheduler.done(uri, due, time.perf_counter() - started)
+        self.context.detail.collect(uri, conn, self.context.topology_cache)
+        return virt_data
+
+    def collect(self, wait_first: bool = False) -> VirtData:
+        """Collects all the URIs and returns the merged data. Takes at most as
+        long as the per-URI timeout, unless wait_first has it wait for the
+        first pass of every URI however long it takes."""
+        for uri in self.uris:
+            # a URI that missed the last deadline is still being collected
+            if uri not in self.pending:
+                self.pending[uri] = self.executor.submit(self.collect_uri, uri)
+        concurrent.futures.wait(self.pending.values(), timeout=self.timeout)
+        if wait_first:
+            # a first pass fetches the XML of every domain, it can take longer
+            concurrent.futures.wait(
+                [
+                    future
+                    for uri, future in self.pending.items()
+                    if uri not in self.snapshots
+                ]
+            )
+
+        for uri, future in list(self.pending.items()):
+            if not future.done():
+                logging.warning("%s missed its deadline", uri)
+                self.mark_stale(uri)
+                continue
+            del self.pending[uri]
+            try:
+                virt_data = future.result()
+            except Exception as exception:
+                logging.exception(exception)
+                virt_data = None
+            if virt_data is None:
+                self.mark_stale(uri)
+            else:
+                self.snapshots[uri] = HostSnapshot(virt_data, time.monotonic())
+
+        # keep the history of domains on unreachable URIs for a while
+        self.context.metrics.prune(max(60.0, self.timeout * 10))
+        self.context.resolver.prune(max(60.0, self.timeout * 10))
+        return self.merged()
+
+    def merged(self) -> VirtData:
+        """The last data of all the URIs."""
+        merged = VirtData()
+        for uri in self.uris:
+            if uri in self.snapshots:
+                merged.extend(self.snapshots[uri].virt_data)
+        return merged
+
+    def seed(self, cached: typing.Dict[str, VirtData]) -> None:
+        """Starts from data of an earlier run, stale until the URIs answer."""
+        for uri in self.uris:
+            if uri in cached:
+                self.snapshots[uri] = HostSnapshot(cached[uri], time.monotonic(), True)
+
+    def mark_stale(self, uri: str) -> None:
+        """Marks the last snapshot of a URI as stale."""
+        if uri in self.snapshots:
+            self.snapshots[uri].stale = True
+
+    def is_stale(self, uri: str) -> bool:
+        """Whether the data shown for a URI is from an earlier refresh."""
+        snapshot = self.snapshots.get(uri)
+        return snapshot is not None and snapshot.stale
+
+    def stale_uris(self) -> typing.FrozenSet[str]:
+        """The URIs whose data is from an earlier refresh."""
+        return frozenset(uri for uri in self.uris if self.is_stale(uri))
+
+    def host_status(self) -> typing.Dict[str, HostStatus]:
+        """The collection latency and the time of the last data of every URI."""
+        offset = time.time() - time.monotonic()
+        status = {}
+        for uri in self.uris:
+            snapshot = self.snapshots.get(uri)
+            status[uri] = HostStatus(
+                self.context.scheduler.latency.get(uri, math.nan),
+                math.nan if snapshot is None else snapshot.timestamp + offset,
+            )
+        return status
+
+    def close(self) -> None:
+        """Stops the thread pool without waiting for stragglers."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.context.resolver.close()
+
+
+@dataclasses.dataclass(frozen=True)
+class Snapshot:
+    """The data of one collection pass as published to the UI. Never mutated
+    once published so the UI can read it without any locking."""
+
+    virt_data: VirtData
+    stale_uris: typing.FrozenSet[str]
+    timestamp: float
+    generation: int
+    hosts: typing.Mapping[str, HostStatus] = dataclasses.field(default_factory=dict)
+
+
+class Collector:
+    """Runs the collection on its own thread every delay seconds and publishes
+    the results as immutable snapshots for the UI to pick up."""
+
+    def __init__(self, host_collector: HostCollector, delay: float):
+        self.host_collector = host_collector
+        self.delay = delay
+        self.snapshot: typing.Optional[Snapshot] = None
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="collector", daemon=True)
+        # called on the collector thread with every published snapshot
+        self.on_snapshot: typing.List[typing.Callable[[Snapshot], None]] = []
+        # domains starting or stopping should show up without waiting a full delay
+        host_collector.inventory.listeners.append(self.refresh)
+
+    def start(self) -> None:
+        """Starts the collector thread."""
+        self.thread.start()
+
+    def run(self) -> None:
+        """Collects until stopped."""
+        generation: int = 0
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            # a refresh asked for during the pass makes for another one
+            self.wakeup.clear()
+            try:
+                virt_data = self.host_collector.collect()
+                generation += 1
+                # publishing is a single reference assignment
+                self.snapshot = Snapshot(
+                    virt_data,
+                    self.host_collector.stale_uris(),
+                    time.monotonic(),
+                    generation,
+                    self.host_collector.host_status(),
+                )
+                for hook in self.on_snapshot:
+                    hook(self.snapshot)
+            except Exception as exception:
+                logging.exception(exception)
+            self.wakeup.wait(max(0.0, self.delay - (time.monotonic() - started)))
+
+    def latest(self) -> typing.Optional[Snapshot]:
+        """Returns the latest snapshot, None before the first one is ready."""
+        return self.snapshot
+
+    def publish_cached(self, cached: typing.Dict[str, VirtData]) -> None:
+        """Shows data of an earlier run, marked stale, until the first
+        collection is done. Call before start."""
+        self.host_collector.seed(cached)
+        self.snapshot = Snapshot(
+            self.host_collector.merged(),
+            self.host_collector.stale_uris(),
+            time.monotonic(),
+            0,
+        )
+
+    def refresh(self) -> None:
+        """Makes the collector start its next pass right away."""
+        self.wakeup.set()
+
+    def watch(self, key: typing.Optional[DomainKey]) -> None:
+        """Fetches the detail of a domain on every refresh, None to stop."""
+        self.host_collector.context.detail.watch(key)
+        if key is not None:
+            self.refresh()
+
+    def detail(self, key: DomainKey) -> typing.Optional[DomainDetail]:
+        """The latest detail of the watched domain, None until it is ready."""
+        detail = self.host_collector.context.detail.detail
+        return detail if detail is not None and detail.key == key else None
+
+    def stop(self) -> None:
+        """Stops the collector thread."""
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join(timeout=self.host_collector.timeout + 1)
+        self.host_collector.close()
+
+
+RECORDING_MAGIC: bytes = b"VIRTTOP\x01"
+# time, payload length and flags of a frame
+FRAME_HEADER = struct.Struct("<dIB")
+FRAME_KEYFRAME: int = 1
+# offset, time and offset of the keyframe of a frame, in FILE.idx
+INDEX_ENTRY = struct.Struct("<QdQ")
+RECORDED_STRINGS: typing.Tuple[str, ...] = ("uri", "uuid", "name", "mac", "ip", "pool")
+RECORDED_VALUES: typing.Tuple[str, ...] = (
+    "dom_id",
+    "cpu_time",
+    "mem_actual",
+    "mem_available",
+    "net_rx",
+    "net_tx",
+    "disk_rd",
+    "disk_wr",
+    "snapshots",
+)
+# rates are stored as integers in thousandths
+RATE_SCALE: int = 1000
+
+# the strings and the values, None for NaN, of a record in a frame
+RecordedDomain = typing.Tuple[
+    typing.Tuple[str, ...], typing.Tuple[typing.Optional[int], ...]
+]
+
+
+def write_varint(buf: bytearray, value: int) -> None:
+    """Appends an unsigned LEB128 integer."""
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def read_varint(data, pos: int) -> typing.Tuple[int, int]:
+    """Reads an unsigned LEB128 integer, returns it and the next position."""
+    result: int = 0
+    shift: int = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def write_string(buf: bytearray, value: str) -> None:
+    """Appends a length prefixed UTF-8 string."""
+    encoded = value.encode()
+    write_varint(buf, len(encoded))
+    buf += encoded
+
+
+def read_string(data, pos: int) -> typing.Tuple[str, int]:
+    """Reads a length prefixed UTF-8 string."""
+    length, pos = read_varint(data, pos)
+    return bytes(data[pos : pos + length]).decode(), pos + length
+
+
+def zigzag(value: int) -> int:
+    """Maps signed integers to unsigned ones, small magnitudes staying small."""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value: int) -> int:
+    """Reverses zigzag."""
+    return (value >> 1) ^ -(value & 1)
+
+
+def recorded_values(record: DomainRecord) -> typing.Tuple[typing.Optional[int], ...]:
+    """The numeric columns of a record as integers, None for NaN."""
+    values = [getattr(record, field) for field in RECORDED_VALUES]
+    values.extend(rate * RATE_SCALE for rate in record.rates)
+    return tuple(None if math.isnan(value) else round(value) for value in values)
+
+
+def encode_frame(
+    snapshot: Snapshot,
+    previous: typing.Dict[DomainKey, typing.Tuple[int, RecordedDomain]],
+) -> typing.Tuple[bytes, typing.Dict[DomainKey, typing.Tuple[int, RecordedDomain]]]:
+    """Encodes a snapshot against the domains of the previous frame, by key,
+    and returns the payload and the domains of this frame. Each domain refers
+    to its position in the previous frame and only carries the strings that
+    changed and the zigzag varint deltas of its numeric columns."""
+    buf = bytearray()
+    write_varint(buf, len(snapshot.stale_uris))
+    for uri in sorted(snapshot.stale_uris):
+        write_string(buf, uri)
+    records = snapshot.virt_data.records
+    write_varint(buf, len(records))
+    current: typing.Dict[DomainKey, typing.Tuple[int, RecordedDomain]] = {}
+    no_strings = ("",) * len(RECORDED_STRINGS)
+    no_values = (None,) * (len(RECORDED_VALUES) + len(METRICS))
+    for index, (key, record) in enumerate(records.items()):
+        strings = tuple(getattr(record, field) for field in RECORDED_STRINGS)
+        values = recorded_values(record)
+        ref, (old_strings, old_values) = previous.get(
+            key, (-1, (no_strings, no_values))
+        )
+        write_varint(buf, ref + 1)
+        changed = 0
+        for bit, (new, old) in enumerate(zip(strings, old_strings)):
+            if new != old:
+                changed |= 1 << bit
+        write_varint(buf, changed)
+        for bit, new in enumerate(strings):
+            if changed & (1 << bit):
+                write_string(buf, new)
+        write_varint(
+            buf, sum(1 << bit for bit, value in enumerate(values) if value is None)
+        )
+        for new, old in zip(values, old_values):
+            if new is not None:
+                write_varint(buf, zigzag(new - (old or 0)))
+        current[key] = (index, (strings, values))
+    return bytes(buf), current
+
+
+def decode_frame(
+    data, pos: int, previous: typing.List[RecordedDomain]
+) -> typing.Tuple[typing.FrozenSet[str], typing.List[RecordedDomain]]:
+    """Decodes the payload at pos against the domains of the previous frame."""
+    count, pos = read_varint(data, pos)
+    stale_uris = []
+    for _ in range(count):
+        uri, pos = read_string(data, pos)
+        stale_uris.append(uri)
+    count, pos = read_varint(data, pos)
+    no_strings = ("",) * len(RECORDED_STRINGS)
+    no_values = (None,) * (len(RECORDED_VALUES) + len(METRICS))
+    domains: typing.List[RecordedDomain] = []
+    for _ in range(count):
+        ref, pos = read_varint(data, pos)
+        old_strings, old_values = previous[ref - 1] if ref else (no_strings, no_values)
+        changed, pos = read_varint(data, pos)
+        strings = list(old_strings)
+        for bit in range(len(strings)):
+            if changed & (1 << bit):
+                strings[bit], pos = read_string(data, pos)
+        missing, pos = read_varint(data, pos)
+        values: typing.List[typing.Optional[int]] = []
+        for bit, old in enumerate(old_values):
+            if missing & (1 << bit):
+                values.append(None)
+            else:
+                delta, pos = read_varint(data, pos)
+                values.append((old or 0) + unzigzag(delta))
+        domains.append((tuple(strings), tuple(values)))
+    return frozenset(stale_uris), domains
+
+
+def make_record(domain: RecordedDomain) -> DomainRecord:
+    """Turns a decoded domain back into a record."""
+    strings, values = domain
+    fields = dict(zip(RECORDED_STRINGS, strings))
+    record = DomainRecord(fields["uri"], fields["uuid"], fields["name"], values[0])
+    record.mac, record.ip, record.pool = fields["mac"], fields["ip"], fields["pool"]
+    nan_values = [math.nan if value is None else value for value in values]
+    for field, value in zip(RECORDED_VALUES[1:], nan_values[1:]):
+        setattr(record, field, value)
+    record.rates = tuple(
+        rate / RATE_SCALE for rate in nan_values[len(RECORDED_VALUES) :]
+    )
+    return record
+
+
+class Recorder:
+    """Appends snapshots to a recording. A frame only holds the deltas against
+    the frame before it, except for a keyframe every keyframe_interval frames.
+    FILE.idx gets a fixed size entry per frame so replays can seek without
+    reading the frames."""
+
+    def __init__(self, path: str, keyframe_interval: int = 60):
+        self.recover(path)
+        with contextlib.ExitStack() as stack:
+            self.data = stack.enter_context(open(path, "ab"))
+            self.index = stack.enter_context(open(path + ".idx", "ab"))
+            if self.data.tell() == 0:
+                self.data.write(RECORDING_MAGIC)
+            # the files stay open until close
+            self.files = stack.pop_all()
+        self.keyframe_interval = keyframe_interval
+        self.count: int = 0
+        self.keyframe_offset: int = 0
+        self.previous: typing.Dict[DomainKey, typing.Tuple[int, RecordedDomain]] = {}
+
+    def write(self, snapshot: Snapshot) -> None:
+        """Appends a snapshot."""
+        keyframe = self.count % self.keyframe_interval == 0
+        payload, current = encode_frame(snapshot, {} if keyframe else self.previous)
+        offset = self.data.tell()
+        if keyframe:
+            self.keyframe_offset = offset
+        timestamp = time.time()
+        try:
+            self.data.write(
+                FRAME_HEADER.pack(
+                    timestamp, len(payload), FRAME_KEYFRAME if keyframe else 0
+                )
+            )
+            self.data.write(payload)
+            self.data.flush()
+            self.index.write(INDEX_ENTRY.pack(offset, timestamp, self.keyframe_offset))
+            self.index.flush()
+        except OSError:
+            # the next frame cannot refer to one that may be incomplete
+            self.count = 0
+            raise
+        self.previous = current
+        self.count += 1
+
+    @staticmethod
+    def recover(path: str) -> None:
+        """Cuts a frame a crash left half written off the end of a recording
+        and the index back to the frames that are all there, indexing the ones
+        that are not, so that appending continues a valid recording."""
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        if size < len(RECORDING_MAGIC):
+            with open(path, "rb") as data:
+                if not RECORDING_MAGIC.startswith(data.read()):
+                    raise ValueError(f"{path} is not a virttop recording")
+            # not even the magic made it, start over
+            os.truncate(path, 0)
+            with open(path + ".idx", "ab") as index:
+                index.truncate(0)
+            return
+        replay = Replay(path)
+        try:
+            indexed = replay.indexed
+            unindexed = list(replay.unindexed)
+            end = len(RECORDING_MAGIC)
+            if len(replay):
+                end = replay.frame_end(replay.entry(len(replay) - 1)[0]) or end
+        finally:
+            replay.close()
+        if end < size:
+            logging.warning("cutting a torn frame off the end of %s", path)
+            os.truncate(path, end)
+        with open(path + ".idx", "ab") as index:
+            index.truncate(indexed * INDEX_ENTRY.size)
+            for entry in unindexed:
+                index.write(INDEX_ENTRY.pack(*entry))
+
+    def close(self) -> None:
+        """Closes the recording."""
+        self.files.close()
+
+
+def map_file(path: str) -> typing.Union[mmap.mmap, bytes]:
+    """Maps a file read only, mmap does not take empty files."""
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Replay:
+    """Plays a recording back as snapshots, at the recorded pace times speed.
+    The recording and its index are memory mapped and only the frames between
+    the closest keyframe and the one shown are decoded."""
+
+    def __init__(self, path: str):
+        self.data = map_file(path)
+        if self.data[: len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            raise ValueError(f"{path} is not a virttop recording")
+        try:
+            self.index = map_file(path + ".idx")
+        except FileNotFoundError:
+            self.index = b""
+        self.indexed = len(self.index) // INDEX_ENTRY.size
+        # a crash can leave index entries for frames that were not written
+        while self.indexed and self.frame_end(self.entry(self.indexed - 1)[0]) is None:
+            self.indexed -= 1
+        # and frames without index entries, found by walking the frames
+        self.unindexed: typing.List[typing.Tuple[int, float, int]] = []
+        pos, keyframe_offset = len(RECORDING_MAGIC), 0
+        if self.indexed:
+            pos, _, keyframe_offset = self.entry(self.indexed - 1)
+            pos = self.frame_end(pos)
+        while (end := self.frame_end(pos)) is not None:
+            timestamp, _, flags = FRAME_HEADER.unpack_from(self.data, pos)
+            if flags & FRAME_KEYFRAME:
+                keyframe_offset = pos
+            self.unindexed.append((pos, timestamp, keyframe_offset))
+            pos = end
+
+        self.start: float = self.entry(0)[1] if len(self) else 0.0
+        self.end: float = self.entry(len(self) - 1)[1] if len(self) else 0.0
+        self.speed: float = 1.0
+        self.paused: bool = False
+        self.position: float = self.start
+        self.anchor: float = time.monotonic()
+        # the last decoded frame, what the next one is decoded against
+        self.frame: typing.Optional[int] = None
+        self.domains: typing.List[RecordedDomain] = []
+        self.snapshot: typing.Optional[Snapshot] = None
+
+    def __len__(self) -> int:
+        return self.indexed + len(self.unindexed)
+
+    def entry(self, frame: int) -> typing.Tuple[int, float, int]:
+        """The offset, time and keyframe offset of a frame."""
+        if frame < self.indexed:
+            return INDEX_ENTRY.unpack_from(self.index, frame * INDEX_ENTRY.size)
+        return self.unindexed[frame - self.indexed]
+
+    def frame_end(self, pos: int) -> typing.Optional[int]:
+        """Where the frame at pos ends, None if it is not all there."""
+        if pos + FRAME_HEADER.size > len(self.data):
+            return None
+        _, length, _ = FRAME_HEADER.unpack_from(self.data, pos)
+        end = pos + FRAME_HEADER.size + length
+        return end if end <= len(self.data) else None
+
+    def clock(self) -> float:
+        """The recorded time being played."""
+        if self.paused:
+            return self.position
+        return min(
+            self.position + (time.monotonic() - self.anchor) * self.speed, self.end
+        )
+
+    def seek(self, position: float) -> None:
+        """Moves playback to a recorded time, within the recording."""
+        self.position = min(max(position, self.start), self.end)
+        self.anchor = time.monotonic()
+
+    def latest(self) -> typing.Optional[Snapshot]:
+        """Returns the snapshot recorded at the time being played."""
+        if not len(self):
+            return None
+        clock = self.clock()
+        frame = bisect.bisect_right(
+            range(len(self)), clock, key=lambda frame: self.entry(frame)[1]
+        )
+        return self.decode(max(frame - 1, 0))
+
+    def decode(self, frame: int) -> Snapshot:
+        """Decodes a frame, going forward from the last decoded one when it
+        shares its keyframe."""
+        if frame == self.frame and self.snapshot is not None:
+            return self.snapshot
+        offset, timestamp, keyframe_offset = self.entry(frame)
+        if (
+            self.frame is not None
+            and keyframe_offset <= self.entry(self.frame)[0] < offset
+        ):
+            pos = self.frame_end(self.entry(self.frame)[0])
+        else:
+            pos, self.domains = keyframe_offset, []
+        while True:
+            stale_uris, self.domains = decode_frame(
+                self.data, pos + FRAME_HEADER.size, self.domains
+            )
+            if pos == offset:
+                break
+            pos = self.frame_end(pos)
+        virt_data = VirtData()
+        for domain in self.domains:
+            virt_data.add(make_record(domain))
+        self.frame = frame
+        self.snapshot = Snapshot(virt_data, stale_uris, timestamp, frame)
+        return self.snapshot
+
+    def feed(self, char: int) -> bool:
+        """Handles the playback keys, returns whether char was one."""
+        if char == ord(" "):
+            self.seek(self.clock())
+            self.paused = not self.paused
+        elif char in (ord("["), ord("]")):
+            self.seek(self.clock() + (60.0 if char == ord("]") else -60.0))
+        elif char in (ord("-"), ord("+")):
+            self.seek(self.clock())
+            self.speed = min(
+                max(self.speed * (2 if char == ord("+") else 0.5), 0.125), 64
+            )
+        else:
+            return False
+        return True
+
+    def status(self) -> str:
+        """Describes the playback."""
+        shown = self.clock() if self.snapshot is None else self.snapshot.timestamp
+        status = time.strftime("replay %Y-%m-%d %H:%M:%S", time.localtime(shown))
+        status += f" x{self.speed:g}"
+        if self.paused:
+            status += " paused"
+        return status
+
+    def close(self) -> None:
+        """Unmaps the recording."""
+        for mapped in (self.data, self.index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+
+class SnapshotCache:
+    """Keeps the last snapshot and the topology cache on disk so that the next
+    run can show them, marked stale, before its first collection is done and
+    does not have to fetch the XML of every running domain again. Saves are at
+    most every min_interval seconds, except the last one."""
+
+    def __init__(self, path: str, min_interval: float = 60.0):
+        self.path = os.path.expanduser(path)
+        self.min_interval = min_interval
+        self.saved_at: float = -math.inf
+        # the topologies as loaded, written back when they are not ours to save
+        self.loaded_topologies: typing.Dict[str, list] = {}
+
+    def load(
+        self, uris: typing.List[str]
+    ) -> typing.Tuple[
+        typing.Dict[str, VirtData],
+        typing.Dict[str, typing.Tuple[str, int, DomainTopology]],
+    ]:
+        """Returns the cached data and topologies of the given URIs."""
+        cached: typing.Dict[str, VirtData] = {}
+        topologies: typing.Dict[str, typing.Tuple[str, int, DomainTopology]] = {}
+        try:
+            with open(self.path, "rb") as cache_file:
+                data = json.load(cache_file)
+            if data.get("version") != 1:
+                return cached, topologies
+            self.loaded_topologies = data["topologies"]
+            for strings, values in data["records"]:
+                record = make_record((strings, values))
+                if record.uri in uris:
+                    cached.setdefault(record.uri, VirtData()).add(record)
+            for uuid, (uri, dom_id, interfaces, disks) in data["topologies"].items():
+                # a shut off domain keeps its ID, so an edit made while we were
+                # not running would never be noticed
+                if uri in uris and dom_id >= 0:
+                    topologies[uuid] = (
+                        uri,
+                        dom_id,
+                        DomainTopology(
+                            tuple(Interface(*interface) for interface in interfaces),
+                            tuple(Disk(*disk) for disk in disks),
+                        ),
+                    )
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as exception:
+            logging.warning("ignoring the cache %s: %s", self.path, exception)
+        return cached, topologies
+
+    def save(
+        self,
+        snapshot: typing.Optional[Snapshot],
+        topology_cache: typing.Optional[TopologyCache],
+        force: bool = False,
+    ) -> None:
+        """Writes the snapshot and the topologies, replacing the last ones.
+        Without a topology cache, as in fleet mode where the workers keep
+        theirs, the topologies that were loaded are written back."""
+        if snapshot is None or snapshot.generation == 0:
+            # nothing newer than what was loaded
+            return
+        if not force and time.monotonic() - self.saved_at < self.min_interval:
+            return
+        self.saved_at = time.monotonic()
+        if topology_cache is None:
+            saved_topologies = self.loaded_topologies
+        else:
+            with topology_cache.lock:
+                topologies = dict(topology_cache.topologies)
+            saved_topologies = {
+                uuid: [uri, dom_id, topology.interfaces, topology.disks]
+                for uuid, (uri, dom_id, topology) in topologies.items()
+            }
+        data = {
+            "version": 1,
+            "time": time.time(),
+            "records": [
+                [
+                    [getattr(record, field) for field in RECORDED_STRINGS],
+                    recorded_values(record),
+                ]
+                for record in snapshot.virt_data.records.values()
+            ],
+            "topologies": saved_topologies,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".tmp", "w", encoding="utf-8") as cache_file:
+                json.dump(data, cache_file, separators=(",", ":"))
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as exception:
+            logging.error("writing the cache %s failed: %s", self.path, exception)
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkerSettings:
+    """What a fleet worker needs from the command line."""
+
+    active_only: bool
+    history: int
+    timeout: float
+    threads: int
+    delay: float
+    max_inflight: int
+    logfile: str
+    profile_log: bool
+
+
+def fleet_worker(
+    uris: typing.List[str],
+    settings: WorkerSettings,
+    updates: multiprocessing.connection.Connection,
+    control: multiprocessing.connection.Connection,
+) -> None:
+    """Collects a shard of the URIs in a worker process of the fleet mode and
+    sends every snapshot of it to the UI process as a delta against the one
+    before, until told to stop or the UI process goes away."""
+    init_logging(settings.logfile, "a")
+    # ^C is for the UI process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    RPC_LIMITER.max_inflight = settings.max_inflight
+    start_event_loop()
+    conn_pool = ConnectionPool()
+    context = CollectionContext(
+        settings.active_only, metrics=MetricsStore(settings.history)
+    )
+    collector = Collector(
+        HostCollector(conn_pool, uris, context, settings.timeout, settings.threads),
+        settings.delay,
+    )
+    previous: typing.Dict[DomainKey, typing.Tuple[int, RecordedDomain]] = {}
+
+    def send(snapshot: Snapshot) -> None:
+        nonlocal previous
+        payload, previous = encode_frame(snapshot, previous)
+        updates.send((payload, dict(snapshot.hosts)))
+
+    collector.on_snapshot.append(send)
+    collector.start()
+    try:
+        while control.recv() == "refresh":
+            collector.refresh()
+    except (EOFError, OSError):
+        pass
+    finally:
+        collector.stop()
+        conn_pool.close()
+        if settings.profile_log:
+            PROFILER.dump()
+
+
+class FleetCollector:
+    """Collects the URIs on a pool of worker processes, each owning the
+    connections of its shard of the URIs, to watch hundreds of hypervisors.
+    Workers send the snapshots of their shard as compact deltas and a reader
+    thread merges them into the snapshots the UI reads, published the same way
+    as the ones of Collector."""
+
+    def __init__(self, uris: typing.List[str], workers: int, settings: WorkerSettings):
+        self.uris = uris
+        self.timeout = settings.timeout
+        context = multiprocessing.get_context("spawn")
+        count = max(1, min(workers, len(uris)))
+        self.shards = [uris[i::count] for i in range(count)]
+        self.processes: typing.List[multiprocessing.process.BaseProcess] = []
+        self.updates: typing.List[multiprocessing.connection.Connection] = []
+        self.controls: typing.List[multiprocessing.connection.Connection] = []
+        # the ends the workers hold, closed here once they are started
+        self.worker_ends: typing.List[multiprocessing.connection.Connection] = []
+        for index, shard in enumerate(self.shards):
+            updates, worker_updates = context.Pipe(duplex=False)
+            worker_control, control = context.Pipe(duplex=False)
+            self.processes.append(
+                context.Process(
+                    target=fleet_worker,
+                    args=(shard, settings, worker_updates, worker_control),
+                    name=f"virttop-worker-{index}",
+                    daemon=True,
+                )
+            )
+            self.updates.append(updates)
+            self.controls.append(control)
+            self.worker_ends += [worker_updates, worker_control]
+        # per shard, the domains of its last frame and what they decode to
+        self.domains: typing.List[typing.List[RecordedDomain]] = [
+            [] for _ in self.shards
+        ]
+        self.virt_data: typing.List[VirtData] = [VirtData() for _ in self.shards]
+        self.stale_uris: typing.List[typing.FrozenSet[str]] = [
+            frozenset() for _ in self.shards
+        ]
+        self.hosts: typing.Dict[str, HostStatus] = {}
+        self.snapshot: typing.Optional[Snapshot] = None
+        self.control_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="fleet", daemon=True)
+        # called on the reader thread with every published snapshot
+        self.on_snapshot: typing.List[typing.Callable[[Snapshot], None]] = []
+
+    def start(self) -> None:
+        """Starts the workers and the reader thread."""
+        for process in self.processes:
+            process.start()
+        for end in self.worker_ends:
+            end.close()
+        self.thread.start()
+
+    def run(self) -> None:
+        """Merges the updates of the workers until they are all gone."""
+        generation: int = 0
+        readers = dict(zip(self.updates, range(len(self.shards))))
+        while readers:
+            for reader in multiprocessing.connection.wait(list(readers)):
+                shard = readers[reader]
+                try:
+                    payload, hosts = reader.recv()
+                except (EOFError, OSError):
+                    if not self.stopping.is_set():
+                        logging.error("fleet worker %d is gone", shard)
+                    del readers[reader]
+                    self.stale_uris[shard] = frozenset(self.shards[shard])
+                    continue
+                stale_uris, self.domains[shard] = decode_frame(
+                    payload, 0, self.domains[shard]
+                )
+                virt_data = VirtData()
+                for domain in self.domains[shard]:
+                    virt_data.add(make_record(domain))
+                self.virt_data[shard] = virt_data
+                self.stale_uris[shard] = stale_uris
+                self.hosts.update(hosts)
+            generation += 1
+            self.publish(generation)
+
+    def publish(self, generation: int) -> None:
+        """Merges the shards into a new snapshot."""
+        merged = VirtData()
+        for virt_data in self.virt_data:
+            merged.extend(virt_data)
+        self.snapshot = Snapshot(
+            merged,
+            frozenset().union(*self.stale_uris),
+            time.monotonic(),
+            generation,
+            dict(self.hosts),
+        )
+        for hook in self.on_snapshot:
+            try:
+                hook(self.snapshot)
+            except Exception as exception:
+                logging.exception(exception)
+
+    def latest(self) -> typing.Optional[Snapshot]:
+        """Returns the latest snapshot, None before the first one is ready."""
+        return self.snapshot
+
+    def publish_cached(self, cached: typing.Dict[str, VirtData]) -> None:
+        """Shows data of an earlier run, marked stale, until the workers send
+        theirs. Call before start."""
+        for shard, uris in enumerate(self.shards):
+            for uri in uris:
+                if uri in cached:
+                    self.virt_data[shard].extend(cached[uri])
+            self.stale_uris[shard] = frozenset(uris) & cached.keys()
+        self.publish(0)
+
+    def send(self, message: str) -> None:
+        """Sends a message to all the workers."""
+        with self.control_lock:
+            for control in self.controls:
+                try:
+                    control.send(message)
+                except OSError:
+                    pass
+
+    def refresh(self) -> None:
+        """Makes the workers start their next pass right away."""
+        self.send("refresh")
+
+    def stop(self) -> None:
+        """Stops the workers, killing the ones that do not stop in time."""
+        self.stopping.set()
+        self.send("stop")
+        for process in self.processes:
+            process.join(timeout=self.timeout + 1)
+            if process.is_alive():
+                process.terminate()
+        self.thread.join(timeout=1)
+
+
+# kind and length of a message on the daemon socket
+MESSAGE_HEADER = struct.Struct("<BI")
+# daemon to client: a frame encoded against the last one sent, and the
+# status of the subscribed hosts as JSON, sent before the frame
+MESSAGE_FRAME: int = 1
+MESSAGE_HOSTS: int = 2
+# client to daemon: the columns and hosts to send as JSON, and a refresh
+MESSAGE_SUBSCRIBE: int = 3
+MESSAGE_REFRESH: int = 4
+
+
+def send_message(sock: socket.socket, kind: int, payload: bytes = b"") -> None:
+    """Writes one message to the socket."""
+    sock.sendall(MESSAGE_HEADER.pack(kind, len(payload)) + payload)
+
+
+def recv_message(stream) -> typing.Optional[typing.Tuple[int, bytes]]:
+    """Reads one message from the socket file, None once it is closed."""
+    header = stream.read(MESSAGE_HEADER.size)
+    if len(header) < MESSAGE_HEADER.size:
+        return None
+    kind, length = MESSAGE_HEADER.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return kind, payload
+
+
+class Subscription(typing.NamedTuple):
+    """The record fields and the URIs a client of the daemon wants."""
+
+    fields: typing.FrozenSet[str]
+    uri_filter: typing.Optional[re.Pattern]
+
+    def record(self, record: DomainRecord) -> DomainRecord:
+        """A copy of the record with only the subscribed fields, the others
+        are left unknown and cost a bit per frame."""
+        copy = DomainRecord(record.uri, record.uuid, record.name, record.dom_id)
+        for field in RECORDED_STRINGS[3:] + RECORDED_VALUES[1:]:
+            if field in self.fields:
+                setattr(copy, field, getattr(record, field))
+        copy.rates = tuple(
+            rate if f"{metric}/s" in self.fields else math.nan
+            for metric, rate in zip(METRICS, record.rates)
+        )
+        return copy
+
+    def snapshot(self, snapshot: Snapshot) -> Snapshot:
+        """The part of the snapshot the client subscribed to."""
+        virt_data = VirtData()
+        for record in snapshot.virt_data.records.values():
+            if self.uri_filter is None or self.uri_filter.search(record.uri):
+                virt_data.add(self.record(record))
+        hosts = {
+            uri: status
+            for uri, status in snapshot.hosts.items()
+            if self.uri_filter is None or self.uri_filter.search(uri)
+        }
+        return Snapshot(
+            virt_data,
+            snapshot.stale_uris & (hosts.keys() | virt_data_uris(virt_data)),
+            snapshot.timestamp,
+            snapshot.generation,
+            hosts,
+        )
+
+
+def virt_data_uris(virt_data: VirtData) -> typing.Set[str]:
+    """The URIs that have domains in the data."""
+    return {uri for uri, _ in virt_data.records}
+
+
+# what a client gets before it subscribes
+EVERYTHING = Subscription(
+    frozenset(RECORDED_STRINGS[3:] + RECORDED_VALUES[1:])
+    | frozenset(f"{metric}/s" for metric in METRICS),
+    None,
+)
+
+
+class DaemonClient:
+    """A client attached to the daemon. Frames are encoded and sent on a
+    thread of its own, always from the latest snapshot against the last frame
+    sent, so a slow client skips snapshots instead of holding up the
+    collection or the other clients."""
+
+    def __init__(
+        self, sock: socket.socket, collector, refresh: typing.Callable[[], None]
+    ):
+        self.sock = sock
+        self.collector = collector
+        self.refresh = refresh
+        self.subscription = EVERYTHING
+        self.pending: typing.Optional[Snapshot] = collector.latest()
+        self.closed = False
+        self.condition = threading.Condition()
+        threading.Thread(target=self.send_loop, name="daemon-send", daemon=True).start()
+        threading.Thread(target=self.recv_loop, name="daemon-recv", daemon=True).start()
+
+    def publish(self, snapshot: Snapshot) -> None:
+        """Queues the snapshot, replacing one not sent yet."""
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify()
+
+    def send_loop(self) -> None:
+        """Sends the queued snapshots until the client goes away."""
+        previous: typing.Dict[DomainKey, typing.Tuple[int, RecordedDomain]] = {}
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                snapshot, self.pending = self.pending, None
+                subscription = self.subscription
+            snapshot = subscription.snapshot(snapshot)
+            payload, previous = encode_frame(snapshot, previous)
+            hosts = json.dumps(
+                {uri: list(status) for uri, status in snapshot.hosts.items()}
+            )
+            try:
+                send_message(self.sock, MESSAGE_HOSTS, hosts.encode())
+                send_message(self.sock, MESSAGE_FRAME, payload)
+            except OSError:
+                self.close()
+                return
+
+    def recv_loop(self) -> None:
+        """Takes the subscriptions and refreshes of the client."""
+        with self.sock.makefile("rb") as stream:
+            while (message := recv_message(stream)) is not None:
+                kind, payload = message
+                if kind == MESSAGE_REFRESH:
+                    self.refresh()
+                elif kind == MESSAGE_SUBSCRIBE:
+                    try:
+                        request = json.loads(payload)
+                        fields = frozenset(
+                            field
+                            for column in request["columns"]
+                            for field in COLUMN_FIELDS.get(column, ())
+                        )
+                        uri_filter = compile_filter(request["uris"])
+                    except (ValueError, KeyError, TypeError, re.error) as exception:
+                        logging.error("bad subscription: %s", exception)
+                        continue
+                    with self.condition:
+                        self.subscription = Subscription(fields, uri_filter)
+                        # send the newly subscribed data right away
+                        self.pending = self.pending or self.collector.latest()
+                        self.condition.notify()
+        self.close()
+
+    def close(self) -> None:
+        """Stops sending and closes the socket."""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.sock.close()
+
+
+class SnapshotServer:
+    """Serves the snapshots of one collector to any number of clients on a
+    Unix socket, so that viewers do not each poll the hypervisors. Who can
+    attach is up to the permissions of the socket. The refreshes the clients
+    ask for make for at most one collection every min_refresh_interval
+    seconds, and none while the last one asked for is not published yet."""
+
+    def __init__(self, path: str, collector, min_refresh_interval: float = 1.0):
+        self.path = os.path.expanduser(path)
+        self.collector = collector
+        self.min_refresh_interval = min_refresh_interval
+        self.refresh_pending = False
+        self.refreshed_at: float = -math.inf
+        self.clients: typing.List[DaemonClient] = []
+        self.lock = threading.Lock()
+        try:
+            mode = os.lstat(self.path).st_mode
+        except FileNotFoundError:
+            mode = None
+        # connecting to a regular file is refused too, never delete one
+        if mode is not None and not stat.S_ISSOCK(mode):
+            raise OSError("exists and is not a socket")
+        # a socket left behind by a daemon that did not exit cleanly
+        if mode is not None:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise OSError("in use by another daemon")
+            except ConnectionRefusedError:
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen()
+        collector.on_snapshot.append(self.publish)
+
+    def publish(self, snapshot: Snapshot) -> None:
+        """Hands a new snapshot to the clients, called on the collector
+        thread."""
+        with self.lock:
+            self.refresh_pending = False
+            self.clients = [client for client in self.clients if not client.closed]
+            clients = list(self.clients)
+        for client in clients:
+            client.publish(snapshot)
+
+    def refresh(self) -> None:
+        """Passes a refresh a client asked for on to the collector, unless
+        one was passed on too recently."""
+        with self.lock:
+            now = time.monotonic()
+            if (
+                self.refresh_pending
+                or now - self.refreshed_at < self.min_refresh_interval
+            ):
+                return
+            self.refresh_pending, self.refreshed_at = True, now
+        self.collector.refresh()
+
+    def serve_forever(self) -> None:
+        """Accepts clients until the socket is closed."""
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            logging.info("client attached, %d in total", len(self.clients) + 1)
+            with self.lock:
+                self.clients.append(DaemonClient(sock, self.collector, self.refresh))
+
+    def close(self) -> None:
+        """Closes the socket and drops the clients."""
+        self.sock.close()
+        with contextlib.suppress(OSError):
+            os.unlink(self.path)
+        with self.lock:
+            for client in self.clients:
+                client.close()
+
+
+class AttachedCollector:
+    """Reads the snapshots of a daemon instead of collecting, publishing them
+    the same way as Collector. Only the columns and hosts the TUI shows are
+    subscribed to."""
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.subscription: typing.Optional[typing.Tuple[typing.List[str], str]] = None
+        self.snapshot: typing.Optional[Snapshot] = None
+        self.send_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="attach", daemon=True)
+        # called on the reader thread with every published snapshot
+        self.on_snapshot: typing.List[typing.Callable[[Snapshot], None]] = []
+
+    def start(self) -> None:
+        """Starts reading from the daemon."""
+        self.thread.start()
+
+    def run(self) -> None:
+        """Decodes the frames of the daemon until it goes away."""
+        generation: int = 0
+        domains: typing.List[RecordedDomain] = []
+        hosts: typing.Dict[str, HostStatus] = {}
+        with self.sock.makefile("rb") as stream:
+            while (message := recv_message(stream)) is not None:
+                kind, payload = message
+                if kind == MESSAGE_HOSTS:
+                    hosts = {
+                        uri: HostStatus(*status)
+                        for uri, status in json.loads(payload).items()
+                    }
+                    continue
+                if kind != MESSAGE_FRAME:
+                    continue
+                stale_uris, domains = decode_frame(payload, 0, domains)
+                virt_data = VirtData()
+                for domain in domains:
+                    virt_data.add(make_record(domain))
+                generation += 1
+                self.publish(
+                    Snapshot(virt_data, stale_uris, time.monotonic(), generation, hosts)
+                )
+        logging.error("the daemon on %s went away", self.path)
+        if self.snapshot is not None:
+            # keep showing the last data, all of it stale
+            self.publish(
+                dataclasses.replace(
+                    self.snapshot,
+                    stale_uris=frozenset(
+                        self.snapshot.hosts.keys()
+                        | virt_data_uris(self.snapshot.virt_data)
+                    ),
+                    generation=generation + 1,
+                )
+            )
+
+    def publish(self, snapshot: Snapshot) -> None:
+        """Makes the snapshot the latest one."""
+        self.snapshot = snapshot
+        for hook in self.on_snapshot:
+            try:
+                hook(snapshot)
+            except Exception as exception:
+                logging.exception(exception)
+
+    def latest(self) -> typing.Optional[Snapshot]:
+        """Returns the latest snapshot, None before the first one is ready."""
+        return self.snapshot
+
+    def send(self, kind: int, payload: bytes = b"") -> None:
+        """Sends a message to the daemon, if it is still there."""
+        with self.send_lock:
+            try:
+                send_message(self.sock, kind, payload)
+            except OSError:
+                pass
+
+    def subscribe(self, columns: typing.List[str], uri_filter: str) -> None:
+        """Asks the daemon for the columns of the domains on the matching
+        URIs only, unless that is what was asked for last."""
+        if (columns, uri_filter) != self.subscription:
+            self.subscription = (columns, uri_filter)
+            request = {"columns": columns, "uris": uri_filter}
+            self.send(MESSAGE_SUBSCRIBE, json.dumps(request).encode())
+
+    def refresh(self) -> None:
+        """Asks the daemon to start its next pass right away."""
+        self.send(MESSAGE_REFRESH)
+
+    def stop(self) -> None:
+        """Detaches from the daemon."""
+        with contextlib.suppress(OSError):
+            self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+        self.thread.join(timeout=1)
+
+
+class AlertMetric(typing.NamedTuple):
+    """What a rule can watch. kind decides which units a threshold takes,
+    total is what a threshold in % is a percentage of."""
+
+    columns: typing.Tuple[str, ...]
+    kind: str
+    value: typing.Callable[[DomainRecord], float]
+    total: typing.Optional[typing.Callable[[DomainRecord], float]] = None
+
+
+CPU_METRIC = AlertMetric(("CPU%",), "percent", lambda record: record.rates[0] / 1e7)
+MEM_ACTUAL_METRIC = AlertMetric(
+    ("MEM_ACTUAL",), "bytes", lambda record: record.mem_actual * 1024
+)
+MEM_AVAIL_METRIC = AlertMetric(
+    ("MEM_AVAIL", "MEM_ACTUAL"),
+    "bytes",
+    lambda record: record.mem_available * 1024,
+    lambda record: record.mem_actual * 1024,
+)
+NET_RX_METRIC = AlertMetric(("NET_READ_B/s",), "rate", lambda record: record.rates[1])
+NET_TX_METRIC = AlertMetric(("NET_WRITE_B/s",), "rate", lambda record: record.rates[2])
+DISK_RD_METRIC = AlertMetric(("IO_READ_B/s",), "rate", lambda record: record.rates[3])
+DISK_WR_METRIC = AlertMetric(("IO_WRITE_B/s",), "rate", lambda record: record.rates[4])
+IOPS_METRIC = AlertMetric(("IOPS",), "count", lambda record: record.rates[5])
+
+# the names a rule can use, spaces in them are written as underscores
+ALERT_METRICS: typing.Dict[str, AlertMetric] = {
+    "cpu%": CPU_METRIC,
+    "cpu": CPU_METRIC,
+    "mem_actual": MEM_ACTUAL_METRIC,
+    "mem_avail": MEM_AVAIL_METRIC,
+    "mem_available": MEM_AVAIL_METRIC,
+    "net_rx_rate": NET_RX_METRIC,
+    "net_read_rate": NET_RX_METRIC,
+    "net_tx_rate": NET_TX_METRIC,
+    "net_write_rate": NET_TX_METRIC,
+    "disk_read_rate": DISK_RD_METRIC,
+    "disk_write_rate": DISK_WR_METRIC,
+    "iops": IOPS_METRIC,
+}
+SIZE_UNITS: typing.Dict[str, float] = {
+    "": 1,
+    "b": 1,
+    "kb": 1e3,
+    "mb": 1e6,
+    "gb": 1e9,
+    "tb": 1e12,
+    "kib": 2**10,
+    "mib": 2**20,
+    "gib": 2**30,
+    "tib": 2**40,
+}
+DURATION_UNITS: typing.Dict[str, float] = {"": 1, "s": 1, "m": 60, "h": 3600}
+ALERT_OPERATORS: typing.Dict[str, typing.Callable[[float, float], bool]] = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+ALERT_RULE = re.compile(
+    r"\s*(?P<metric>[a-z_%][a-z_% ]*?)\s*(?P<op>[<>]=?)\s*"
+    r"(?P<threshold>\d+(?:\.\d+)?)\s*(?P<unit>[a-z%]*)(?P<rate>/s)?"
+    r"(?:\s+for\s+(?P<duration>\d+(?:\.\d+)?)\s*(?P<duration_unit>[smh]?))?\s*",
+    re.IGNORECASE,
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class AlertRule:
+    """One threshold on one metric of a domain, that has to hold for duration
+    seconds before the domain counts as firing."""
+
+    text: str
+    metric: AlertMetric
+    compare: typing.Callable[[float, float], bool]
+    threshold: float
+    duration: float
+    percent: bool
+
+    def holds(self, record: DomainRecord) -> bool:
+        """Whether the record is over the threshold. An unknown value never
+        is."""
+        value = self.value(record)
+        return not math.isnan(value) and self.compare(value, self.threshold)
+
+    def value(self, record: DomainRecord) -> float:
+        """The value the threshold applies to, NaN if we do not have it."""
+        value = self.metric.value(record)
+        if self.percent and self.metric.total is not None:
+            total = self.metric.total(record)
+            return value * 100 / total if total > 0 else math.nan
+        return value
+
+
+def parse_alert_rule(text: str) -> AlertRule:
+    """Parses a rule like "cpu% > 90 for 60s", "mem_avail < 5%" or
+    "disk write rate > 500MB/s". Raises ValueError on anything else."""
+    match = ALERT_RULE.fullmatch(text)
+    if match is None:
+        raise ValueError(f"alert rule {text!r}: expected <metric> <op> <threshold>")
+    name = "_".join(match["metric"].lower().split())
+    if name not in ALERT_METRICS:
+        raise ValueError(
+            f"alert rule {text!r}: unknown metric {match['metric']!r}, "
+            f"one of {', '.join(ALERT_METRICS)}"
+        )
+    metric = ALERT_METRICS[name]
+    unit = match["unit"].lower()
+    percent = unit == "%"
+    if metric.kind == "percent":
+        valid, scale = unit in ("", "%") and not match["rate"], 1.0
+    elif percent:
+        valid, scale = metric.total is not None and not match["rate"], 1.0
+    elif metric.kind == "count":
+        valid, scale = not unit, 1.0
+    else:
+        valid = unit in SIZE_UNITS and (metric.kind == "rate" or not match["rate"])
+        scale = SIZE_UNITS.get(unit, 1.0)
+    if not valid:
+        unit_text = match["unit"] + (match["rate"] or "")
+        raise ValueError(f"alert rule {text!r}: {unit_text!r} does not fit {name}")
+    duration = 0.0
+    if match["duration"] is not None:
+        duration = (
+            float(match["duration"]) * DURATION_UNITS[match["duration_unit"].lower()]
+        )
+    return AlertRule(
+        text.strip(),
+        metric,
+        ALERT_OPERATORS[match["op"]],
+        float(match["threshold"]) * scale,
+        duration,
+        percent,
+    )
+
+
+class AlertEvent(typing.NamedTuple):
+    """A domain starting or stopping to fire a rule."""
+
+    rule: AlertRule
+    record: DomainRecord
+    firing: bool
+
+
+class AlertEngine:
+    """Evaluates the alert rules on every new sample. Per rule and domain only
+    the time the condition started to hold is kept, so a sample costs the same
+    no matter how long the history is. Stale hosts are left as they were
+    until they answer again."""
+
+    def __init__(self, rules: typing.Sequence[AlertRule]):
+        self.rules = tuple(rules)
+        self.since: typing.List[typing.Dict[DomainKey, float]] = [
+            {} for _ in self.rules
+        ]
+        self.active: typing.List[typing.Set[DomainKey]] = [set() for _ in self.rules]
+        # read by the UI, replaced rather than mutated
+        self.firing: typing.FrozenSet[DomainKey] = frozenset()
+        self.listeners: typing.List[typing.Callable[[AlertEvent], None]] = []
+        # the columns the rules read, for a subscription to a daemon
+        self.columns: typing.Tuple[str, ...] = tuple(
+            dict.fromkeys(
+                column for rule in self.rules for column in rule.metric.columns
+            )
+        )
+
+    def evaluate(
+        self,
+        virt_data: VirtData,
+        stale_uris: typing.FrozenSet[str],
+        now: typing.Optional[float] = None,
+    ) -> typing.List[AlertEvent]:
+        """Feeds one sample to the rules and returns the domains that started
+        or stopped firing."""
+        now = time.monotonic() if now is None else now
+        events: typing.List[AlertEvent] = []
+        records = virt_data.records
+        for rule, since, active in zip(self.rules, self.since, self.active):
+            for key, record in records.items():
+                if record.uri in stale_uris:
+                    continue
+                if not rule.holds(record):
+                    since.pop(key, None)
+                    if key in active:
+                        active.discard(key)
+                        events.append(AlertEvent(rule, record, False))
+                    continue
+                started = since.setdefault(key, now)
+                if key not in active and now - started >= rule.duration:
+                    active.add(key)
+                    events.append(AlertEvent(rule, record, True))
+            for key in since.keys() - records.keys():
+                del since[key]
+            active.intersection_update(records)
+        self.firing = frozenset().union(*self.active)
+        for event in events:
+            if event.firing:
+                logging.warning(
+                    "alert %r firing for %s on %s",
+                    event.rule.text,
+                    event.record.name,
+                    event.record.uri,
+                )
+            else:
+                logging.info(
+                    "alert %r resolved for %s on %s",
+                    event.rule.text,
+                    event.record.name,
+                    event.record.uri,
+                )
+            for listener in self.listeners:
+                listener(event)
+        return events
+
+    def observe(self, snapshot: Snapshot) -> None:
+        """Evaluates a published snapshot, for Collector.on_snapshot."""
+        self.evaluate(snapshot.virt_data, snapshot.stale_uris)
+
+
+@dataclasses.dataclass
+class ConfigData:
+    """Holds the config data"""
+
+    sasl_user: str = dataclasses.field(default_factory=str)
+    sasl_password: str = dataclasses.field(default_factory=str)
+    color: typing.Dict[str, int] = dataclasses.field(default_factory=dict)
+    alerts: typing.List[AlertRule] = dataclasses.field(default_factory=list)
+
+
+def size_abr(num: float, shift_by: float) -> str:
+    """Rounds and abbreviates floats."""
+    num = num * shift_by
+    if num < 1000:
+        return repr(num)
+    if num < 1_000_000.0:
+        return repr(round(num / 1_000, 2)) + " KB"
+    if num < 1_000_000_000:
+        return repr(round(num / 1_000_000, 2)) + " MB"
+    if num < 1_000_000_000_000:
+        return repr(round(num / 1_000_000_000, 2)) + " GB"
+    return "N/A"
+
+
+def carried_record(
+    record: DomainRecord,
+    previous: typing.Optional[typing.Dict[DomainKey, DomainRecord]],
+) -> typing.Optional[DomainRecord]:
+    """The record of the domain from the last refresh, if it is still the same
+    run of the domain, to carry over the groups that are not due."""
+    last = None if previous is None else previous.get(record.key)
+    return last if last is not None and last.dom_id == record.dom_id else None
+
+
+def fill_virt_data_uri(
+    conn: libvirt.virConnect,
+    hosts: typing.List[libvirt.virDomain],
+    virt_data: VirtData,
+    context: CollectionContext,
+    due: typing.AbstractSet[str] = ALL_GROUPS,
+    previous: typing.Optional[typing.Dict[DomainKey, DomainRecord]] = None,
+) -> None:
+    """fill VirtData for one URI, with a few calls per domain. Only the due
+    groups are fetched, the others are carried over from previous."""
+    uri = conn.getURI()
+    for dom in hosts:
+        try:
+            if context.active_only and dom.ID() <= 0:
+                continue
+            record = DomainRecord(uri, dom.UUIDString(), dom.name(), dom.ID())
+            last = carried_record(record, previous)
+            if "snapshots" in due or last is None:
+                record.snapshots = PROFILER.call(uri, "snapshotNum", dom.snapshotNum)
+            else:
+                record.snapshots = last.snapshots
+            topology = context.topology_cache.get(uri, dom)
+            # an empty drive has no source to read stats from
+            disks = [disk for disk in topology.disks if disk.path]
+            if disks and disks[0].pool:
+                # a volume backed disk names its pool, not its path
+                record.pool = disks[0].pool
+            else:
+                record.pool = context.pool_index.lookup(
+                    uri, conn, disks[0].path if disks else ""
+                )
+
+            if record.dom_id >= 0:
+                try:
+                    record.cpu_time = PROFILER.call(
+                        uri, "getCPUStats", dom.getCPUStats, total=True
+                    )[0]["cpu_time"]
+                except libvirt.libvirtError as exception:
+                    logging.error("%s: %s", record.name, exception)
+
+                if "balloon" in due or last is None:
+                    mem_stats = PROFILER.call(uri, "memoryStats", dom.memoryStats)
+                    record.mem_actual = mem_stats.get("actual", math.nan)
+                    record.mem_available = mem_stats.get("available", math.nan)
+                else:
+                    record.mem_actual = last.mem_actual
+                    record.mem_available = last.mem_available
+
+                interfaces = [iface for iface in topology.interfaces if iface.target]
+                if interfaces:
+                    record.net_rx = record.net_tx = 0
+                for iface in interfaces:
+                    stats = PROFILER.call(
+                        uri, "interfaceStats", dom.interfaceStats, iface.target
+                    )
+                    record.net_rx += stats[0]
+                    record.net_tx += stats[4]
+                if topology.interfaces:
+                    record.mac = topology.interfaces[0].mac
+                record.ip = context.resolver.lookup(
+                    uri,
+                    dom,
+                    record.key,
+                    tuple(iface.mac for iface in topology.interfaces),
+                )
+
+                disk_reqs = math.nan
+                if disks:
+                    record.disk_rd = record.disk_wr = disk_reqs = 0
+                for disk in disks:
+                    rd_req, rd_bytes, wr_req, wr_bytes, _ = PROFILER.call(
+                        uri, "blockStats", dom.blockStats, disk.target
+                    )
+                    record.disk_rd += rd_bytes
+                    record.disk_wr += wr_bytes
+                    disk_reqs += rd_req + wr_req
+
+                record.rates = context.metrics.record(
+                    record.key,
+                    time.monotonic(),
+                    (
+                        record.cpu_time,
+                        record.net_rx,
+                        record.net_tx,
+                        record.disk_rd,
+                        record.disk_wr,
+                        disk_reqs,
+                    ),
+                )
+            virt_data.add(record)
+        except Exception as exception:
+            logging.exception(exception)
+
+
+def device_total(stats: typing.Dict[str, typing.Any], group: str, field: str) -> float:
+    """Sums a per device field of the bulk stats over all the devices of the
+    group, NaN if the domain has none. Devices without the field, like an
+    empty drive, count as zero."""
+    count = stats.get(f"{group}.count", 0)
+    if count == 0:
+        return math.nan
+    return sum(stats.get(f"{group}.{i}.{field}", 0) for i in range(count))
+
+
+def fill_virt_data_uri_bulk(
+    conn: libvirt.virConnect,
+    virt_data: VirtData,
+    context: CollectionContext,
+    domains: typing.Optional[typing.List[libvirt.virDomain]] = None,
+    due: typing.AbstractSet[str] = ALL_GROUPS,
+    previous: typing.Optional[typing.Dict[DomainKey, DomainRecord]] = None,
+) -> int:
+    """fill VirtData for one URI with a single bulk stats call for all the due
+    groups, the others are carried over from previous. If the domains are
+    already known only their stats are fetched, otherwise the driver lists
+    them too. returns the number of domains the driver reported."""
+    wanted = stats_flags(due)
+    if domains is None:
+        flags = (
+            libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE
+            if context.active_only
+            else 0
+        )
+        records = conn.getAllDomainStats(wanted, flags)
+    else:
+        if context.active_only:
+            domains = [dom for dom in domains if dom.ID() > 0]
+        # domains that went away since we last heard of them are skipped
+        records = conn.domainListGetStats(domains, wanted) if domains else []
+    timestamp = time.monotonic()
+    uri = conn.getURI()
+    for dom, stats in records:
+        try:
+            # ID(), name() and UUIDString() are cached on the domain object
+            record = DomainRecord(uri, dom.UUIDString(), dom.name(), dom.ID())
+            if context.active_only and record.dom_id <= 0:
+                continue
+            last = carried_record(record, previous)
+            if "snapshots" in due or last is None:
+                record.snapshots = PROFILER.call(uri, "snapshotNum", dom.snapshotNum)
+            else:
+                record.snapshots = last.snapshots
+            record.pool = context.pool_index.lookup(
+                uri, conn, stats.get("block.0.path", "")
+            )
+
+            if record.dom_id >= 0:
+                record.cpu_time = stats.get("cpu.time", math.nan)
+                if "balloon" in due:
+                    record.mem_actual = stats.get("balloon.current", math.nan)
+                    record.mem_available = stats.get("balloon.available", math.nan)
+                elif last is not None:
+                    record.mem_actual = last.mem_actual
+                    record.mem_available = last.mem_available
+                else:
+                    # new or restarted since balloon was last due, the bulk
+                    # stats did not ask for it
+                    try:
+                        mem_stats = PROFILER.call(uri, "memoryStats", dom.memoryStats)
+                        record.mem_actual = mem_stats.get("actual", math.nan)
+                        record.mem_available = mem_stats.get("available", math.nan)
+                    except libvirt.libvirtError as exception:
+                        logging.error("%s: %s", record.name, exception)
+                record.net_rx = device_total(stats, "net", "rx.bytes")
+                record.net_tx = device_total(stats, "net", "tx.bytes")
+                record.disk_rd = device_total(stats, "block", "rd.bytes")
+                record.disk_wr = device_total(stats, "block", "wr.bytes")
+
+                # the bulk stats do not carry MAC addresses
+                topology = context.topology_cache.get(uri, dom)
+                if topology.interfaces:
+                    record.mac = topology.interfaces[0].mac
+                record.ip = context.resolver.lookup(
+                    uri,
+                    dom,
+                    record.key,
+                    tuple(iface.mac for iface in topology.interfaces),
+                )
+
+                record.rates = context.metrics.record(
+                    record.key,
+                    timestamp,
+                    (
+                        record.cpu_time,
+                        record.net_rx,
+                        record.net_tx,
+                        record.disk_rd,
+                        record.disk_wr,
+                        device_total(stats, "block", "rd.reqs")
+                        + device_total(stats, "block", "wr.reqs"),
+                    ),
+                )
+            virt_data.add(record)
+        except Exception as exception:
+            logging.exception(exception)
+
+    return len(records)
+
+
+def fill_virt_data(
+    conn: libvirt.virConnect,
+    virt_data: VirtData,
+    context: CollectionContext,
+    domains: typing.Optional[typing.List[libvirt.virDomain]] = None,
+    due: typing.AbstractSet[str] = ALL_GROUPS,
+    previous: typing.Optional[typing.Dict[DomainKey, DomainRecord]] = None,
+) -> int:
+    """fill VirtData for one URI using the bulk stats API if the driver
+    supports it, otherwise fall back to querying the domains one by one.
+    domains are listed on the connection unless given. Only the due metric
+    groups are fetched, the others are carried over from the records of the
+    previous refresh. returns the number of domains found on the URI."""
+    # libvirt-python bindings older than the bulk stats API do not have it
+    if getattr(conn, "bulk_stats", True) and hasattr(conn, "getAllDomainStats"):
+        try:
+            return fill_virt_data_uri_bulk(
+                conn, virt_data, context, domains, due, previous
+            )
+        except libvirt.libvirtError as exception:
+            if exception.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+                raise
+            logging.info("%s has no bulk stats support, falling back", conn.getURI())
+            conn.bulk_stats = False
+    hosts = conn.listAllDomains() if domains is None else domains
+    fill_virt_data_uri(conn, hosts, virt_data, context, due, previous)
+    return len(hosts)
+
+
+def read_config(config_path) -> ConfigData:
+    """read the config"""
+    config_data = ConfigData()
+    try:
+        with open(os.path.expanduser(config_path), "rb") as conf_file:
+            data = tomllib.load(conf_file)
+            for key, value in data.items():
+                match key:
+                    case "sasl_user":
+                        config_data.sasl_user = value
+                    case "sasl_password":
+                        config_data.sasl_password = value
+                    case "color":
+                        for key, value in value.items():
+                            config_data.color[key] = value
+                    case "alert":
+                        # [[alert]] tables with a rule each, or plain strings
+                        alerts = value if isinstance(value, list) else [value]
+                        for alert in alerts:
+                            rule = (
+                                alert.get("rule") if isinstance(alert, dict) else alert
+                            )
+                            if not isinstance(rule, str):
+                                raise ValueError(
+                                    f"alert {alert!r}: expected a rule string"
+                                )
+                            config_data.alerts.append(parse_alert_rule(rule))
+                    case _:
+                        print(f"warning: unknown key, {key}, found.")
+    except FileNotFoundError:
+        pass
+
+    return config_data
+
+
+def load_config(argparser) -> ConfigData:
+    """Reads the config, a broken one is a usage error."""
+    try:
+        config_data = read_config(argparser.args.config)
+    except (OSError, tomllib.TOMLDecodeError, ValueError) as exception:
+        argparser.parser.error(f"{argparser.args.config}: {exception}")
+    return config_data
+
+
+def curses_init():
+    """Initialize ncurses."""
+    stdscr = curses.initscr()
+    curses.start_color()
+    curses.use_default_colors()
+    curses.curs_set(False)
+    curses.noecho()
+    curses.cbreak()
+    stdscr.keypad(True)
+    # the UI never waits on libvirt so it can afford a short input timeout
+    stdscr.timeout(100)
+    # escape cancels the filter prompts, do not wait long for a sequence
+    curses.set_escdelay(25)
+    return stdscr
+
+
+def init_color_pairs(config_data: ConfigData) -> None:
+    """Initialize the curses color pairs."""
+    curses.init_pair(
+        1, config_data.color["name_column_fg"], config_data.color["name_column_bg"]
+    )
+    curses.init_pair(
+        2, config_data.color["active_row_fg"], config_data.color["active_row_bg"]
+    )
+    curses.init_pair(
+        3, config_data.color["inactive_row_fg"], config_data.color["inactive_row_bg"]
+    )
+    curses.init_pair(4, config_data.color["box_fg"], config_data.color["box_bg"])
+    curses.init_pair(
+        5, config_data.color["selected_fg"], config_data.color["selected_bg"]
+    )
+    # newer than the rest, older configs do not have it
+    curses.init_pair(
+        6,
+        config_data.color.get("alert_fg", curses.COLOR_WHITE),
+        config_data.color.get("alert_bg", curses.COLOR_RED),
+    )
+
+
+def get_visible_rows(max_rows: int, sel: int) -> typing.Tuple[int, int]:
+    """Returns the range of columns that will be visible based on max_rows."""
+    win_min_row = sel + 2 - int(max_rows / 2)
+    win_min_row = max(win_min_row, 0)
+    win_max_row = sel + 2 + int(max_rows / 2)
+    win_max_row = max(win_max_row, max_rows)
+    return win_min_row, win_max_row
+
+
+def make_collector(
+    argparser, conn_pool: ConnectionPool
+) -> typing.Tuple[
+    typing.Union[Collector, FleetCollector], typing.Optional[TopologyCache]
+]:
+    """Sets up the background collection, on worker processes in fleet mode.
+    Returns the collector and its topology cache, None in fleet mode where
+    the workers keep their own."""
+    if argparser.args.fleet > 0:
+        settings = WorkerSettings(
+            argparser.args.active,
+            argparser.args.history,
+            argparser.args.timeout,
+            argparser.args.threads,
+            argparser.args.delay,
+            argparser.args.max_inflight,
+            argparser.args.logfile,
+            argparser.args.profile_log,
+        )
+        return (
+            FleetCollector(argparser.args.uri, argparser.args.fleet, settings),
+            None,
+        )
+    host_collector = make_host_collector(argparser, conn_pool)
+    return (
+        Collector(host_collector, argparser.args.delay),
+        host_collector.context.topology_cache,
+    )
+
+
+def make_host_collector(argparser, conn_pool: ConnectionPool) -> HostCollector:
+    """Sets up the collection of the URIs given on the command line."""
+    context = CollectionContext(
+        argparser.args.active,
+        metrics=MetricsStore(argparser.args.history),
+    )
+    return HostCollector(
+        conn_pool,
+        argparser.args.uri,
+        context,
+        argparser.args.timeout,
+        argparser.args.threads,
+    )
+
+
+# the fields of the batch mode records, raw values in the units libvirt uses
+BATCH_FIELDS: typing.Tuple[str, ...] = (
+    "time",
+    "uri",
+    "uuid",
+    "name",
+    "id",
+    "stale",
+    "cpu_time_ns",
+    "cpu_percent",
+    "mem_actual_kib",
+    "mem_available_kib",
+    "net_rx_bytes",
+    "net_tx_bytes",
+    "net_rx_bytes_per_s",
+    "net_tx_bytes_per_s",
+    "disk_read_bytes",
+    "disk_write_bytes",
+    "disk_read_bytes_per_s",
+    "disk_write_bytes_per_s",
+    "iops",
+    "mac",
+    "ip",
+    "snapshots",
+    "storage_pool",
+)
+
+
+def batch_values(record: DomainRecord, timestamp: float, stale: bool) -> list:
+    """Returns the values of a record in the order of BATCH_FIELDS, with None
+    for the ones we could not get."""
+    cpu_rate, net_rx_rate, net_tx_rate, disk_rd_rate, disk_wr_rate, iops = record.rates
+    values = [
+        timestamp,
+        record.uri,
+        record.uuid,
+        record.name,
+        record.dom_id,
+        stale,
+        record.cpu_time,
+        cpu_rate / 10_000_000,
+        record.mem_actual,
+        record.mem_available,
+        record.net_rx,
+        record.net_tx,
+        net_rx_rate,
+        net_tx_rate,
+        record.disk_rd,
+        record.disk_wr,
+        disk_rd_rate,
+        disk_wr_rate,
+        iops,
+        record.mac,
+        record.ip,
+        record.snapshots,
+        record.pool,
+    ]
+    return [
+        None if isinstance(value, float) and math.isnan(value) else value
+        for value in values
+    ]
+
+
+class BatchWriter:  # pylint: disable=too-few-public-methods
+    """Writes one line per domain per refresh as JSON Lines or CSV. Nothing is
+    kept between refreshes and the stream is flushed once per refresh."""
+
+    def __init__(self, stream: typing.TextIO, output_format: str):
+        self.stream = stream
+        self.output_format = output_format
+        self.csv_writer = None
+        if output_format == "csv":
+            self.csv_writer = csv.writer(stream, lineterminator="\n")
+            self.csv_writer.writerow(BATCH_FIELDS)
+
+    def write(self, virt_data: VirtData, stale_uris: typing.FrozenSet[str]) -> None:
+        """Writes the records of one refresh."""
+        timestamp = round(time.time(), 3)
+        for record in virt_data.records.values():
+            values = batch_values(record, timestamp, record.uri in stale_uris)
+            if self.csv_writer is not None:
+                self.csv_writer.writerow(
+                    ["" if value is None else value for value in values]
+                )
             else:
-                print("no active VMs found.")
-                time.sleep(3)
+                self.stream.write(
+                    json.dumps(dict(zip(BATCH_FIELDS, values)), separators=(",", ":"))
+                )
+                self.stream.write("\n")
+        self.stream.flush()
+
+    def alert(self, event: AlertEvent) -> None:
+        """Writes a domain starting or stopping to fire an alert. JSON Lines
+        get it inline, CSV keeps its columns and gets it on stderr."""
+        fields = {
+            "time": round(time.time(), 3),
+            "alert": event.rule.text,
+            "state": "firing" if event.firing else "resolved",
+            "uri": event.record.uri,
+            "uuid": event.record.uuid,
+            "name": event.record.name,
+            "value": event.rule.value(event.record),
+        }
+        if math.isnan(fields["value"]):
+            fields["value"] = None
+        if self.csv_writer is not None:
+            print(
+                f"alert {fields['alert']!r} {fields['state']} for "
+                f"{fields['name']} on {fields['uri']}",
+                file=sys.stderr,
+                flush=True,
+            )
+        else:
+            self.stream.write(json.dumps(fields, separators=(",", ":")))
+            self.stream.write("\n")
+
+
+def batch_loop(argparser) -> None:
+    """Writes the stats to stdout every delay seconds instead of running the
+    TUI, for cron jobs and log shippers."""
+    alerts = AlertEngine(load_config(argparser).alerts)
+    start_event_loop()
+    conn_pool = ConnectionPool()
+    host_collector = make_host_collector(argparser, conn_pool)
+    writer = BatchWriter(sys.stdout, argparser.args.format)
+    alerts.listeners.append(writer.alert)
+    iteration: int = 0
+    try:
+        while True:
+            started = time.monotonic()
+            # a line per domain every iteration, none missing its first pass
+            virt_data = host_collector.collect(wait_first=True)
+            stale_uris = frozenset(
+                uri for uri in host_collector.uris if host_collector.is_stale(uri)
+            )
+            alerts.evaluate(virt_data, stale_uris)
+            writer.write(virt_data, stale_uris)
+            iteration += 1
+            if iteration == argparser.args.iterations:
+                break
+            time.sleep(max(0.0, argparser.args.delay - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # the reader went away, keep python from complaining on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        host_collector.close()
+        conn_pool.close()
+
+
+def escape_label(value: str) -> str:
+    """Escapes an OpenMetrics label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# name, type, help and how to get the value, NaN meaning no sample
+EXPORTED_METRICS: typing.Tuple[
+    typing.Tuple[str, str, str, typing.Callable[[DomainRecord], float]], ...
+] = (
+    (
+        "virttop_domain_cpu_seconds",
+        "counter",
+        "CPU time used by the domain.",
+        lambda record: record.cpu_time / 1_000_000_000,
+    ),
+    (
+        "virttop_domain_cpu_percent",
+        "gauge",
+        "CPU usage over the last refresh, 100 being one host CPU.",
+        lambda record: record.rates[0] / 10_000_000,
+    ),
+    (
+        "virttop_domain_memory_actual_bytes",
+        "gauge",
+        "Current balloon size of the domain.",
+        lambda record: record.mem_actual * 1024,
+    ),
+    (
+        "virttop_domain_memory_available_bytes",
+        "gauge",
+        "Memory available to the guest as reported by the balloon driver.",
+        lambda record: record.mem_available * 1024,
+    ),
+    (
+        "virttop_domain_network_receive_bytes",
+        "counter",
+        "Bytes received by the domain.",
+        lambda record: record.net_rx,
+    ),
+    (
+        "virttop_domain_network_transmit_bytes",
+        "counter",
+        "Bytes transmitted by the domain.",
+        lambda record: record.net_tx,
+    ),
+    (
+        "virttop_domain_block_read_bytes",
+        "counter",
+        "Bytes read from the disks of the domain.",
+        lambda record: record.disk_rd,
+    ),
+    (
+        "virttop_domain_block_write_bytes",
+        "counter",
+        "Bytes written to the disks of the domain.",
+        lambda record: record.disk_wr,
+    ),
+    (
+        "virttop_domain_snapshots",
+        "gauge",
+        "Number of snapshots of the domain.",
+        lambda record: math.nan if record.snapshots < 0 else record.snapshots,
+    ),
+)
+
+
+def render_openmetrics(snapshot: typing.Optional[Snapshot]) -> bytes:
+    """Renders a snapshot in the OpenMetrics text format."""
+    lines: typing.List[str] = []
+    records = [] if snapshot is None else list(snapshot.virt_data.records.values())
+    labels = [
+        f'uri="{escape_label(record.uri)}",uuid="{record.uuid}",'
+        f'name="{escape_label(record.name)}"'
+        for record in records
+    ]
+
+    # the family of an info metric has no _info, only its samples do
+    lines.append("# TYPE virttop_domain info")
+    lines.append("# HELP virttop_domain Domain metadata.")
+    for record, label in zip(records, labels):
+        lines.append(
+            f'virttop_domain_info{{{label},mac="{escape_label(record.mac)}",'
+            f'ip="{escape_label(record.ip)}",'
+            f'storage_pool="{escape_label(record.pool)}"}} 1'
+        )
+    lines.append("# TYPE virttop_domain_running gauge")
+    lines.append("# HELP virttop_domain_running Whether the domain is running.")
+    for record, label in zip(records, labels):
+        lines.append(f"virttop_domain_running{{{label}}} {int(record.dom_id >= 0)}")
+
+    for name, metric_type, help_text, getter in EXPORTED_METRICS:
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"# HELP {name} {help_text}")
+        suffix = "_total" if metric_type == "counter" else ""
+        for record, label in zip(records, labels):
+            if record.dom_id < 0:
+                continue
+            value = getter(record)
+            if math.isnan(value):
                 continue
+            if value == int(value):
+                value = int(value)
+            lines.append(f"{name}{suffix}{{{label}}} {value}")
 
-        lines = ffs(
-            2,
-            [
-                "ID",
-                "NAME",
-                "CPU",
-                "MEM_ACTUAL",
-                "MEM_AVAIL",
-                "NET_WRITE_B",
-                "NET_READ_B",
-                "MAC",
-                "IP",
-                "IO_READ_B",
-                "IO_WRITE_B",
-                "SNAPSHOTS",
-                "URI",
-                "STORAGE_POOL",
-            ],
-            False,
-            virt_data.vm_id,
-            virt_data.name,
-            virt_data.cpu_times,
-            virt_data.mem_actual,
-            virt_data.mem_unused,
-            virt_data.write_bytes,
-            virt_data.read_bytes,
-            virt_data.macs,
-            virt_data.ips,
-            virt_data.disk_reads,
-            virt_data.disk_writes,
-            virt_data.snapshot_counts,
-            virt_data.uri,
-            virt_data.memory_pool,
-        )
-        stdscr.attron(curses.color_pair(4))
-        stdscr.box()
-        stdscr.attroff(curses.color_pair(4))
-        stdscr.addstr(1, 1, lines[0], curses.color_pair(1))
-
-        max_rows, _ = stdscr.getmaxyx()
-
-        win_min_row, win_max_row = get_visible_rows(max_rows - 3, sel)
-
-        current_row = 0
-        current_visi = 0
-        active_ids: typing.List[int] = []
-        for count, (line, vm_id, vm_name) in enumerate(
-            zip(lines[1:], virt_data.vm_id, virt_data.name)
-        ):
-            if int(vm_id) >= 0:
-                vm_name_ordered_list.append(vm_name)
-                active_ids.append(count)
-                current_row += 1
-                if current_row > win_max_row or current_row <= win_min_row:
-                    continue
-                if sel == current_row - 1:
-                    stdscr.addstr(current_visi + 2, 1, line, curses.color_pair(5))
+    lines.append("# TYPE virttop_uri_stale gauge")
+    lines.append("# HELP virttop_uri_stale Whether the URI missed its last refresh.")
+    if snapshot is not None:
+        for uri in sorted({record.uri for record in records} | snapshot.stale_uris):
+            stale = int(uri in snapshot.stale_uris)
+            lines.append(f'virttop_uri_stale{{uri="{escape_label(uri)}"}} {stale}')
+    lines.append("# EOF\n")
+    return "\n".join(lines).encode()
+
+
+class MetricsExporter:  # pylint: disable=too-few-public-methods
+    """Renders the latest snapshot of the collector once and serves the same
+    bytes to every scrape until the next snapshot, so scrapes never reach
+    libvirt and concurrent scrapers cost one render per refresh."""
+
+    def __init__(self, collector: Collector):
+        self.collector = collector
+        self.lock = threading.Lock()
+        self.generation: typing.Optional[int] = None
+        self.body: bytes = b""
+
+    def get(self) -> bytes:
+        """Returns the rendered latest snapshot."""
+        snapshot = self.collector.latest()
+        generation = None if snapshot is None else snapshot.generation
+        with self.lock:
+            if generation != self.generation or not self.body:
+                self.body = render_openmetrics(snapshot)
+                self.generation = generation
+            return self.body
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """HTTP server for the exporter, listening on IPv4 or IPv6."""
+
+    def __init__(self, address: typing.Tuple[str, int], exporter: MetricsExporter):
+        self.address_family = socket.AF_INET6 if ":" in address[0] else socket.AF_INET
+        self.exporter = exporter
+        super().__init__(address, MetricsHandler)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Answers scrapes from the exporter of the server."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serves /metrics."""
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.exporter.get()  # type: ignore[attr-defined]
+        self.send_response(200)
+        self.send_header(
+            "Content-Type",
+            "application/openmetrics-text; version=1.0.0; charset=utf-8",
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("%s %s", self.address_string(), format % args)
+
+
+def parse_address(address: str) -> typing.Tuple[str, int]:
+    """Splits ADDR:PORT, ADDR being optional and possibly a bracketed IPv6.
+    Raises ValueError on anything else."""
+    host, separator, port = address.rpartition(":")
+    if not separator or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"expected ADDR:PORT, got {address!r}")
+    return host.strip("[]"), int(port)
+
+
+def serve_loop(argparser) -> None:
+    """Collects in the background and serves the latest snapshot as
+    OpenMetrics instead of running the TUI."""
+    host, port = parse_address(argparser.args.serve)
+    start_event_loop()
+    conn_pool = ConnectionPool()
+    collector, _ = make_collector(argparser, conn_pool)
+    server = MetricsServer((host, port), MetricsExporter(collector))
+    recorder = Recorder(argparser.args.record) if argparser.args.record else None
+    if recorder is not None:
+        collector.on_snapshot.append(recorder.write)
+    collector.start()
+    logging.info("serving metrics on %s", argparser.args.serve)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        collector.stop()
+        conn_pool.close()
+        if recorder is not None:
+            recorder.close()
+
+
+def daemon_loop(argparser) -> None:
+    """Collects in the background and serves the snapshots to the TUIs
+    attached to the socket instead of running one."""
+    alerts = AlertEngine(load_config(argparser).alerts)
+    start_event_loop()
+    conn_pool = ConnectionPool()
+    collector, _ = make_collector(argparser, conn_pool)
+    # the daemon only logs the alerts, attached TUIs evaluate their own
+    collector.on_snapshot.append(alerts.observe)
+    try:
+        server = SnapshotServer(argparser.args.daemon, collector)
+    except OSError as exception:
+        argparser.parser.error(f"{argparser.args.daemon}: {exception}")
+    recorder = Recorder(argparser.args.record) if argparser.args.record else None
+    if recorder is not None:
+        collector.on_snapshot.append(recorder.write)
+    # the server socket is closed on SIGTERM too, which ends serve_forever
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.close())
+    collector.start()
+    logging.info("serving snapshots on %s", server.path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        collector.stop()
+        conn_pool.close()
+        if recorder is not None:
+            recorder.close()
+
+
+def main_loop(
+    argparser,
+    stdscr,
+    config_data: ConfigData,
+    replay: typing.Optional[Replay],
+    attached: typing.Optional[AttachedCollector] = None,
+) -> None:
+    """Main TUI loop."""
+    sigint_handler = functools.partial(sig_handler_sigint, stdscr=stdscr)
+    signal.signal(signal.SIGINT, sigint_handler)
+    init_color_pairs(config_data)
+    if replay is not None:
+        try:
+            tui_loop(stdscr, None, replay, argparser.args.active)
+        finally:
+            replay.close()
+        return
+
+    start_event_loop()
+    conn_pool = ConnectionPool()
+    collector: typing.Union[Collector, FleetCollector, AttachedCollector]
+    topology_cache: typing.Optional[TopologyCache]
+    if attached is not None:
+        # the daemon has the data, actions still go to libvirt directly
+        collector, topology_cache, cache = attached, None, None
+    else:
+        collector, topology_cache = make_collector(argparser, conn_pool)
+        cache = None if argparser.args.no_cache else SnapshotCache(argparser.args.cache)
+    if cache is not None:
+        cached, topologies = cache.load(argparser.args.uri)
+        if topology_cache is not None:
+            topology_cache.topologies.update(topologies)
+        if cached:
+            collector.publish_cached(cached)
+        collector.on_snapshot.append(
+            functools.partial(cache.save, topology_cache=topology_cache)
+        )
+    recorder = Recorder(argparser.args.record) if argparser.args.record else None
+    if recorder is not None:
+        collector.on_snapshot.append(recorder.write)
+    alerts = AlertEngine(config_data.alerts) if config_data.alerts else None
+    if alerts is not None:
+        collector.on_snapshot.append(alerts.observe)
+    executor = ActionExecutor(conn_pool)
+    executor.listeners.append(collector.refresh)
+    collector.start()
+    try:
+        tui_loop(stdscr, executor, collector, argparser.args.active, alerts)
+    finally:
+        executor.close()
+        collector.stop()
+        if cache is not None:
+            cache.save(collector.latest(), topology_cache, force=True)
+        conn_pool.close()
+        if recorder is not None:
+            recorder.close()
+
+
+def start_domain(dom: libvirt.virDomain) -> int:
+    """Starts a domain, or resumes it if it is paused."""
+    state, _ = dom.state()
+    if state == libvirt.VIR_DOMAIN_PAUSED:
+        return dom.resume()
+    return dom.createWithFlags()
+
+
+def shutdown_domain(dom: libvirt.virDomain) -> int:
+    """Asks the guest to shut down."""
+    return dom.shutdownFlags()
+
+
+def destroy_domain(dom: libvirt.virDomain) -> int:
+    """Powers a domain off, gracefully."""
+    return dom.destroyFlags(flags=libvirt.VIR_DOMAIN_DESTROY_GRACEFUL)
+
+
+def reboot_domain(dom: libvirt.virDomain) -> int:
+    """Asks the guest to reboot."""
+    return dom.reboot()
+
+
+def suspend_domain(dom: libvirt.virDomain) -> int:
+    """Pauses a domain."""
+    return dom.suspend()
+
+
+# key -> name and function of the lifecycle actions
+ACTIONS: typing.Dict[
+    int, typing.Tuple[str, typing.Callable[[libvirt.virDomain], int]]
+] = {
+    ord("r"): ("start", start_domain),
+    ord("s"): ("shutdown", shutdown_domain),
+    ord("d"): ("destroy", destroy_domain),
+    ord("b"): ("reboot", reboot_domain),
+    ord("z"): ("suspend", suspend_domain),
+}
+
+
+class ActionExecutor:
+    """Runs lifecycle actions off the UI thread, on a small thread pool per
+    URI so that one slow hypervisor neither blocks the others nor gets more
+    than per_uri actions at once. The status of every action is kept for
+    status_ttl seconds after it finishes."""
+
+    def __init__(
+        self, conn_pool: ConnectionPool, per_uri: int = 4, status_ttl: float = 10.0
+    ):
+        self.conn_pool = conn_pool
+        self.per_uri = per_uri
+        self.status_ttl = status_ttl
+        self.executors: typing.Dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+        # domain -> status text and when the action finished, inf while running
+        self.statuses: typing.Dict[DomainKey, typing.Tuple[str, float]] = {}
+        # bumped on every status change so the UI knows to redraw
+        self.generation: int = 0
+        self.lock = threading.Lock()
+        # called from the worker threads when an action is done
+        self.listeners: typing.List[typing.Callable[[], None]] = []
+
+    def submit(self, key: DomainKey, action: int) -> None:
+        """Queues an action, by key, on a domain."""
+        uri, _ = key
+        with self.lock:
+            if self.statuses.get(key, ("", 0.0))[1] == math.inf:
+                # one action at a time per domain
+                return
+            executor = self.executors.get(uri)
+            if executor is None:
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.per_uri, thread_name_prefix="action"
+                )
+                self.executors[uri] = executor
+        self.set_status(key, ACTIONS[action][0] + " pending", math.inf)
+        executor.submit(self.run, key, action)
+
+    def run(self, key: DomainKey, action: int) -> None:
+        """Runs an action, on the thread pool of the URI."""
+        uri, uuid = key
+        name, func = ACTIONS[action]
+        self.set_status(key, name + " running", math.inf)
+        try:
+            conn = self.conn_pool.get(uri)
+            if conn is None:
+                raise libvirt.libvirtError(f"{uri} is unreachable")
+            dom = conn.lookupByUUIDString(uuid)
+            # the action is an RPC on the raw domain, it takes a call slot too
+            PROFILER.call(uri, name, func, dom)
+        except libvirt.libvirtError as exception:
+            logging.error("%s of %s failed: %s", name, uuid, exception)
+            self.set_status(key, f"{name} failed: {exception}", time.monotonic())
+        else:
+            logging.info("%s of %s done", name, uuid)
+            self.set_status(key, name + " ok", time.monotonic())
+        for listener in self.listeners:
+            listener()
+
+    def set_status(self, key: DomainKey, text: str, finished_at: float) -> None:
+        """Updates the status of the action on a domain."""
+        with self.lock:
+            self.statuses[key] = (text, finished_at)
+            self.generation += 1
+
+    def status(self, key: DomainKey) -> str:
+        """The status of the last action on a domain, empty once expired."""
+        text, finished_at = self.statuses.get(key, ("", 0.0))
+        if time.monotonic() - finished_at > self.status_ttl:
+            return ""
+        return text
+
+    def close(self) -> None:
+        """Drops the queued actions, running ones are left to finish."""
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def format_size(value: float, shift_by: float) -> str:
+    """Formats a byte count."""
+    if math.isnan(value):
+        return "N/A"
+    return size_abr(value, shift_by)
+
+
+def format_rate(rate: float) -> str:
+    """Formats a bytes per second rate."""
+    if math.isnan(rate):
+        return "-"
+    return size_abr(round(rate), 1) + "/s"
+
+
+def format_percent(rate: float) -> str:
+    """Formats a cpu time rate in nanoseconds per second, 100% being one host
+    CPU like top does."""
+    if math.isnan(rate):
+        return "-"
+    return f"{rate / 10_000_000:.1f}%"
+
+
+def format_count(rate: float) -> str:
+    """Formats a per second count."""
+    if math.isnan(rate):
+        return "-"
+    return repr(round(rate))
+
+
+def running(
+    formatter: typing.Callable[[DomainRecord], str]
+) -> typing.Callable[[DomainRecord], str]:
+    """Shows a dash instead of the value for domains that are not running."""
+
+    def format_running(record: DomainRecord) -> str:
+        if record.dom_id < 0:
+            return "-"
+        return formatter(record)
+
+    return format_running
+
+
+class Column(typing.NamedTuple):
+    """A column of the table, with how to format a record for it and the raw
+    value to sort on."""
+
+    header: str
+    format: typing.Callable[[DomainRecord], str]
+    sort: typing.Callable[[DomainRecord], typing.Union[float, str]]
+    descending: bool = False
+
+
+COLUMNS: typing.Tuple[Column, ...] = (
+    Column("ID", lambda record: repr(record.dom_id), lambda record: record.dom_id),
+    Column("NAME", lambda record: record.name, lambda record: record.name),
+    Column(
+        "CPU",
+        running(
+            lambda record: "n/a"
+            if math.isnan(record.cpu_time)
+            else repr(int(record.cpu_time / 1_000_000_000)) + "s"
+        ),
+        lambda record: record.cpu_time,
+        True,
+    ),
+    Column(
+        "CPU%",
+        running(lambda record: format_percent(record.rates[0])),
+        lambda record: record.rates[0],
+        True,
+    ),
+    Column(
+        "MEM_ACTUAL",
+        running(lambda record: format_size(record.mem_actual, 1000)),
+        lambda record: record.mem_actual,
+        True,
+    ),
+    Column(
+        "MEM_AVAIL",
+        running(lambda record: format_size(record.mem_available, 1000)),
+        lambda record: record.mem_available,
+        True,
+    ),
+    Column(
+        "NET_WRITE_B",
+        running(lambda record: format_size(record.net_tx, 1)),
+        lambda record: record.net_tx,
+        True,
+    ),
+    Column(
+        "NET_READ_B",
+        running(lambda record: format_size(record.net_rx, 1)),
+        lambda record: record.net_rx,
+        True,
+    ),
+    Column(
+        "NET_WRITE_B/s",
+        running(lambda record: format_rate(record.rates[2])),
+        lambda record: record.rates[2],
+        True,
+    ),
+    Column(
+        "NET_READ_B/s",
+        running(lambda record: format_rate(record.rates[1])),
+        lambda record: record.rates[1],
+        True,
+    ),
+    Column("MAC", lambda record: record.mac, lambda record: record.mac),
+    Column("IP", lambda record: record.ip, lambda record: record.ip),
+    Column(
+        "IO_READ_B",
+        running(lambda record: format_size(record.disk_rd, 1)),
+        lambda record: record.disk_rd,
+        True,
+    ),
+    Column(
+        "IO_WRITE_B",
+        running(lambda record: format_size(record.disk_wr, 1)),
+        lambda record: record.disk_wr,
+        True,
+    ),
+    Column(
+        "IO_READ_B/s",
+        running(lambda record: format_rate(record.rates[3])),
+        lambda record: record.rates[3],
+        True,
+    ),
+    Column(
+        "IO_WRITE_B/s",
+        running(lambda record: format_rate(record.rates[4])),
+        lambda record: record.rates[4],
+        True,
+    ),
+    Column(
+        "IOPS",
+        running(lambda record: format_count(record.rates[5])),
+        lambda record: record.rates[5],
+        True,
+    ),
+    Column(
+        "SNAPSHOTS",
+        lambda record: repr(record.snapshots),
+        lambda record: record.snapshots,
+        True,
+    ),
+    Column("URI", lambda record: record.uri, lambda record: record.uri),
+    Column("STORAGE_POOL", lambda record: record.pool, lambda record: record.pool),
+)
+
+# the last column, not sortable, shows the lifecycle actions
+ACTION_HEADER: str = "ACTION"
+HEADERS: typing.Tuple[str, ...] = tuple(column.header for column in COLUMNS)
+URI_COLUMN: int = HEADERS.index("URI")
+# the record fields, or the rates of the METRICS as "metric/s", each column
+# shows. The key of a domain, its name and its ID always come along.
+COLUMN_FIELDS: typing.Dict[str, typing.Tuple[str, ...]] = {
+    "ID": (),
+    "NAME": (),
+    "CPU": ("cpu_time",),
+    "CPU%": ("cpu_time/s",),
+    "MEM_ACTUAL": ("mem_actual",),
+    "MEM_AVAIL": ("mem_available",),
+    "NET_WRITE_B": ("net_tx",),
+    "NET_READ_B": ("net_rx",),
+    "NET_WRITE_B/s": ("net_tx/s",),
+    "NET_READ_B/s": ("net_rx/s",),
+    "MAC": ("mac",),
+    "IP": ("ip",),
+    "IO_READ_B": ("disk_rd",),
+    "IO_WRITE_B": ("disk_wr",),
+    "IO_READ_B/s": ("disk_rd/s",),
+    "IO_WRITE_B/s": ("disk_wr/s",),
+    "IOPS": ("disk_reqs/s",),
+    "SNAPSHOTS": ("snapshots",),
+    "URI": (),
+    "STORAGE_POOL": ("pool",),
+}
+
+
+def get_row(
+    record: DomainRecord, stale_uris: typing.FrozenSet[str]
+) -> typing.List[str]:
+    """Formats the cells of one row, in the order of COLUMNS."""
+    cells = [column.format(record) for column in COLUMNS]
+    if record.uri in stale_uris:
+        cells[URI_COLUMN] += " (stale)"
+    return cells
+
+
+# the sections of the detail pane, the first one's headers are the pane's
+DETAIL_HEADERS: typing.Dict[str, typing.Tuple[str, ...]] = {
+    "vcpus": ("VCPU", "STATE", "TIME", "", "CPU%", "", ""),
+    "disks": ("DISK", "SOURCE", "READ_B", "WRITE_B", "READ_B/s", "WRITE_B/s", "IOPS"),
+    "nics": ("NIC", "MAC", "RX_B", "TX_B", "RX_B/s", "TX_B/s", "PACKETS/s"),
+    "nodes": ("NODE", "VCPUS", "", "", "CPU%", "", ""),
+}
+
+
+def get_detail_rows(
+    detail: typing.Optional[DomainDetail],
+) -> typing.List[typing.Tuple[typing.List[str], int]]:
+    """Formats the detail pane, each section under its own headers."""
+    rows: typing.List[typing.Tuple[typing.List[str], int]] = []
+    if detail is None:
+        return rows
+    for section, headers in DETAIL_HEADERS.items():
+        devices: typing.Tuple[DeviceDetail, ...] = getattr(detail, section)
+        if not devices:
+            continue
+        if rows:
+            rows.append(([""] * len(headers), curses.color_pair(2)))
+            rows.append((list(headers), curses.color_pair(1)))
+        for device in devices:
+            if section == "vcpus":
+                cells = [
+                    device.name,
+                    device.info,
+                    repr(int(device.values[0] / 1_000_000_000)) + "s",
+                    "",
+                    format_percent(device.rates[0]),
+                    "",
+                    "",
+                ]
+            elif section == "nodes":
+                cells = [device.name, device.info, "", ""]
+                cells += [format_percent(device.rates[0]), "", ""]
+            else:
+                cells = [
+                    device.name,
+                    device.info,
+                    format_size(device.values[0], 1),
+                    format_size(device.values[1], 1),
+                    format_rate(device.rates[0]),
+                    format_rate(device.rates[1]),
+                    format_count(device.rates[2]),
+                ]
+            rows.append((cells, curses.color_pair(2)))
+    return rows
+
+
+# the columns of the domains the per host summary adds up
+HOST_COLUMNS: typing.Tuple[str, ...] = (
+    "CPU%",
+    "MEM_ACTUAL",
+    "NET_WRITE_B/s",
+    "NET_READ_B/s",
+    "IO_READ_B/s",
+    "IO_WRITE_B/s",
+    "IOPS",
+)
+HOST_HEADERS: typing.Tuple[str, ...] = (
+    "URI",
+    "DOMAINS",
+    "RUNNING",
+    "CPU%",
+    "MEM_ACTUAL",
+    "NET_B/s",
+    "IO_B/s",
+    "IOPS",
+    "LATENCY_MS",
+    "UPDATED",
+)
+
+
+def nansum(values: typing.Iterable[float]) -> float:
+    """Sums the values that are not NaN, NaN if all of them are."""
+    total = math.nan
+    for value in values:
+        if not math.isnan(value):
+            total = value if math.isnan(total) else total + value
+    return total
+
+
+def get_host_rows(
+    snapshot: typing.Optional[Snapshot],
+) -> typing.List[typing.Tuple[str, typing.List[str]]]:
+    """The URI and the cells of the summary of every host, by URI."""
+    if snapshot is None:
+        return []
+    by_uri: typing.Dict[str, typing.List[DomainRecord]] = {
+        uri: [] for uri in snapshot.hosts
+    }
+    for record in snapshot.virt_data.records.values():
+        by_uri.setdefault(record.uri, []).append(record)
+    now = time.time()
+    rows = []
+    for uri, records in sorted(by_uri.items()):
+        status = snapshot.hosts.get(uri, HostStatus(math.nan, math.nan))
+        latency = "-" if math.isnan(status.latency) else f"{status.latency * 1000:.0f}"
+        updated = (
+            "never"
+            if math.isnan(status.updated)
+            else f"{now - status.updated:.0f}s ago"
+        )
+        if uri in snapshot.stale_uris:
+            updated += " (stale)"
+        rows.append(
+            (
+                uri,
+                [
+                    uri,
+                    repr(len(records)),
+                    repr(sum(record.dom_id >= 0 for record in records)),
+                    format_percent(nansum(record.rates[0] for record in records)),
+                    format_size(nansum(record.mem_actual for record in records), 1000),
+                    format_rate(
+                        nansum(record.rates[1] + record.rates[2] for record in records)
+                    ),
+                    format_rate(
+                        nansum(record.rates[3] + record.rates[4] for record in records)
+                    ),
+                    format_count(nansum(record.rates[5] for record in records)),
+                    latency,
+                    updated,
+                ],
+            )
+        )
+    return rows
+
+
+class Descending:  # pylint: disable=too-few-public-methods
+    """Wraps a string so that it sorts in reverse."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: str):
+        self.value = value
+
+    def __lt__(self, other: "Descending") -> bool:
+        return other.value < self.value
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Descending) and other.value == self.value
+
+    def __hash__(self) -> int:
+        return hash(self.value)
+
+
+class SortedView:
+    """The records of the latest snapshot that pass the filters, in display
+    order. On a new snapshot only the records whose sort key changed are moved
+    with a binary search, the whole list is only sorted again when the sort
+    column or the filters change or when most of the keys moved anyway."""
+
+    def __init__(self, active_only: bool):
+        self.active_only = active_only
+        # None keeps the default order, active domains first
+        self.column: typing.Optional[int] = None
+        self.descending: bool = False
+        self.name_filter: typing.Optional[re.Pattern] = None
+        self.uri_filter: typing.Optional[re.Pattern] = None
+        self.records: typing.Dict[DomainKey, DomainRecord] = {}
+        # sorted (sort key, domain key) of the records that pass the filters
+        self.entries: typing.List[typing.Tuple[tuple, DomainKey]] = []
+        self.sort_keys: typing.Dict[DomainKey, tuple] = {}
+        # the order in which the domains were first seen breaks ties
+        self.seen: typing.Dict[DomainKey, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, index: int) -> DomainRecord:
+        return self.records[self.entries[index][1]]
+
+    def index(self, key: typing.Optional[DomainKey]) -> typing.Optional[int]:
+        """Returns the position of the domain or None if it is not shown."""
+        sort_key = self.sort_keys.get(key)  # type: ignore
+        if sort_key is None:
+            return None
+        return bisect.bisect_left(self.entries, (sort_key, key))
+
+    def matches(self, record: DomainRecord) -> bool:
+        """Whether the record passes the filters."""
+        if self.active_only and record.dom_id < 0:
+            return False
+        if self.name_filter is not None and not self.name_filter.search(record.name):
+            return False
+        if self.uri_filter is not None and not self.uri_filter.search(record.uri):
+            return False
+        return True
+
+    def sort_key(self, record: DomainRecord) -> tuple:
+        """Returns the key of the record for the current sort column."""
+        seen = self.seen.setdefault(record.key, len(self.seen))
+        if self.column is None:
+            return (record.dom_id < 0, seen)
+        value = COLUMNS[self.column].sort(record)
+        if isinstance(value, str):
+            return (False, Descending(value) if self.descending else value, seen)
+        # NaNs compare false to everything so they get their own group, last
+        if math.isnan(value):
+            return (True, 0.0, seen)
+        return (False, -value if self.descending else value, seen)
+
+    def update(self, records: typing.Dict[DomainKey, DomainRecord]) -> None:
+        """Moves to the records of a new snapshot."""
+        changed: typing.List[typing.Tuple[DomainKey, typing.Optional[tuple]]] = []
+        for key in self.sort_keys.keys() - records.keys():
+            changed.append((key, None))
+        for key, record in records.items():
+            sort_key = self.sort_key(record) if self.matches(record) else None
+            if sort_key != self.sort_keys.get(key):
+                changed.append((key, sort_key))
+        self.records = records
+        for key in self.seen.keys() - records.keys():
+            del self.seen[key]
+
+        if len(changed) > len(self.entries) // 4:
+            self.rebuild()
+            return
+        for key, sort_key in changed:
+            old = self.sort_keys.pop(key, None)
+            if old is not None:
+                del self.entries[bisect.bisect_left(self.entries, (old, key))]
+            if sort_key is not None:
+                bisect.insort(self.entries, (sort_key, key))
+                self.sort_keys[key] = sort_key
+
+    def rebuild(self) -> None:
+        """Filters and sorts all the records from scratch."""
+        self.sort_keys = {
+            key: self.sort_key(record)
+            for key, record in self.records.items()
+            if self.matches(record)
+        }
+        self.entries = sorted(
+            (sort_key, key) for key, sort_key in self.sort_keys.items()
+        )
+
+    def sort_by(self, column: typing.Optional[int], descending: bool) -> None:
+        """Changes the sort column, None being the default order."""
+        self.column = column
+        self.descending = descending
+        self.rebuild()
+
+    def filter_by(
+        self,
+        name_filter: typing.Optional[re.Pattern],
+        uri_filter: typing.Optional[re.Pattern],
+    ) -> None:
+        """Changes the name and URI filters, None showing everything."""
+        self.name_filter = name_filter
+        self.uri_filter = uri_filter
+        self.rebuild()
+
+    def headers(self) -> typing.List[str]:
+        """The column headers with the sort column marked."""
+        headers = list(HEADERS)
+        if self.column is not None:
+            headers[self.column] += "v" if self.descending else "^"
+        return headers
+
+    def status(self) -> str:
+        """Describes the active filters."""
+        filters = []
+        if self.name_filter is not None:
+            filters.append("name=~" + self.name_filter.pattern)
+        if self.uri_filter is not None:
+            filters.append("uri=~" + self.uri_filter.pattern)
+        return " ".join(filters)
+
+
+class Prompt:  # pylint: disable=too-few-public-methods
+    """A line of text input edited one key at a time."""
+
+    def __init__(self, label: str, text: str):
+        self.label = label
+        self.text = text
+
+    def feed(self, char: int) -> typing.Optional[bool]:
+        """Handles a key. Returns True once the input is accepted, False if it
+        was cancelled and None while it is still being edited."""
+        if char in (curses.KEY_ENTER, ord("\n"), ord("\r")):
+            return True
+        if char == 27:
+            return False
+        if char in (curses.KEY_BACKSPACE, 127, 8):
+            self.text = self.text[:-1]
+        elif 32 <= char < 127:
+            self.text += chr(char)
+        return None
+
+
+def compile_filter(text: str) -> typing.Optional[re.Pattern]:
+    """Compiles a filter, an empty one showing everything."""
+    return re.compile(text) if text else None
+
+
+class Renderer:
+    """Draws the table inside a box. Only the rows that fit on the screen are
+    formatted and only the cells that changed since the last frame are written
+    to curses, so the cost of a frame does not depend on the number of rows."""
+
+    def __init__(self, stdscr, headers: typing.Sequence[str], offset: int = 2):
+        self.stdscr = stdscr
+        self.headers = list(headers)
+        self.offset = offset
+        # column widths only ever grow so they are kept up to date from the
+        # rows that get drawn instead of being recomputed over all the rows
+        self.widths = [len(header) + offset for header in headers]
+        # screen line -> (attribute, cells) as currently drawn
+        self.screen: typing.Dict[int, typing.Tuple[int, typing.List[str]]] = {}
+        self.status: str = ""
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Forgets what is on the screen, e.g. after a resize."""
+        self.screen.clear()
+        self.status = ""
+        self.stdscr.clear()
+        self.stdscr.attron(curses.color_pair(4))
+        self.stdscr.box()
+        self.stdscr.attroff(curses.color_pair(4))
+
+    def set_headers(self, headers: typing.List[str]) -> None:
+        """Changes the header texts."""
+        if headers != self.headers:
+            self.headers = headers
+            self.update_widths([headers])
+            self.screen.clear()
+
+    def draw_status(self, text: str) -> None:
+        """Writes a line of text on the bottom border of the box."""
+        if text == self.status:
+            return
+        if self.status:
+            self.invalidate()
+        self.status = text
+        max_rows, max_cols = self.stdscr.getmaxyx()
+        if text and max_cols > 4:
+            self.stdscr.addnstr(
+                max_rows - 1, 2, f" {text} ", max_cols - 4, curses.color_pair(4)
+            )
+
+    def visible_columns(self) -> int:
+        """Number of columns that start inside the box."""
+        _, max_cols = self.stdscr.getmaxyx()
+        x = 1
+        for count, width in enumerate(self.widths):
+            if x >= max_cols - 1:
+                return count
+            x += width
+        return len(self.widths)
+
+    def height(self) -> int:
+        """Number of rows that fit below the header."""
+        max_rows, _ = self.stdscr.getmaxyx()
+        return max(max_rows - 3, 0)
+
+    def update_widths(self, rows: typing.List[typing.List[str]]) -> bool:
+        """Widens the columns for the given rows, returns whether any did."""
+        changed = False
+        for cells in rows:
+            for i, cell in enumerate(cells):
+                if len(cell) + self.offset > self.widths[i]:
+                    self.widths[i] = len(cell) + self.offset
+                    changed = True
+        return changed
+
+    def draw_cell(self, y: int, x: int, text: str, width: int, attr: int) -> None:
+        """Writes a cell, clipped to the inside of the box."""
+        _, max_cols = self.stdscr.getmaxyx()
+        room = min(width, max_cols - 1 - x)
+        if room > 0:
+            self.stdscr.addnstr(y, x, text.ljust(room), room, attr)
+
+    def draw_line(self, y: int, cells: typing.List[str], attr: int) -> None:
+        """Draws one line, only rewriting the cells that changed if the line
+        was already on the screen with the same attribute."""
+        previous = self.screen.get(y)
+        x = 1
+        for i, (cell, width) in enumerate(zip(cells, self.widths)):
+            if previous is None or previous[0] != attr or previous[1][i] != cell:
+                self.draw_cell(y, x, cell, width, attr)
+            x += width
+        if previous is None:
+            # clear whatever a wider previous line left behind
+            self.draw_cell(y, x, "", max(self.stdscr.getmaxyx()[1] - x, 0), attr)
+        self.screen[y] = (attr, cells)
+
+    def clear_line(self, y: int) -> None:
+        """Blanks a line that no longer has a row to show."""
+        if y in self.screen:
+            del self.screen[y]
+            self.draw_cell(y, 1, "", self.stdscr.getmaxyx()[1], curses.A_NORMAL)
+
+    def draw(self, rows: typing.List[typing.Tuple[typing.List[str], int]]) -> None:
+        """Draws the header and the given (cells, attribute) rows."""
+        if self.update_widths([cells for cells, _ in rows]):
+            # everything right of a widened column moves
+            self.screen.clear()
+        self.draw_line(1, self.headers, curses.color_pair(1))
+        for y, (cells, attr) in enumerate(rows, start=2):
+            self.draw_line(y, cells, attr)
+        for y in range(len(rows) + 2, self.height() + 2):
+            self.clear_line(y)
+        self.stdscr.refresh()
+
+
+# the keys the per host summary takes over from the table
+HOST_PANE_KEYS: typing.FrozenSet[int] = frozenset(
+    (
+        ord("j"),
+        ord("k"),
+        ord("g"),
+        ord("G"),
+        ord("\n"),
+        ord("\r"),
+        curses.KEY_DOWN,
+        curses.KEY_UP,
+        curses.KEY_ENTER,
+    )
+)
+
+
+# pylint: disable=too-many-branches,too-many-statements,too-many-locals
+def tui_loop(
+    stdscr,
+    executor: typing.Optional[ActionExecutor],
+    collector: typing.Union[Collector, FleetCollector, AttachedCollector, Replay],
+    active_only: bool,
+    alerts: typing.Optional[AlertEngine] = None,
+) -> None:
+    """Draws the latest snapshot and handles input until the user quits. A
+    replay has no executor, so no domain actions. Domains firing an alert
+    are highlighted."""
+    sel: int = 0
+    # the selection follows its domain when rows move
+    selected: typing.Optional[DomainKey] = None
+    # the domains the next action applies to, instead of the selected one
+    tagged: typing.Set[DomainKey] = set()
+    drawn_generation: typing.Optional[int] = None
+    drawn_actions: int = 0
+    renderer = Renderer(stdscr, [*HEADERS, ACTION_HEADER])
+    # the profile overlay replaces the table while shown
+    overlay: typing.Optional[Renderer] = None
+    # so does the detail pane, of the watched domain
+    detail_pane: typing.Optional[Renderer] = None
+    watched: typing.Optional[DomainKey] = None
+    # and the per host summary, with its own selection
+    host_pane: typing.Optional[Renderer] = None
+    host_sel: int = 0
+    view = SortedView(active_only)
+    prompt: typing.Optional[Prompt] = None
+    # the filter texts, by prompt label
+    filters: typing.Dict[str, str] = {"/": "", "o": ""}
+    status: str = ""
+
+    while True:
+        snapshot = collector.latest()
+        generation = -1 if snapshot is None else snapshot.generation
+        actions = 0 if executor is None else executor.generation
+        char = -1
+        if generation == drawn_generation and actions == drawn_actions:
+            char = stdscr.getch()
+            if char == -1:
+                continue
+
+        stale_uris = frozenset() if snapshot is None else snapshot.stale_uris
+        if generation != drawn_generation:
+            with PROFILER.span("", "sort"):
+                view.update({} if snapshot is None else snapshot.virt_data.records)
+            drawn_generation = generation
+        drawn_actions = actions
+        row_count = max(len(view), 1)
+        index = view.index(selected)
+        sel = min(sel if index is None else index, row_count - 1)
+
+        reordered = False
+        if prompt is not None and char != -1:
+            # the filter is applied as it is being typed
+            done = prompt.feed(char)
+            candidate = dict(filters)
+            if done is not False:
+                candidate[prompt.label] = prompt.text
+            try:
+                view.filter_by(
+                    compile_filter(candidate["/"]), compile_filter(candidate["o"])
+                )
+                error = ""
+            except re.error as exception:
+                error = f" ({exception})"
+            if done is None:
+                status = prompt.label + prompt.text + error
+            else:
+                if error:
+                    # back to the last filters that worked
+                    view.filter_by(
+                        compile_filter(filters["/"]), compile_filter(filters["o"])
+                    )
                 else:
-                    stdscr.addstr(current_visi + 2, 1, line, curses.color_pair(2))
-                current_visi += 1
-
-        inactive_count: int = len(active_ids)
-        if not argparser.args.active:
-            for count, (line, vm_name) in enumerate(zip(lines[1:], virt_data.name)):
-                if count not in active_ids:
-                    vm_name_ordered_list.append(vm_name)
-                    inactive_count += 1
-                    current_row += 1
-                    if current_row >= win_max_row or current_row < win_min_row:
-                        continue
-                    if sel == current_row - 1:
-                        stdscr.addstr(current_visi + 2, 1, line, curses.color_pair(5))
-                    else:
-                        stdscr.addstr(current_visi + 2, 1, line, curses.color_pair(3))
-                    current_visi += 1
-
-        char = stdscr.getch()
-        if char == ord("j") or char == curses.KEY_DOWN:
-            sel = (sel + 1) % (len(lines) - 1)
+                    filters = candidate
+                prompt = None
+            reordered = True
+        elif host_pane is not None and char in HOST_PANE_KEYS:
+            hosts = [uri for uri, _ in get_host_rows(snapshot)]
+            if char in (ord("j"), curses.KEY_DOWN):
+                host_sel += 1
+            elif char in (ord("k"), curses.KEY_UP):
+                host_sel -= 1
+            elif char == ord("g"):
+                host_sel = 0
+            elif char == ord("G"):
+                host_sel = -1
+            elif hosts:
+                # drill down into the domains of the host
+                filters["o"] = "^" + re.escape(hosts[host_sel % len(hosts)]) + "$"
+                view.filter_by(
+                    compile_filter(filters["/"]), compile_filter(filters["o"])
+                )
+                host_pane = None
+                (renderer if detail_pane is None else detail_pane).invalidate()
+                reordered = True
+            host_sel %= max(len(hosts), 1)
+        elif char == ord("j") or char == curses.KEY_DOWN:
+            sel = (sel + 1) % row_count
         elif char == ord("k") or char == curses.KEY_UP:
-            sel = (sel - 1) % (len(lines) - 1)
+            sel = (sel - 1) % row_count
         elif char == ord("g"):
             sel = 0
         elif char == ord("G"):
-            sel = len(lines) - 2
+            sel = row_count - 1
         elif char == ord("q"):
             break
-        elif char == ord("d"):
-            dom = conn.lookupByName(vm_name_ordered_list[sel])
-            logging.debug("shutting down domain %s", vm_name_ordered_list[sel])
-            task_list.append(await destroy_domain(dom))
-        elif char == ord("s"):
-            dom = conn.lookupByName(vm_name_ordered_list[sel])
-            logging.debug("shutting down domain %s", vm_name_ordered_list[sel])
-            task_list.append(await shutdown_domain(dom))
-        elif char == ord("r"):
-            dom = conn.lookupByName(vm_name_ordered_list[sel])
-            logging.debug("shutting down domain %s", vm_name_ordered_list[sel])
-            task_list.append(await start_domain(dom))
-        else:
+        elif char == curses.KEY_RESIZE:
+            renderer.invalidate()
+            if overlay is not None:
+                overlay.invalidate()
+            if detail_pane is not None:
+                detail_pane.invalidate()
+            if host_pane is not None:
+                host_pane.invalidate()
+        elif char == ord("p"):
+            if overlay is None:
+                overlay = Renderer(stdscr, PROFILE_HEADERS)
+            else:
+                overlay = None
+                if host_pane is not None:
+                    host_pane.invalidate()
+                else:
+                    (renderer if detail_pane is None else detail_pane).invalidate()
+        elif char == ord("H"):
+            if host_pane is None:
+                host_pane = Renderer(stdscr, HOST_HEADERS)
+            else:
+                host_pane = None
+                (renderer if detail_pane is None else detail_pane).invalidate()
+        elif char in (curses.KEY_ENTER, ord("\n"), ord("\r")) and isinstance(
+            collector, Collector
+        ):
+            # the detail is only fetched while the pane is open
+            if detail_pane is None and sel < len(view):
+                watched = view[sel].key
+                detail_pane = Renderer(stdscr, DETAIL_HEADERS["vcpus"])
+            elif detail_pane is not None:
+                watched = None
+                detail_pane = None
+                renderer.invalidate()
+            collector.watch(watched)
+        elif char in (ord("<"), ord(">")):
+            # cycle through the columns, with the default order in between
+            positions = [None, *range(len(COLUMNS))]
+            position = positions.index(view.column) + (1 if char == ord(">") else -1)
+            column = positions[position % len(positions)]
+            view.sort_by(
+                column, False if column is None else COLUMNS[column].descending
+            )
+            reordered = True
+        elif char == ord("R") and view.column is not None:
+            view.sort_by(view.column, not view.descending)
+            reordered = True
+        elif char in (ord("/"), ord("o")):
+            prompt = Prompt(chr(char), filters[chr(char)])
+            status = prompt.label + prompt.text
+        elif isinstance(collector, Replay) and collector.feed(char):
             pass
+        elif char == ord(" ") and sel < len(view):
+            tagged ^= {view[sel].key}
+            sel = min(sel + 1, row_count - 1)
+        elif char in ACTIONS and executor is not None:
+            targets = tagged or ({view[sel].key} if sel < len(view) else set())
+            for key in targets:
+                executor.submit(key, char)
+            tagged = set()
+        if snapshot is not None:
+            # tags of domains that went away are dropped
+            tagged.intersection_update(snapshot.virt_data.records)
+        if prompt is None:
+            status = view.status()
+            if tagged:
+                status = " ".join(filter(None, (f"{len(tagged)} tagged", status)))
+            if isinstance(collector, Replay):
+                status = " ".join(filter(None, (collector.status(), status)))
+            if alerts is not None and alerts.firing:
+                status = " ".join(
+                    filter(None, (f"{len(alerts.firing)} alerting", status))
+                )
 
-        stdscr.refresh()
-        vm_name_ordered_list = []
+        if reordered:
+            # keep the selected domain selected after a resort or a refilter
+            index = view.index(selected)
+            sel = sel if index is None else index
+        row_count = max(len(view), 1)
+        sel = min(sel, row_count - 1)
+        selected = view[sel].key if sel < len(view) else None
 
+        if isinstance(collector, AttachedCollector):
+            # only what is on the screen comes over the socket
+            columns = list(HEADERS[: renderer.visible_columns()])
+            if view.column is not None:
+                columns.append(HEADERS[view.column])
+            if host_pane is not None:
+                columns += HOST_COLUMNS
+            if alerts is not None:
+                columns += alerts.columns
+            collector.subscribe(columns, filters["o"])
 
-def main() -> None:
-    """Entry point."""
+        if overlay is not None:
+            overlay.draw_status("profile, p to close")
+            summary = PROFILER.summary()[: overlay.height()]
+            overlay.draw([(line, curses.color_pair(2)) for line in summary])
+            continue
+
+        if host_pane is not None:
+            host_pane.draw_status("hosts, Enter shows the domains of one, H to close")
+            host_rows = get_host_rows(snapshot)
+            host_sel = min(host_sel, max(len(host_rows) - 1, 0))
+            win_min_row, win_max_row = get_visible_rows(host_pane.height(), host_sel)
+            rows = []
+            for row in range(win_min_row, min(win_max_row, len(host_rows))):
+                uri, cells = host_rows[row]
+                if row == host_sel:
+                    attr = curses.color_pair(5)
+                elif uri in stale_uris:
+                    attr = curses.color_pair(3)
+                else:
+                    attr = curses.color_pair(2)
+                rows.append((cells, attr))
+            host_pane.draw(rows[: host_pane.height()])
+            continue
+
+        if detail_pane is not None and watched is not None:
+            detail = collector.detail(watched)
+            name = watched[1] if detail is None else detail.name
+            state = "loading, " if detail is None else ""
+            if detail is not None and not detail.vcpus:
+                state = "not running, "
+            detail_pane.draw_status(f"{name} on {watched[0]}, {state}Enter to close")
+            detail_pane.draw(get_detail_rows(detail)[: detail_pane.height()])
+            continue
+
+        renderer.set_headers([*view.headers(), ACTION_HEADER])
+        renderer.draw_status(status)
+        win_min_row, win_max_row = get_visible_rows(renderer.height(), sel)
+        rows = []
+        with PROFILER.span("", "format"):
+            for row in range(win_min_row, min(win_max_row, len(view))):
+                record = view[row]
+                if row == sel:
+                    attr = curses.color_pair(5)
+                elif alerts is not None and record.key in alerts.firing:
+                    attr = curses.color_pair(6)
+                elif record.dom_id >= 0:
+                    attr = curses.color_pair(2)
+                else:
+                    attr = curses.color_pair(3)
+                action = "" if executor is None else executor.status(record.key)
+                if record.key in tagged:
+                    attr |= curses.A_UNDERLINE
+                    action = action or "tagged"
+                rows.append(([*get_row(record, stale_uris), action], attr))
+        with PROFILER.span("", "draw"):
+            renderer.draw(rows[: renderer.height()])
+
+
+def tui_main(argparser) -> None:
+    """Runs the TUI. Whatever can fail on bad input is done before curses
+    takes over the terminal."""
+    config_data = load_config(argparser)
+    replay = None
+    if argparser.args.replay:
+        try:
+            replay = Replay(argparser.args.replay)
+        except (OSError, ValueError) as exception:
+            argparser.parser.error(str(exception))
+    attached = None
+    if argparser.args.attach:
+        try:
+            attached = AttachedCollector(argparser.args.attach)
+        except OSError as exception:
+            argparser.parser.error(f"{argparser.args.attach}: {exception}")
+
+    stdscr = curses_init()
     try:
-        argparser = Argparser()
-        stdscr = curses_init()
-        logging.basicConfig(
-            filename=os.path.expanduser(argparser.args.logfile),
-            filemode="w",
-            format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
-            datefmt="%H:%M:%S",
-            level=logging.DEBUG,
-        )
-        asyncio.run(main_loop(argparser, stdscr))
+        main_loop(argparser, stdscr, config_data, replay, attached)
     except Exception as exception:
         logging.exception(exception)
     finally:
         do_cleanup(stdscr)
 
 
+def init_logging(logfile: str, filemode: str = "w") -> None:
+    """Logs everything to the log file."""
+    logging.basicConfig(
+        filename=os.path.expanduser(logfile),
+        filemode=filemode,
+        format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
+        datefmt="%H:%M:%S",
+        level=logging.DEBUG,
+    )
+
+
+def main() -> None:
+    """Entry point."""
+    argparser = Argparser()
+    init_logging(argparser.args.logfile)
+    RPC_LIMITER.max_inflight = argparser.args.max_inflight
+    # only replays work without libvirt
+    if isinstance(libvirt, MissingModule) and not argparser.args.replay:
+        argparser.parser.error("libvirt-python is not installed")
+    if argparser.args.serve:
+        try:
+            parse_address(argparser.args.serve)
+        except ValueError as exception:
+            argparser.parser.error(f"--serve: {exception}")
+    try:
+        if argparser.args.batch:
+            batch_loop(argparser)
+        elif argparser.args.serve:
+            serve_loop(argparser)
+        elif argparser.args.daemon:
+            daemon_loop(argparser)
+        else:
+            tui_main(argparser)
+    finally:
+        if argparser.args.profile_log:
+            PROFILER.dump()
+
+
 if __name__ == "__main__":
     main()